@@ -60,6 +60,16 @@ export interface SongDownloadJson {
   download_token: string
 }
 
+export interface UploadJobJson {
+  job: string
+  status: 'queued' | 'encoding' | 'done' | 'failed'
+  filename: string
+  artist: string | null
+  title: string | null
+  id: string | null
+  position?: number | null
+}
+
 export interface SongRequestJson {
   meta: SongMeta
 }
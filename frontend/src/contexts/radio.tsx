@@ -162,6 +162,38 @@ async function fetchInfo(dispatch: Dispatch) {
     })
 }
 
+// Subscribes to the now playing changes pushed by the server.
+// onInfo is called with the whole document on (re)connect and on every change.
+// Returns a function that closes the subscription.
+function subscribeInfo(
+  dispatch: Dispatch,
+  onInfo: (info: ReturnType<typeof transformNowPlaying>) => void,
+  onError: () => void
+): () => void {
+  let current: ApiResponse<NowPlayingJson> | undefined
+  const source = new EventSource(`${API_BASE}/np/events`)
+  const apply = (resp: ApiResponse<NowPlayingJson>) => {
+    current = resp
+    dispatch({ type: 'SET_INFO', payload: resp })
+    onInfo(transformNowPlaying(resp))
+  }
+  source.addEventListener('np', event =>
+    apply(JSON.parse((event as MessageEvent).data))
+  )
+  // updates only carry the fields that changed
+  source.addEventListener('update', event => {
+    if (current) {
+      apply({ ...current, ...JSON.parse((event as MessageEvent).data) })
+    }
+  })
+  // the browser reconnects by itself, and gets the whole document again
+  source.onerror = () => {
+    current = undefined
+    onError()
+  }
+  return () => source.close()
+}
+
 function setFavourited(dispatch: Dispatch, favourited: boolean) {
   dispatch({ type: 'SET_FAVOURITED', payload: favourited })
 }
@@ -172,5 +204,6 @@ export {
   useRadioInfoState,
   useRadioInfoDispatch,
   fetchInfo,
+  subscribeInfo,
   setFavourited
 }
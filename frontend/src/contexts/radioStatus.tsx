@@ -1,7 +1,18 @@
 import { useControlState } from '/contexts/control'
-import { fetchInfo, useRadioInfoDispatch } from '/contexts/radio'
+import {
+  fetchInfo,
+  subscribeInfo,
+  useRadioInfoDispatch
+} from '/contexts/radio'
 import { useInterval } from '/utils'
-import React, { createContext, useContext, useReducer, useRef } from 'react'
+import React, {
+  createContext,
+  useContext,
+  useEffect,
+  useReducer,
+  useRef,
+  useState
+} from 'react'
 
 export const SYNC_OFFSET = 0
 
@@ -91,36 +102,63 @@ function RadioStatusProvider({ children }: ProviderProps) {
 
   const controlState = useControlState()
 
+  // only follow the server if radio is playing, or we are on the homepage
+  const active = controlState.playing || window.location.pathname === '/'
+  // whether changes are being pushed by the server, polling is the fallback
+  const [pushed, setPushed] = useState(false)
+
+  const sync = (songInfo: {
+    startTime: number
+    endTime: number
+    serverTime: number
+  }) =>
+    dispatch({
+      type: 'UPDATE',
+      payload: {
+        start: songInfo.startTime + SYNC_OFFSET,
+        // set end to 0 to reset the counter
+        // this is done to make sure the counter still progresses
+        // even if there are no songs.
+        end:
+          songInfo.startTime !== songInfo.endTime
+            ? songInfo.endTime + SYNC_OFFSET
+            : 0,
+        serverTime: songInfo.serverTime,
+        clientTime: Math.round(new Date().getTime() / 1000.0)
+      }
+    })
+
+  useEffect(() => {
+    if (!active || typeof EventSource === 'undefined') {
+      return
+    }
+    const unsubscribe = subscribeInfo(
+      radioInfoDispatch,
+      info => {
+        setPushed(true)
+        sync(info.songInfo)
+      },
+      () => setPushed(false)
+    )
+    return () => {
+      unsubscribe()
+      setPushed(false)
+    }
+  }, [active])
+
   useInterval(
     () => {
       // once counter hits 8 (i.e. 8 seconds) or song has finished
       // then fetch current song info from server
       if (
         isFirstRun.current ||
-        // only request info if radio is playing, or we are on the homepage
-        ((controlState.playing || window.location.pathname === '/') &&
+        (active &&
+          !pushed &&
           (state.counter >= 8.0 ||
             // next song should have started by now, so refresh
             state.position > state.duration))
       ) {
-        fetchInfo(radioInfoDispatch).then(info => {
-          const { songInfo } = info
-          dispatch({
-            type: 'UPDATE',
-            payload: {
-              start: songInfo.startTime + SYNC_OFFSET,
-              // set end to 0 to reset the counter
-              // this is done to make sure the counter still progresses
-              // even if there are no songs.
-              end:
-                songInfo.startTime !== songInfo.endTime
-                  ? songInfo.endTime + SYNC_OFFSET
-                  : 0,
-              serverTime: songInfo.serverTime,
-              clientTime: Math.round(new Date().getTime() / 1000.0)
-            }
-          })
-        })
+        fetchInfo(radioInfoDispatch).then(info => sync(info.songInfo))
       }
       dispatch({ type: 'UPDATE_COUNTER' })
       if (isFirstRun.current) {
@@ -6,7 +6,8 @@ import {
   AutocompleteJson,
   Description,
   SongItem,
-  SongsJson
+  SongsJson,
+  UploadJobJson
 } from '/api/Schemas'
 import Error from '/components/Error'
 import NotificationToast from '/components/NotificationToast'
@@ -66,6 +67,28 @@ interface SongUploadFormProps {
   refreshSong: (song: string) => void
 }
 
+const JOB_POLL_INTERVAL = 2000
+
+// uploads are encoded in the background, so wait for the song to be added
+function waitForJob(job: string): Promise<ApiResponse<UploadJobJson>> {
+  return new Promise((resolve, reject) => {
+    const poll = () =>
+      fetch(`${API_BASE}/upload/${job}`)
+        .then(resp => resp.clone().json())
+        .then((result: ApiResponse<UploadJobJson>) => {
+          if (result.status_code !== 200 || result.status === 'failed') {
+            reject(result)
+          } else if (result.status === 'done') {
+            resolve(result)
+          } else {
+            setTimeout(poll, JOB_POLL_INTERVAL)
+          }
+        })
+        .catch(reject)
+    poll()
+  })
+}
+
 const SongUploadForm: FunctionComponent<SongUploadFormProps> = ({
   refreshSong
 }) => {
@@ -73,13 +96,16 @@ const SongUploadForm: FunctionComponent<SongUploadFormProps> = ({
 
   const pond = useRef<FilePond>(null)
   const [files, setFiles] = useState<FilePondFile[]>([])
+  // jobs finish after later renders, so always refresh with the latest songs
+  const refresh = useRef(refreshSong)
+  refresh.current = refreshSong
 
   const server = {
     process: {
       url: `${API_BASE}/upload`,
       onload: (response: any) => {
-        const json: { id: string } = JSON.parse(response)
-        return json.id
+        const json: { job: string } = JSON.parse(response)
+        return json.job
       },
       onerror: (response: any) => {
         const json: ApiBaseResponse = JSON.parse(response)
@@ -99,8 +125,16 @@ const SongUploadForm: FunctionComponent<SongUploadFormProps> = ({
   const onProcessFile = (err: any, file: FilePondFile) => {
     if (!err) {
       // @ts-ignore
-      toast(<NotificationToast>Song uploaded!</NotificationToast>)
-      refreshSong(file.serverId)
+      toast(<NotificationToast>Song uploaded, encoding...</NotificationToast>)
+      waitForJob(file.serverId)
+        .then(result => {
+          toast(<NotificationToast>Song added!</NotificationToast>)
+          if (result.id) refresh.current(result.id)
+        })
+        .catch(result => {
+          const msg = result.message || result.description || 'Upload failed'
+          toast(<NotificationToast error>{msg}</NotificationToast>)
+        })
 
       // remove file after uploaded
       pond.current && pond.current.removeFile(file.id)
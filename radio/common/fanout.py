@@ -0,0 +1,155 @@
+import logging
+import os
+import subprocess
+import threading
+from typing import List
+from typing import Optional
+from typing import Tuple
+from uuid import UUID
+
+from radio.common.ringbuffer import RingBuffer
+from radio.common.schemas import Track
+from radio.common.transcode import Rendition
+from radio.common.transcode import gain_args
+from radio.common.transcode import trim_args
+
+logger = logging.getLogger("stream")
+
+
+class FanOut:
+    """
+    Decodes each track once and fans the encoded renditions out to ring buffers.
+    A single ffmpeg process reads the file and writes every rendition to its own pipe,
+    so adding a mount costs an encoder rather than another read and decode.
+
+    :param config: app config
+    :param outputs: rendition and the ring buffer its worker reads from
+    """
+
+    def __init__(self, config: dict, outputs: List[Tuple[Rendition, RingBuffer]]):
+        self.config = config
+        self.outputs = outputs
+        self.process: Optional[subprocess.Popen] = None
+        # decoder started ahead of time: (song id, process, pipe read ends)
+        self.prepared: Optional[Tuple[UUID, subprocess.Popen, List[int]]] = None
+        self.threads: List[threading.Thread] = []
+
+    def command(self, track: Track, fds: List[int]) -> List[str]:
+        """
+        Builds the ffmpeg command writing each rendition of `track` to its pipe
+
+        :param track: track to decode
+        :param fds: pipe file descriptors, one per output
+        :return: ffmpeg command line
+        """
+        command = [
+            str(self.config["PATH_FFMPEG_BINARY"]),
+            *trim_args(track),
+            "-i",
+            str(track.path),
+        ]
+        # trimmed on input, so every rendition (stream copies too) starts at once
+        for (rendition, _), fd in zip(self.outputs, fds):
+            # stream copies cannot be filtered, they rely on ReplayGain tags
+            levelling = [] if rendition.passthrough else gain_args(track)
+            command += ["-map", "0:a", *levelling, *rendition.encoder_args()]
+            command.append(f"pipe:{fd}")
+        return command
+
+    def prepare(self, track: Track) -> None:
+        """
+        Pre-starts the decoder for the track that will be played next.
+        ffmpeg primes its encoders and blocks once the pipes are full,
+        until `start` begins draining them.
+
+        :param track: track to decode
+        """
+        self.discard()
+        pipes = [os.pipe() for _ in self.outputs]
+        write_fds = [write_fd for _, write_fd in pipes]
+        process = subprocess.Popen(
+            self.command(track, write_fds),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            pass_fds=write_fds,
+        )
+        logger.debug(f"Started fan-out ffmpeg for {len(self.outputs)} renditions.")
+        for fd in write_fds:
+            os.close(fd)
+        self.prepared = (track.id, process, [read_fd for read_fd, _ in pipes])
+
+    def discard(self) -> None:
+        """
+        Stops a prepared decoder that will not be used
+        """
+        if self.prepared:
+            _, process, read_fds = self.prepared
+            self.prepared = None
+            process.terminate()
+            process.wait()
+            for fd in read_fds:
+                os.close(fd)
+
+    def start(self, track: Track) -> None:
+        """
+        Starts decoding the given track into every ring buffer.
+        Must only be called once the workers have finished the previous track.
+
+        :param track: track to decode
+        """
+        if not self.prepared or self.prepared[0] != track.id:
+            self.prepare(track)
+        _, self.process, read_fds = self.prepared
+        self.prepared = None
+        for _, ring in self.outputs:
+            ring.reset()
+        self.threads = [
+            threading.Thread(target=self.pump, args=(read_fd, ring), daemon=True)
+            for read_fd, (_, ring) in zip(read_fds, self.outputs)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def pump(self, fd: int, ring: RingBuffer) -> None:
+        """
+        Copies one ffmpeg output into its ring buffer.
+        If the reader goes away the pipe is still drained, so ffmpeg never
+        stalls the other renditions.
+        """
+        chunk = bytearray(64 * 1024)
+        view = memoryview(chunk)
+        connected = True
+        with open(fd, "rb", buffering=0) as pipe:
+            while True:
+                size = pipe.readinto(chunk)
+                if not size:
+                    break
+                if connected:
+                    connected = ring.write(view[:size])
+        ring.finish()
+
+    def stop(self) -> None:
+        """
+        Stops decoding the current track, whether or not it has finished
+        """
+        for _, ring in self.outputs:
+            ring.close()
+        if self.process:
+            self.process.terminate()
+            self.process.wait()
+            self.process = None
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def close(self) -> None:
+        """
+        Stops decoding and frees the ring buffers.
+        Must only be called by the process that created them, once the workers
+        have exited.
+        """
+        self.discard()
+        self.stop()
+        for _, ring in self.outputs:
+            ring.unlink()
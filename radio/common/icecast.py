@@ -0,0 +1,218 @@
+import base64
+import http.client
+import json
+import logging
+import queue
+import threading
+import time
+import urllib.parse
+import urllib.request
+from http.client import responses
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+
+from radio import app
+from radio import redis_client
+from radio.common.transcode import get_renditions
+
+logger = logging.getLogger("stream")
+
+# listener counts and health of every mount, as last sampled
+STATUS_KEY = "icecast:status"
+
+
+def mount_of(listenurl: str) -> str:
+    return urllib.parse.urlsplit(listenurl).path
+
+
+def fetch_status(timeout: float) -> Dict[str, Any]:
+    """
+    Reads the listener count and health of every mount with a single request
+    to Icecast's status-json.xsl
+
+    :param timeout: timeout for the request, in seconds
+    :return: total listeners, and whether each mount is online and its listeners
+    """
+    url = "http://{ICECAST_HOST}:{ICECAST_PORT}/status-json.xsl".format(**app.config)
+    mounts = {
+        rendition.mount: {"online": False, "listeners": 0}
+        for rendition in get_renditions(app.config)
+    }
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as resp:
+            stats = json.load(resp).get("icestats", {})
+    except (OSError, ValueError):
+        logger.warning(f"Could not read Icecast status from {url}")
+        stats = {}
+    sources = stats.get("source") or []
+    # a single source is not wrapped in a list
+    if isinstance(sources, dict):
+        sources = [sources]
+    for source in sources:
+        mount = mount_of(source.get("listenurl", ""))
+        if mount in mounts:
+            listeners = int(source.get("listeners") or 0)
+            mounts[mount] = {"online": True, "listeners": listeners}
+    return {
+        "listeners": sum(mount["listeners"] for mount in mounts.values()),
+        "mounts": mounts,
+        "sampled": time.time(),
+    }
+
+
+def sample_status() -> Dict[str, Any]:
+    """
+    Fetches the status of every mount and caches it for ICECAST_STATUS_TTL seconds
+    """
+    status = fetch_status(app.config.get("ICECAST_STATUS_TIMEOUT", 5))
+    try:
+        redis_client.set(
+            STATUS_KEY,
+            json.dumps(status),
+            ex=app.config.get("ICECAST_STATUS_TTL", 60),
+        )
+    except Exception:
+        logger.warning("Could not store Icecast status", exc_info=True)
+    return status
+
+
+def get_cached_status() -> Optional[Dict[str, Any]]:
+    try:
+        cached = redis_client.get(STATUS_KEY)
+    except Exception:
+        logger.warning("Could not read Icecast status", exc_info=True)
+        return None
+    return json.loads(cached) if cached else None
+
+
+def get_status() -> Dict[str, Any]:
+    """
+    Returns the cached status of every mount, only sampling it if the cache
+    is empty (e.g. when no stream node is running a sampler)
+    """
+    return get_cached_status() or sample_status()
+
+
+def get_listeners() -> int:
+    """
+    :return: number of listeners across every mount
+    """
+    return get_status()["listeners"]
+
+
+class StatusSampler:
+    """
+    Samples the status of every mount from a background thread, so readers
+    only ever see the cached value and never wait on Icecast.
+
+    :param interval: time between samples, in seconds
+    :param on_sample: called with each new status
+    :param active: only samples while this returns True, e.g. while this node
+        leads, so several nodes never sample at once
+    """
+
+    def __init__(
+        self,
+        interval: float = 10.0,
+        on_sample: Optional[Callable[[Dict[str, Any]], None]] = None,
+        active: Optional[Callable[[], bool]] = None,
+    ):
+        self.interval = interval
+        self.on_sample = on_sample
+        self.active = active
+
+    @classmethod
+    def from_config(
+        cls,
+        config: dict,
+        on_sample: Optional[Callable[[Dict[str, Any]], None]] = None,
+        active: Optional[Callable[[], bool]] = None,
+    ) -> "StatusSampler":
+        return cls(config.get("ICECAST_STATUS_INTERVAL", 10.0), on_sample, active)
+
+    def start(self) -> None:
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self) -> None:
+        while True:
+            started = time.monotonic()
+            if self.active and not self.active():
+                time.sleep(self.interval)
+                continue
+            try:
+                status = sample_status()
+                if self.on_sample:
+                    self.on_sample(status)
+            except Exception:
+                logger.exception("Failed to sample Icecast status")
+            time.sleep(max(self.interval - (time.monotonic() - started), 0))
+
+
+class MetadataUpdater:
+    """
+    Sends "now playing" titles to Icecast from a background thread.
+    Updates reuse a single kept-alive HTTP connection, and only the latest
+    pending title is sent, so a slow Icecast never delays any audio.
+
+    :param params: shouty connection parameters of the mount to update
+    :param timeout: timeout for each update request, in seconds
+    """
+
+    def __init__(self, params: dict, timeout: float = 5.0):
+        self.host = params["host"]
+        self.port = params["port"]
+        self.mount = params["mount"]
+        self.timeout = timeout
+        credentials = f"{params['user']}:{params['password']}".encode("ascii")
+        self.authorization = "Basic " + base64.b64encode(credentials).decode("utf-8")
+        self.pending: "queue.Queue[Tuple[str, str]]" = queue.Queue()
+        self.connection: Optional[http.client.HTTPConnection] = None
+
+    def start(self) -> None:
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def update(self, artist: str, title: str) -> None:
+        """
+        Queues a title update for the mount, without blocking
+        """
+        self.pending.put((artist, title))
+
+    def run(self) -> None:
+        while True:
+            update = self.pending.get()
+            # skip straight to the newest title if several are waiting
+            while not self.pending.empty():
+                update = self.pending.get_nowait()
+            try:
+                self.send(*update)
+            except Exception:
+                logger.exception(f"Failed to set metadata for {self.mount}")
+
+    def send(self, artist: str, title: str) -> None:
+        song = urllib.parse.quote_plus(f"{artist} - {title}")
+        url = f"/admin/metadata?mount={self.mount}&mode=updinfo&song={song}"
+        headers = {"Authorization": self.authorization, "Connection": "keep-alive"}
+        # retry once on a fresh connection if the kept-alive one was closed
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(
+                    self.host, self.port, timeout=self.timeout
+                )
+            try:
+                self.connection.request("GET", url, headers=headers)
+                resp = self.connection.getresponse()
+                resp.read()
+            except (http.client.HTTPException, OSError):
+                self.connection.close()
+                self.connection = None
+                if attempt:
+                    raise
+                continue
+            if resp.will_close:
+                self.connection.close()
+                self.connection = None
+            logger.debug(f"Set metadata [{resp.status} {responses[resp.status]}]")
+            return
@@ -0,0 +1,200 @@
+import json
+import time
+import uuid
+from enum import Enum
+from pathlib import Path
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+
+from redis.exceptions import WatchError
+
+from radio import app
+from radio import redis_client
+
+# pending jobs, scored so higher priorities (then older jobs) come first
+JOBS_KEY = "upload:jobs"
+# jobs being encoded, scored by when they started
+RUNNING_KEY = "upload:running"
+JOB_KEY = "upload:job:{}"
+
+PRIORITY_HIGH = 2
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 0
+# keeps every priority level's scores apart, whatever the timestamp
+PRIORITY_SPAN = 1e10
+
+
+class JobStatus(str, Enum):
+    QUEUED = "queued"
+    ENCODING = "encoding"
+    DONE = "done"
+    FAILED = "failed"
+
+
+def job_score(priority: int, created: float) -> float:
+    return (PRIORITY_HIGH - priority) * PRIORITY_SPAN + created
+
+
+def create_job(
+    path: Path,
+    filename: str,
+    hashes: Dict[str, str],
+    priority: int = PRIORITY_NORMAL,
+    **fields: Any,
+) -> str:
+    """
+    Queues an uploaded file to be encoded and added to the library
+
+    :param path: uploaded file, in PATH_ENCODE
+    :param filename: name of the file as uploaded
+    :param hashes: hashes of the uploaded file, see `hash_song`
+    :param priority: one of the PRIORITY_ constants
+    :param fields: extra details to report in the job's status
+    :return: ID of the new job
+    """
+    job_id = uuid.uuid4().hex
+    created = time.time()
+    job = {
+        "status": JobStatus.QUEUED.value,
+        "path": str(path),
+        "filename": filename,
+        "hashes": json.dumps(hashes),
+        "priority": priority,
+        "created": created,
+        **fields,
+    }
+    pipe = redis_client.pipeline()
+    pipe.hset(JOB_KEY.format(job_id), mapping=job)
+    pipe.zadd(JOBS_KEY, {job_id: job_score(priority, created)})
+    pipe.execute()
+    return job_id
+
+
+def get_job(job_id: str) -> Optional[Dict[str, Any]]:
+    """
+    :return: the job's fields, or None if it does not exist (or has expired)
+    """
+    fields = redis_client.hgetall(JOB_KEY.format(job_id))
+    if not fields:
+        return None
+    job: Dict[str, Any] = {k.decode(): v.decode() for k, v in fields.items()}
+    job["hashes"] = json.loads(job["hashes"])
+    job["priority"] = int(job["priority"])
+    job["created"] = float(job["created"])
+    return job
+
+
+def update_job(job_id: str, status: JobStatus, **fields: Any) -> None:
+    """
+    Updates a job's status. Finished jobs are kept for UPLOAD_JOB_TTL seconds.
+    """
+    key = JOB_KEY.format(job_id)
+    pipe = redis_client.pipeline()
+    pipe.hset(key, mapping={"status": status.value, **fields})
+    if status in (JobStatus.DONE, JobStatus.FAILED):
+        pipe.expire(key, app.config.get("UPLOAD_JOB_TTL", 86400))
+    pipe.execute()
+
+
+def queue_position(job_id: str) -> Optional[int]:
+    """
+    :return: number of jobs ahead of the given one, or None if it is not queued
+    """
+    return redis_client.zrank(JOBS_KEY, job_id)
+
+
+def claim_job() -> Optional[str]:
+    """
+    Moves the first queued job to the running set in a single transaction,
+    so it is never lost if its encoder dies right after taking it
+
+    :return: ID of the job, or None if the queue is empty
+    """
+    with redis_client.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(JOBS_KEY)
+                first = pipe.zrange(JOBS_KEY, 0, 0)
+                if not first:
+                    return None
+                job_id = first[0].decode()
+                pipe.multi()
+                pipe.zrem(JOBS_KEY, job_id)
+                pipe.zadd(RUNNING_KEY, {job_id: time.time()})
+                pipe.execute()
+                return job_id
+            except WatchError:
+                # another encoder took a job first, try again
+                continue
+
+
+def next_job(timeout: float = 5.0, poll: float = 0.5) -> Optional[str]:
+    """
+    Waits for the next job to encode, see `claim_job`
+
+    :param timeout: how long to wait, in seconds
+    :param poll: time between checks of an empty queue, in seconds
+    :return: ID of the job, or None if there was none
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        job_id = claim_job()
+        if job_id or time.monotonic() >= deadline:
+            return job_id
+        time.sleep(poll)
+
+
+def requeue_job(job_id: str) -> None:
+    """
+    Puts a job back in its place in the queue, freeing its slot
+    """
+    job = get_job(job_id)
+    pipe = redis_client.pipeline()
+    if job:
+        pipe.zadd(JOBS_KEY, {job_id: job_score(job["priority"], job["created"])})
+    pipe.zrem(RUNNING_KEY, job_id)
+    pipe.execute()
+
+
+def acquire_slot(job_id: str, limit: int, lease: float) -> bool:
+    """
+    Takes one of the `limit` encode slots shared by every encoder process.
+    Slots held longer than `lease` seconds (e.g. by a crashed process) are freed,
+    and their jobs requeued. Jobs taken with `next_job` already hold a place
+    in the running set, a job that does not get a slot must be requeued.
+
+    :return: True if the slot was taken
+    """
+    requeue_expired(lease)
+    pipe = redis_client.pipeline()
+    pipe.zadd(RUNNING_KEY, {job_id: time.time()}, nx=True)
+    pipe.zrank(RUNNING_KEY, job_id)
+    rank = pipe.execute()[-1]
+    return rank is not None and rank < limit
+
+
+def release_slot(job_id: str) -> None:
+    redis_client.zrem(RUNNING_KEY, job_id)
+
+
+def requeue_expired(lease: float) -> List[str]:
+    """
+    Frees the slots held longer than `lease` seconds, requeueing their jobs,
+    as the encoder holding them died (or hung) before finishing
+
+    :return: IDs of the requeued jobs
+    """
+    expired = redis_client.zrangebyscore(RUNNING_KEY, "-inf", time.time() - lease)
+    requeued = []
+    for job_id in (job_id.decode() for job_id in expired):
+        # only the process that frees the slot requeues its job
+        if not redis_client.zrem(RUNNING_KEY, job_id):
+            continue
+        job = get_job(job_id)
+        if job and job["status"] in (JobStatus.QUEUED, JobStatus.ENCODING):
+            update_job(job_id, JobStatus.QUEUED)
+            requeue_job(job_id)
+            requeued.append(job_id)
+    return requeued
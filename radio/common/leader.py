@@ -0,0 +1,176 @@
+import dataclasses
+import json
+import logging
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Optional
+from uuid import UUID
+
+from radio import app
+from radio import redis_client
+from radio.common.schemas import Track
+
+logger = logging.getLogger("stream")
+
+# channel the leader publishes each scheduled track on
+TRACK_CHANNEL = "stream:track"
+
+# only extend/release the lease if we still hold it
+RENEW_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("pexpire", KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+def dump_track(track: Track) -> str:
+    return json.dumps(dataclasses.asdict(track), default=str)
+
+
+def load_track(data: str) -> Track:
+    fields = json.loads(data)
+    fields["id"] = UUID(fields["id"])
+    # music may be mounted elsewhere on this node
+    fields["path"] = Path(app.config["PATH_MUSIC"], Path(fields["path"]).name)
+    return Track(**fields)
+
+
+class LeaderLease:
+    """
+    Redis lease electing the single stream node allowed to schedule tracks
+    (or, keyed by mount, to stream to a mount).
+    The lease is held and renewed by a background thread; if the leader dies,
+    the lease expires and a standby node takes over.
+    Each new holder gets a higher fencing token, so work done by a holder that
+    lost the lease while paused can be told apart from the current holder's.
+
+    :param key: Redis key holding the lease
+    :param ttl: lifetime of the lease, in seconds
+    """
+
+    def __init__(self, key: str = "stream:leader", ttl: float = 10.0):
+        self.key = key
+        self.ttl = ttl
+        self.node_id = str(uuid.uuid4())
+        self.leader = threading.Event()
+        self.token = 0
+        self.renew_script = redis_client.register_script(RENEW_SCRIPT)
+        self.release_script = redis_client.register_script(RELEASE_SCRIPT)
+
+    @classmethod
+    def from_config(
+        cls, config: dict, key: str = "stream:leader"
+    ) -> Optional["LeaderLease"]:
+        """
+        :returns: the configured lease, or None if leader election is disabled
+        """
+        if not config.get("STREAM_LEADER_ELECTION", False):
+            return None
+        return cls(key=key, ttl=config.get("STREAM_LEADER_TTL", 10.0))
+
+    @property
+    def is_leader(self) -> bool:
+        return self.leader.is_set()
+
+    def acquire(self) -> bool:
+        """
+        Takes the lease if it is free, or renews it if we already hold it
+
+        :return: True if this node holds the lease
+        """
+        ttl_ms = int(self.ttl * 1000)
+        try:
+            held = bool(redis_client.set(self.key, self.node_id, nx=True, px=ttl_ms))
+            if held:
+                self.token = redis_client.incr(f"{self.key}:token")
+            else:
+                args = [self.node_id, ttl_ms]
+                held = bool(self.renew_script(keys=[self.key], args=args))
+        except Exception:
+            logger.exception(f"Could not reach Redis to renew the lease {self.key}")
+            held = False
+        if held and not self.is_leader:
+            logger.info(f"Node {self.node_id} now holds the lease {self.key}")
+        elif not held and self.is_leader:
+            logger.warning(f"Node {self.node_id} lost the lease {self.key}")
+        if held:
+            self.leader.set()
+        else:
+            self.leader.clear()
+        return held
+
+    def confirm(self) -> bool:
+        """
+        Renews the lease right away, before doing work only the holder may do.
+        Unlike `is_leader`, this is never stale after the process was paused.
+
+        :return: True if this node still holds the lease
+        """
+        return self.acquire()
+
+    def release(self) -> None:
+        self.leader.clear()
+        try:
+            self.release_script(keys=[self.key], args=[self.node_id])
+        except Exception:
+            logger.exception("Could not release the lease, it will expire")
+
+    def keep(self) -> None:
+        """
+        Acquires and renews the lease, several times per lease lifetime
+        """
+        while True:
+            time.sleep(self.ttl / 3)
+            self.acquire()
+
+    def start(self) -> None:
+        self.acquire()
+        threading.Thread(target=self.keep, daemon=True).start()
+
+
+class TrackFollower:
+    """
+    Receives the tracks scheduled by the leader, for nodes that are not leading
+    """
+
+    def __init__(self):
+        self.pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(TRACK_CHANNEL)
+        # highest fencing token seen, tracks from older leaders are ignored
+        self.fence = 0
+
+    def next(self, timeout: float = 1.0) -> Optional[Track]:
+        """
+        Waits for the leader to schedule a track.
+        If several have been published since the last call, only the latest is kept.
+
+        :param timeout: how long to wait, in seconds
+        :return: the latest scheduled track, or None if none was published
+        """
+        message = self.pubsub.get_message(timeout=timeout)
+        latest = None
+        while message:
+            track = load_track(message["data"].decode())
+            if track.fence >= self.fence:
+                self.fence = track.fence
+                latest = track
+            else:
+                logger.warning(f"Ignoring track from a stale leader: {track.path}")
+            message = self.pubsub.get_message()
+        return latest
+
+
+def publish_track(track: Track) -> None:
+    """
+    Publishes a track scheduled by the leader to every stream node
+    """
+    redis_client.publish(TRACK_CHANNEL, dump_track(track))
@@ -0,0 +1,187 @@
+import socket
+import threading
+import time
+from collections import defaultdict
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
+
+from radio import redis_client
+from radio.common.icecast import get_cached_status
+from radio.common.tagcache import get_cache_counters
+
+# Redis hash each worker's metrics are stored in, by node and worker
+METRICS_KEY = "metrics:stream:{}:{}"
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Metric(NamedTuple):
+    type: str
+    help: str
+    buckets: Tuple[float, ...] = ()
+
+
+METRICS: Dict[str, Metric] = {
+    "bytes_sent_total": Metric("counter", "Bytes sent to Icecast"),
+    "bytes_per_second": Metric("gauge", "Send rate over the last flush interval"),
+    "tracks_total": Metric("counter", "Tracks streamed"),
+    "skips_total": Metric("counter", "Tracks skipped"),
+    "reconnects_total": Metric("counter", "Icecast source reconnects"),
+    "send_seconds": Metric("histogram", "Time spent in send", LATENCY_BUCKETS),
+    "sync_seconds": Metric("histogram", "Time spent in sync", LATENCY_BUCKETS),
+    "ffmpeg_startup_seconds": Metric(
+        "histogram", "Time until ffmpeg produced its first byte", LATENCY_BUCKETS
+    ),
+    "track_gap_seconds": Metric(
+        "histogram", "Time between the end of one track and the next", LATENCY_BUCKETS
+    ),
+    "skip_latency_seconds": Metric(
+        "histogram", "Time from a skip request to the track stopping", LATENCY_BUCKETS
+    ),
+}
+
+CACHE_METRICS = {
+    "radio_metadata_cache_hits_total": "Tag reads answered by the metadata cache",
+    "radio_metadata_cache_misses_total": "Tag reads that had to open the file",
+}
+
+# gauges of the sampled Icecast status: name, status field, help
+ICECAST_METRICS = (
+    ("radio_icecast_mount_up", "online", "Whether the mount has a source"),
+    ("radio_icecast_listeners", "listeners", "Listeners of the mount"),
+)
+
+
+class StreamMetrics:
+    """
+    Collects instrumentation for a single stream worker.
+    Values are accumulated in memory and flushed to Redis from a background
+    thread, so the send loop never waits on the network for them.
+    Each flush renews the expiry of the worker's hash, so the metrics of
+    workers that are gone stop being exported.
+
+    :param worker: name of the worker, used as a label
+    :param node: name of the stream node, used as a label (default: hostname)
+    :param interval: time between flushes, in seconds
+    :param ttl: time the metrics are kept after the last flush, in seconds
+    """
+
+    def __init__(
+        self,
+        worker: str,
+        node: Optional[str] = None,
+        interval: float = 5.0,
+        ttl: float = 60.0,
+    ):
+        self.worker = worker
+        # nodes streaming the same rendition must not add to each other's values
+        self.node = node or socket.gethostname()
+        self.interval = interval
+        self.ttl = ttl
+        self.counters: Dict[str, float] = defaultdict(float)
+        self.gauges: Dict[str, float] = {}
+        self.last_flush = time.monotonic()
+        self.bytes_since_flush = 0
+        self.lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1) -> None:
+        with self.lock:
+            self.counters[name] += value
+
+    def observe(self, name: str, value: float) -> None:
+        with self.lock:
+            for bucket in METRICS[name].buckets:
+                if value <= bucket:
+                    self.counters[f"{name}_bucket:{bucket}"] += 1
+            self.counters[f"{name}_bucket:+Inf"] += 1
+            self.counters[f"{name}_sum"] += value
+            self.counters[f"{name}_count"] += 1
+
+    def sent(self, size: int) -> None:
+        with self.lock:
+            self.counters["bytes_sent_total"] += size
+            self.bytes_since_flush += size
+
+    def flush(self) -> None:
+        """
+        Writes the values accumulated since the last flush to Redis
+        """
+        now = time.monotonic()
+        with self.lock:
+            counters, self.counters = self.counters, defaultdict(float)
+            sent, self.bytes_since_flush = self.bytes_since_flush, 0
+        self.gauges["bytes_per_second"] = sent / max(now - self.last_flush, 1e-6)
+        self.last_flush = now
+        key = METRICS_KEY.format(self.node, self.worker)
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            for field, value in counters.items():
+                pipe.hincrbyfloat(key, field, value)
+            for field, value in self.gauges.items():
+                pipe.hset(key, field, value)
+            pipe.expire(key, int(self.ttl))
+            pipe.execute()
+        except Exception:
+            # metrics are best effort, keep the counts for the next flush
+            with self.lock:
+                for field, value in counters.items():
+                    self.counters[field] += value
+
+    def run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def start(self) -> None:
+        threading.Thread(target=self.run, daemon=True).start()
+
+
+def parse_field(field: str) -> Tuple[str, float]:
+    """
+    Splits a stored field into its metric name and bucket bound (if any)
+    """
+    name, _, bucket = field.partition(":")
+    return name, float(bucket) if bucket else 0.0
+
+
+def render_metrics() -> str:
+    """
+    Renders the metrics of every stream worker in the Prometheus text format
+
+    :return: metrics, ready to be scraped
+    """
+    samples: Dict[str, List[Tuple[str, float, str]]] = defaultdict(list)
+    for key in sorted(redis_client.scan_iter(match=METRICS_KEY.format("*", "*"))):
+        node, worker = key.decode().split(":", 2)[-1].rsplit(":", 1)
+        for field, value in redis_client.hgetall(key).items():
+            name, bucket = parse_field(field.decode())
+            labels = f'node="{node}",worker="{worker}"'
+            if name.endswith("_bucket"):
+                le = "+Inf" if bucket == float("inf") else f"{bucket:g}"
+                labels += f',le="{le}"'
+            base = name if name in METRICS else name.rsplit("_", 1)[0]
+            sample = f"radio_stream_{name}{{{labels}}} {float(value)}"
+            samples[base].append((name, bucket, sample))
+    lines = []
+    for name, metric in METRICS.items():
+        if name not in samples:
+            continue
+        lines.append(f"# HELP radio_stream_{name} {metric.help}")
+        lines.append(f"# TYPE radio_stream_{name} {metric.type}")
+        lines.extend(sample for _, _, sample in sorted(samples[name]))
+    status = get_cached_status()
+    if status:
+        for name, field, help in ICECAST_METRICS:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} gauge")
+            for mount, values in sorted(status["mounts"].items()):
+                lines.append(f'{name}{{mount="{mount}"}} {float(values[field])}')
+    for name, value in get_cache_counters().items():
+        name = f"radio_metadata_cache_{name}_total"
+        lines.append(f"# HELP {name} {CACHE_METRICS[name]}")
+        lines.append(f"# TYPE {name} counter")
+        lines.append(f"{name} {float(value)}")
+    return "\n".join(lines) + "\n"
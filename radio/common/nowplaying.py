@@ -0,0 +1,263 @@
+import json
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any
+from typing import Dict
+from typing import Optional
+from typing import Set
+
+import arrow
+from pony.orm import db_session
+from pony.orm import desc
+from pony.orm.core import Query
+
+from radio import app
+from radio import redis_client
+from radio.common.leader import dump_track
+from radio.common.leader import load_track
+from radio.common.queue import song_queue
+from radio.common.schemas import Track
+from radio.common.stats import get_library_stats
+from radio.common.utils import queued_songs
+from radio.database import Song
+
+# the track being streamed, as published by the scheduler
+CURRENT_KEY = "np:current"
+# the now playing document served by /np
+SNAPSHOT_KEY = "np:snapshot"
+# seconds both are kept past the end of the track, in case the stream stops
+SNAPSHOT_GRACE = 30
+# listener count last published
+LISTENERS_KEY = "np:listeners"
+# channel the changed fields of the snapshot are published on
+UPDATES_CHANNEL = "np:updates"
+
+
+@dataclass
+class SongTimes:
+    now: arrow.arrow.Arrow = arrow.now()
+    start = now
+    end = now
+    current = 0
+    length = 0
+
+    def set_from_song(self, song: Song):
+        self.set_times(arrow.get(song.lastplayed), song.length)
+
+    def set_from_track(self, track: Track):
+        self.set_times(arrow.get(track.started), track.length)
+
+    def set_times(self, start: arrow.arrow.Arrow, length: int):
+        self.now = arrow.now()
+        self.start = start
+        self.current = self.now - self.start
+        self.length = length
+        self.end = self.start.shift(seconds=self.length)
+
+
+@dataclass
+class DummySong:
+    length = 0
+    artist = ""
+    title = ""
+    id = ""
+
+
+def song_entry(song: Song, time: arrow.arrow.Arrow, requested: bool) -> dict:
+    return {
+        "artist": song.artist,
+        "title": song.title,
+        "time": time.isoformat(),
+        "timestamp": time.timestamp,
+        "requested": requested,
+        "id": str(song.id),
+    }
+
+
+@db_session
+def build_now_playing(track: Optional[Track] = None) -> Dict[str, Any]:
+    """
+    Builds the now playing document, without the parts that change every second
+
+    :param track: track being streamed, its start is taken as the start of playback.
+        If not given, the most recently played song is used instead.
+    :return: current song, queue, recently played songs and library totals
+    """
+    lastplayed_songs: Query = (
+        Song.select(lambda c: c.lastplayed).sort_by(desc(Song.lastplayed)).limit(6)
+    )
+
+    # used to calculate song timestamps
+    times = SongTimes()
+    if track and track.started:
+        current_song = track
+        times.set_from_track(track)
+        lastplayed_songs = [s for s in lastplayed_songs if s.id != track.id][:5]
+    elif lastplayed_songs:
+        # current playing song is the first lastplayed entry
+        current_song = lastplayed_songs[0]
+        times.set_from_song(current_song)
+        lastplayed_songs = lastplayed_songs[1:]
+    else:
+        current_song = DummySong()
+
+    time = times.end
+    queue = []
+    for entry, song in queued_songs(song_queue.entries(10)):
+        queue.append(song_entry(song, time, entry.requested))
+        time = time.shift(seconds=song.length)
+
+    time = times.start
+    lastplayed = []
+    for song in lastplayed_songs:
+        lastplayed.append(song_entry(song, time, False))
+        time = time.shift(seconds=-song.length)
+
+    stats = get_library_stats()
+    return {
+        "len": times.length,
+        "start_time": times.start.timestamp,
+        "end_time": times.end.timestamp,
+        "artist": current_song.artist,
+        "title": current_song.title,
+        "id": str(current_song.id),
+        "requested": False,
+        "queue": queue,
+        "lp": lastplayed,
+        "total_songs": stats.songs,
+        "total_plays": stats.plays,
+        "total_size": stats.size,
+    }
+
+
+def store_now_playing(snapshot: Dict[str, Any]) -> None:
+    """
+    Stores the snapshot, and publishes the fields that changed to push clients
+    """
+    ttl = max(snapshot["end_time"] - arrow.now().timestamp, 0) + SNAPSHOT_GRACE
+    pipe = redis_client.pipeline()
+    pipe.get(SNAPSHOT_KEY)
+    pipe.set(SNAPSHOT_KEY, json.dumps(snapshot), ex=ttl)
+    previous, _ = pipe.execute()
+    previous = json.loads(previous) if previous else {}
+    delta = {k: v for k, v in snapshot.items() if previous.get(k) != v}
+    if delta:
+        redis_client.publish(UPDATES_CHANNEL, json.dumps(delta))
+
+
+def publish_listeners(listeners: int) -> None:
+    """
+    Publishes the listener count to push clients, if it changed
+    """
+    previous = redis_client.getset(LISTENERS_KEY, listeners)
+    if previous is None or int(previous) != listeners:
+        redis_client.publish(UPDATES_CHANNEL, json.dumps({"listeners": listeners}))
+
+
+def set_now_playing(track: Track) -> None:
+    """
+    Records the track that just started streaming, and rebuilds the snapshot.
+    Called by the stream scheduler on every track change.
+
+    :param track: track being streamed, with the time it started
+    """
+    try:
+        ttl = track.length + SNAPSHOT_GRACE
+        redis_client.set(CURRENT_KEY, dump_track(track), ex=ttl)
+        store_now_playing(build_now_playing(track))
+    except Exception:
+        app.logger.warning("Could not update now playing", exc_info=True)
+
+
+def refresh_now_playing() -> None:
+    """
+    Rebuilds the snapshot after the queue changed, keeping the current track
+    """
+    try:
+        current = redis_client.get(CURRENT_KEY)
+        track = load_track(current.decode()) if current else None
+        store_now_playing(build_now_playing(track))
+    except Exception:
+        app.logger.warning("Could not update now playing", exc_info=True)
+
+
+def get_now_playing() -> Dict[str, Any]:
+    """
+    Returns the stored snapshot, only building it if there is none
+    (e.g. when the stream is not running)
+    """
+    try:
+        stored = redis_client.get(SNAPSHOT_KEY)
+    except Exception:
+        app.logger.warning("Could not read now playing", exc_info=True)
+        return build_now_playing()
+    if stored:
+        return json.loads(stored)
+    snapshot = build_now_playing()
+    try:
+        store_now_playing(snapshot)
+    except Exception:
+        app.logger.warning("Could not store now playing", exc_info=True)
+    return snapshot
+
+
+class NowPlayingBroadcaster:
+    """
+    Fans published now playing updates out to the push clients of this process,
+    so any number of clients share a single Redis subscription.
+    A client that falls behind is sent None and dropped, ending its stream.
+
+    :param backlog: updates kept for each client before it is dropped
+    """
+
+    def __init__(self, backlog: int = 16):
+        self.backlog = backlog
+        self.clients: Set[queue.Queue] = set()
+        self.lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+
+    def subscribe(self) -> queue.Queue:
+        """
+        :return: queue the updates (dicts of changed fields) are put on,
+            followed by None if the client fell behind
+        """
+        # room for the end marker
+        client: queue.Queue = queue.Queue(maxsize=self.backlog + 1)
+        with self.lock:
+            self.clients.add(client)
+            # started lazily, as each server process needs its own
+            if not self.thread or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.listen, daemon=True)
+                self.thread.start()
+        return client
+
+    def unsubscribe(self, client: queue.Queue) -> None:
+        with self.lock:
+            self.clients.discard(client)
+
+    def listen(self) -> None:
+        while True:
+            try:
+                pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(UPDATES_CHANNEL)
+                for message in pubsub.listen():
+                    self.broadcast(json.loads(message["data"]))
+            except Exception:
+                app.logger.exception("Now playing listener failed, retrying...")
+                time.sleep(1)
+
+    def broadcast(self, update: Dict[str, Any]) -> None:
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            if client.qsize() < self.backlog:
+                client.put_nowait(update)
+                continue
+            # the client missed updates, it gets the whole snapshot on reconnect
+            self.unsubscribe(client)
+            client.put_nowait(None)
+
+
+broadcaster = NowPlayingBroadcaster()
@@ -0,0 +1,304 @@
+from datetime import datetime
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
+from uuid import UUID
+
+from pony.orm import commit
+from pony.orm import count
+from pony.orm import db_session
+from pony.orm import flush
+
+from radio import app
+from radio import redis_client
+from radio.database import Queue
+from radio.database import Song
+
+
+class QueueEntry(NamedTuple):
+    id: int
+    song_id: UUID
+    requested: bool
+    added: datetime
+
+
+class QueueBackend:
+    """
+    Storage for the play queue. Entries are returned in play order.
+    """
+
+    def add(self, song_ids: Iterable[UUID], requested: bool = False) -> None:
+        """
+        Appends songs to the end of the queue
+
+        :param song_ids: IDs of the songs to queue
+        :param requested: whether the songs were requested by a user
+        """
+        raise NotImplementedError
+
+    def entries(self, num: Optional[int] = None) -> List[QueueEntry]:
+        """
+        :param num: maximum number of entries to return, or None for all
+        :return: entries at the front of the queue
+        """
+        raise NotImplementedError
+
+    def first(self) -> Optional[QueueEntry]:
+        entries = self.entries(1)
+        return entries[0] if entries else None
+
+    def get(self, entry_id: int) -> Optional[QueueEntry]:
+        raise NotImplementedError
+
+    def remove(self, entry_id: int) -> bool:
+        """
+        :return: False if the entry was not in the queue
+        """
+        raise NotImplementedError
+
+    def remove_song(self, song_id: UUID) -> None:
+        """
+        Removes every entry of the given song, e.g. when it is deleted
+        """
+        raise NotImplementedError
+
+    def find(self, song_id: UUID) -> Optional[QueueEntry]:
+        """
+        :return: the first entry of the given song, or None if it is not queued
+        """
+        raise NotImplementedError
+
+    def find_many(self, song_ids: Iterable[UUID]) -> Dict[UUID, QueueEntry]:
+        """
+        Looks up several songs at once, e.g. for a page of search results
+
+        :return: the first entry of each given song that is queued
+        """
+        entries = {song_id: self.find(song_id) for song_id in song_ids}
+        return {song_id: entry for song_id, entry in entries.items() if entry}
+
+    def counts(self) -> Tuple[int, int]:
+        """
+        :return: number of random and requested entries
+        """
+        raise NotImplementedError
+
+    def __len__(self) -> int:
+        return sum(self.counts())
+
+    def clear(self) -> None:
+        raise NotImplementedError
+
+
+class DatabaseQueue(QueueBackend):
+    """
+    Queue stored in the `Queue` table
+    """
+
+    @staticmethod
+    def entry(queue_entry: Queue) -> QueueEntry:
+        return QueueEntry(
+            id=queue_entry.id,
+            song_id=queue_entry.song.id,
+            requested=queue_entry.requested,
+            added=queue_entry.added,
+        )
+
+    @db_session
+    def add(self, song_ids: Iterable[UUID], requested: bool = False) -> None:
+        for song_id in song_ids:
+            Queue(song=Song[song_id], requested=requested)
+        commit()
+
+    @db_session
+    def entries(self, num: Optional[int] = None) -> List[QueueEntry]:
+        query = Queue.select().sort_by(Queue.id)
+        return [self.entry(entry) for entry in (query.limit(num) if num else query)]
+
+    @db_session
+    def get(self, entry_id: int) -> Optional[QueueEntry]:
+        queue_entry = Queue.get(id=entry_id)
+        return self.entry(queue_entry) if queue_entry else None
+
+    @db_session
+    def remove(self, entry_id: int) -> bool:
+        queue_entry = Queue.get(id=entry_id)
+        if not queue_entry:
+            return False
+        queue_entry.delete()
+        # aggregate queries do not see pending deletes
+        flush()
+        return True
+
+    @db_session
+    def remove_song(self, song_id: UUID) -> None:
+        for queue_entry in Queue.select(lambda q: q.song.id == song_id):
+            queue_entry.delete()
+        flush()
+
+    @db_session
+    def find(self, song_id: UUID) -> Optional[QueueEntry]:
+        queue_entry = (
+            Queue.select(lambda q: q.song.id == song_id).sort_by(Queue.id).first()
+        )
+        return self.entry(queue_entry) if queue_entry else None
+
+    @db_session
+    def find_many(self, song_ids: Iterable[UUID]) -> Dict[UUID, QueueEntry]:
+        song_ids = list(song_ids)
+        found: Dict[UUID, QueueEntry] = {}
+        query = Queue.select(lambda q: q.song.id in song_ids).sort_by(Queue.id)
+        for queue_entry in query:
+            found.setdefault(queue_entry.song.id, self.entry(queue_entry))
+        return found
+
+    @db_session
+    def counts(self) -> Tuple[int, int]:
+        requests = count(q for q in Queue if q.requested)
+        return count(q for q in Queue) - requests, requests
+
+    @db_session
+    def clear(self) -> None:
+        Queue.select().delete(bulk=True)
+
+
+class RedisQueue(QueueBackend):
+    """
+    Queue stored in Redis, so popping, length and "is this song queued" checks
+    never touch the database.
+
+    Entry IDs are ordered in a sorted set, each entry's fields are kept in a hash,
+    and every queued song has a sorted set of its entries.
+
+    :param prefix: prefix of every key used by the queue
+    """
+
+    def __init__(self, prefix: str = "queue"):
+        self.prefix = prefix
+        self.order_key = f"{prefix}:order"
+        self.counter_key = f"{prefix}:next_id"
+        self.requested_key = f"{prefix}:requested"
+
+    def entry_key(self, entry_id: int) -> str:
+        return f"{self.prefix}:entry:{entry_id}"
+
+    def song_key(self, song_id: UUID) -> str:
+        return f"{self.prefix}:song:{song_id}"
+
+    @staticmethod
+    def load(entry_id: int, fields: dict) -> Optional[QueueEntry]:
+        if not fields:
+            return None
+        return QueueEntry(
+            id=entry_id,
+            song_id=UUID(fields[b"song"].decode()),
+            requested=fields[b"requested"] == b"1",
+            added=datetime.utcfromtimestamp(float(fields[b"added"])),
+        )
+
+    def add(self, song_ids: Iterable[UUID], requested: bool = False) -> None:
+        for song_id in song_ids:
+            entry_id = redis_client.incr(self.counter_key)
+            self.insert(entry_id, song_id, requested, datetime.utcnow())
+
+    def insert(
+        self, entry_id: int, song_id: UUID, requested: bool, added: datetime
+    ) -> None:
+        fields = {
+            "song": str(song_id),
+            "requested": int(requested),
+            "added": (added - datetime(1970, 1, 1)).total_seconds(),
+        }
+        pipe = redis_client.pipeline()
+        pipe.hset(self.entry_key(entry_id), mapping=fields)
+        pipe.zadd(self.song_key(song_id), {entry_id: entry_id})
+        if requested:
+            pipe.sadd(self.requested_key, entry_id)
+        pipe.zadd(self.order_key, {entry_id: entry_id})
+        pipe.execute()
+
+    def entries(self, num: Optional[int] = None) -> List[QueueEntry]:
+        entry_ids = [
+            int(entry_id)
+            for entry_id in redis_client.zrange(self.order_key, 0, (num or 0) - 1)
+        ]
+        pipe = redis_client.pipeline(transaction=False)
+        for entry_id in entry_ids:
+            pipe.hgetall(self.entry_key(entry_id))
+        entries = [
+            self.load(entry_id, fields)
+            for entry_id, fields in zip(entry_ids, pipe.execute())
+        ]
+        return [entry for entry in entries if entry]
+
+    def get(self, entry_id: int) -> Optional[QueueEntry]:
+        return self.load(entry_id, redis_client.hgetall(self.entry_key(entry_id)))
+
+    def remove(self, entry_id: int) -> bool:
+        song = redis_client.hget(self.entry_key(entry_id), "song")
+        pipe = redis_client.pipeline()
+        pipe.zrem(self.order_key, entry_id)
+        pipe.delete(self.entry_key(entry_id))
+        pipe.srem(self.requested_key, entry_id)
+        if song:
+            pipe.zrem(self.song_key(song.decode()), entry_id)
+        return bool(pipe.execute()[0])
+
+    def remove_song(self, song_id: UUID) -> None:
+        for entry_id in redis_client.zrange(self.song_key(song_id), 0, -1):
+            self.remove(int(entry_id))
+
+    def find(self, song_id: UUID) -> Optional[QueueEntry]:
+        first = redis_client.zrange(self.song_key(song_id), 0, 0)
+        return self.get(int(first[0])) if first else None
+
+    def find_many(self, song_ids: Iterable[UUID]) -> Dict[UUID, QueueEntry]:
+        song_ids = list(song_ids)
+        pipe = redis_client.pipeline(transaction=False)
+        for song_id in song_ids:
+            pipe.zrange(self.song_key(song_id), 0, 0)
+        firsts = {
+            song_id: int(first[0])
+            for song_id, first in zip(song_ids, pipe.execute())
+            if first
+        }
+        for entry_id in firsts.values():
+            pipe.hgetall(self.entry_key(entry_id))
+        found = {}
+        for (song_id, entry_id), fields in zip(firsts.items(), pipe.execute()):
+            entry = self.load(entry_id, fields)
+            if entry:
+                found[song_id] = entry
+        return found
+
+    def counts(self) -> Tuple[int, int]:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.zcard(self.order_key)
+        pipe.scard(self.requested_key)
+        total, requests = pipe.execute()
+        return total - requests, requests
+
+    def clear(self) -> None:
+        keys = list(redis_client.scan_iter(match=f"{self.prefix}:*"))
+        if keys:
+            redis_client.delete(*keys)
+
+
+QUEUE_BACKENDS = {"database": DatabaseQueue, "redis": RedisQueue}
+
+
+def get_queue_backend(name: str) -> QueueBackend:
+    """
+    :param name: name of the backend, see `QUEUE_BACKENDS`
+    :return: queue backend with the given name
+    """
+    try:
+        return QUEUE_BACKENDS[name]()
+    except KeyError:
+        raise ValueError(f"Unknown queue backend: {name}") from None
+
+
+song_queue = get_queue_backend(app.config.get("QUEUE_BACKEND", "database"))
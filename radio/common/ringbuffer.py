@@ -0,0 +1,125 @@
+import multiprocessing
+from multiprocessing import shared_memory
+from typing import Union
+
+# indexes into the shared state array
+HEAD, TAIL, EOF, CLOSED = range(4)
+
+
+class RingBuffer:
+    """
+    Single-producer, single-consumer byte ring buffer backed by shared memory.
+    The producer and consumer may live in different processes.
+
+    Positions are monotonic byte counters, so `head - tail` is always the
+    number of unread bytes.
+
+    :param capacity: size of the buffer, in bytes
+    """
+
+    def __init__(self, capacity: int = 1024 * 1024):
+        self.capacity = capacity
+        self._shm = shared_memory.SharedMemory(create=True, size=capacity)
+        self._state = multiprocessing.Array("Q", 4, lock=False)
+        self._cond = multiprocessing.Condition()
+
+    def reset(self) -> None:
+        """
+        Empties the buffer for a new stream.
+        Must only be called while nothing is reading or writing.
+        """
+        with self._cond:
+            for i in range(len(self._state)):
+                self._state[i] = 0
+
+    def write(self, data: Union[bytes, bytearray, memoryview]) -> bool:
+        """
+        Writes all of `data`, blocking while the buffer is full
+
+        :param data: bytes to write
+        :return: False if the consumer closed the buffer, else True
+        """
+        view = memoryview(data)
+        buf = self._shm.buf
+        while view:
+            with self._cond:
+                while (
+                    self._state[HEAD] - self._state[TAIL] >= self.capacity
+                    and not self._state[CLOSED]
+                ):
+                    self._cond.wait(0.5)
+                if self._state[CLOSED]:
+                    return False
+                head = self._state[HEAD]
+                free = self.capacity - (head - self._state[TAIL])
+            size = min(len(view), free)
+            pos = head % self.capacity
+            first = min(size, self.capacity - pos)
+            buf[pos : pos + first] = view[:first]
+            buf[: size - first] = view[first:size]
+            with self._cond:
+                self._state[HEAD] = head + size
+                self._cond.notify_all()
+            view = view[size:]
+        return True
+
+    def readinto(self, out: Union[bytearray, memoryview]) -> int:
+        """
+        Reads up to `len(out)` bytes into `out`, blocking while the buffer is empty
+
+        :param out: buffer to read into
+        :return: number of bytes read, 0 once the stream has finished
+        """
+        view = memoryview(out)
+        buf = self._shm.buf
+        with self._cond:
+            while (
+                self._state[HEAD] == self._state[TAIL]
+                and not self._state[EOF]
+                and not self._state[CLOSED]
+            ):
+                self._cond.wait(0.5)
+            tail = self._state[TAIL]
+            available = self._state[HEAD] - tail
+        size = min(len(view), available)
+        pos = tail % self.capacity
+        first = min(size, self.capacity - pos)
+        view[:first] = buf[pos : pos + first]
+        view[first:size] = buf[: size - first]
+        with self._cond:
+            self._state[TAIL] = tail + size
+            self._cond.notify_all()
+        return size
+
+    def read(self, size: int) -> bytes:
+        """
+        Reads up to `size` bytes, blocking while the buffer is empty
+
+        :param size: maximum number of bytes to read
+        :return: bytes read, empty once the stream has finished
+        """
+        out = bytearray(size)
+        return bytes(out[: self.readinto(out)])
+
+    def finish(self) -> None:
+        """
+        Marks the end of the stream. The consumer drains what is left, then gets EOF.
+        """
+        with self._cond:
+            self._state[EOF] = 1
+            self._cond.notify_all()
+
+    def close(self) -> None:
+        """
+        Stops the stream early, waking up any blocked reader or writer
+        """
+        with self._cond:
+            self._state[CLOSED] = 1
+            self._cond.notify_all()
+
+    def unlink(self) -> None:
+        """
+        Frees the shared memory. Must only be called by the creating process.
+        """
+        self._shm.close()
+        self._shm.unlink()
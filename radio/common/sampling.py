@@ -0,0 +1,193 @@
+import random
+from array import array
+from typing import Any
+from typing import Dict
+from typing import Hashable
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+
+class SongIndex:
+    """
+    Compact index of song IDs and playcounts for weighted queue sampling.
+    Songs are weighted by `max_plays + 1 - playcount`, so songs that have been
+    played less are more likely to be picked.
+
+    Playcounts and active flags are kept in two Fenwick trees, so a song can be
+    added, removed or played in O(log n) and each sample is drawn in O(log n)
+    by descending both trees at once.
+    """
+
+    # share of empty slots left by removed songs that triggers a compaction
+    COMPACT_RATIO = 0.5
+
+    def __init__(self):
+        self.ids: List[Hashable] = []
+        self.positions: Dict[Hashable, int] = {}
+        self.playcounts = array("q")
+        self.plays_tree = array("q", [0])
+        self.active_tree = array("q", [0])
+        self.active = 0
+        self.max_plays = 0
+        # identifies the library state this index was built from
+        self.fingerprint: Optional[Tuple[Any, ...]] = None
+
+    def __len__(self) -> int:
+        return self.active
+
+    def __contains__(self, song_id: Hashable) -> bool:
+        return song_id in self.positions
+
+    def build(
+        self,
+        songs: Iterable[Tuple[Hashable, int]],
+        fingerprint: Optional[Tuple[Any, ...]] = None,
+    ) -> None:
+        """
+        Rebuilds the index from scratch in O(n)
+
+        :param songs: (id, playcount) pairs for every song
+        :param fingerprint: library state the songs were read from
+        """
+        self.ids = []
+        self.playcounts = array("q")
+        for song_id, playcount in songs:
+            self.ids.append(song_id)
+            self.playcounts.append(playcount)
+        self.positions = {song_id: i for i, song_id in enumerate(self.ids)}
+        self.active = len(self.ids)
+        self.max_plays = max(self.playcounts, default=0)
+        self.fingerprint = fingerprint
+        self._build_trees(len(self.ids) * 2)
+
+    def _build_trees(self, capacity: int) -> None:
+        capacity = max(capacity, 1)
+        size = len(self.ids)
+        self.plays_tree = array("q", [0]) * (capacity + 1)
+        self.active_tree = array("q", [0]) * (capacity + 1)
+        for i in range(size):
+            if self.ids[i] in self.positions:
+                self.plays_tree[i + 1] = self.playcounts[i]
+                self.active_tree[i + 1] = 1
+        # linear-time Fenwick construction: push each node into its parent
+        for node in range(1, capacity + 1):
+            parent = node + (node & -node)
+            if parent <= capacity:
+                self.plays_tree[parent] += self.plays_tree[node]
+                self.active_tree[parent] += self.active_tree[node]
+
+    def _update(self, position: int, plays: int, active: int) -> None:
+        node = position + 1
+        capacity = len(self.plays_tree) - 1
+        while node <= capacity:
+            self.plays_tree[node] += plays
+            self.active_tree[node] += active
+            node += node & -node
+
+    def add(self, song_id: Hashable, playcount: int = 0) -> None:
+        """
+        Adds a song to the index
+        """
+        if song_id in self.positions:
+            return
+        position = len(self.ids)
+        self.ids.append(song_id)
+        self.playcounts.append(playcount)
+        self.positions[song_id] = position
+        self.active += 1
+        self.max_plays = max(self.max_plays, playcount)
+        if position + 1 >= len(self.plays_tree):
+            self._build_trees(len(self.ids) * 2)
+        else:
+            self._update(position, playcount, 1)
+
+    def remove(self, song_id: Hashable) -> None:
+        """
+        Removes a song from the index. Its slot is left empty with no weight,
+        until enough slots are empty for the index to be compacted.
+        """
+        position = self.positions.pop(song_id, None)
+        if position is None:
+            return
+        self._update(position, -self.playcounts[position], -1)
+        self.playcounts[position] = 0
+        self.active -= 1
+        if len(self.ids) - self.active > len(self.ids) * self.COMPACT_RATIO:
+            self.compact()
+
+    def compact(self) -> None:
+        """
+        Rebuilds the index without the empty slots of removed songs
+        """
+        songs = sorted(self.positions.items(), key=lambda item: item[1])
+        self.build(
+            [(song_id, self.playcounts[position]) for song_id, position in songs],
+            self.fingerprint,
+        )
+
+    def playcount(self, song_id: Hashable) -> int:
+        position = self.positions.get(song_id)
+        return 0 if position is None else self.playcounts[position]
+
+    def increment(self, song_id: Hashable) -> None:
+        """
+        Records a play of the given song
+        """
+        position = self.positions.get(song_id)
+        if position is None:
+            return
+        self.playcounts[position] += 1
+        self.max_plays = max(self.max_plays, self.playcounts[position])
+        self._update(position, 1, 0)
+
+    def sample(self, num: int) -> List[Hashable]:
+        """
+        Samples songs (with replacement), weighted towards those played less
+
+        :param num: number of songs to sample
+        :return: sampled song IDs
+        """
+        if not self.active:
+            return []
+        weight = self.max_plays + 1
+        capacity = len(self.plays_tree) - 1
+        total = weight * self.active_tree_total() - self.plays_tree_total()
+        top = 1 << (capacity.bit_length() - 1)
+        samples = []
+        for _ in range(num):
+            remaining = random.random() * total
+            position = 0
+            step = top
+            while step:
+                node = position + step
+                if node <= capacity:
+                    node_weight = (
+                        weight * self.active_tree[node] - self.plays_tree[node]
+                    )
+                    if node_weight <= remaining:
+                        position = node
+                        remaining -= node_weight
+                step >>= 1
+            # guard against float rounding landing on an empty slot
+            position = min(position, len(self.ids) - 1)
+            while position > 0 and self.ids[position] not in self.positions:
+                position -= 1
+            while self.ids[position] not in self.positions:
+                position += 1
+            samples.append(self.ids[position])
+        return samples
+
+    def _prefix(self, tree: array, position: int) -> int:
+        total = 0
+        while position > 0:
+            total += tree[position]
+            position -= position & -position
+        return total
+
+    def active_tree_total(self) -> int:
+        return self._prefix(self.active_tree, len(self.active_tree) - 1)
+
+    def plays_tree_total(self) -> int:
+        return self._prefix(self.plays_tree, len(self.plays_tree) - 1)
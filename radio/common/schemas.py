@@ -1,5 +1,6 @@
 from dataclasses import dataclass
 from datetime import datetime
+from pathlib import Path
 from typing import Optional
 from uuid import UUID
 
@@ -36,6 +37,29 @@ class SongData:
     added: datetime
     meta: Optional[RequestStatus] = None
     size: int = 0
+    bitrate: Optional[int] = None
+    sample_rate: Optional[int] = None
+    channels: Optional[int] = None
+
+
+@dataclass
+class Track:
+    """A song handed from the scheduler to the stream workers"""
+
+    id: UUID
+    path: Path
+    artist: str
+    title: str
+    length: int
+    queue_id: Optional[int] = None
+    # time playback was scheduled to start
+    started: Optional[float] = None
+    # loudness levelling: gain in dB, and the audible section in seconds
+    gain: float = 0.0
+    start: float = 0.0
+    end: Optional[float] = None
+    # fencing token of the leader that scheduled the track
+    fence: int = 0
 
 
 class StrictSchema(Schema):
@@ -43,9 +67,28 @@ class StrictSchema(Schema):
         strict = True
 
 
+# Song fields listings can be sorted by, descending if prefixed with "-"
+SONG_SORT_FIELDS = [
+    "added",
+    "artist",
+    "title",
+    "length",
+    "playcount",
+    "lastplayed",
+    "size",
+    "bitrate",
+]
+
+
 class SongQuerySchema(StrictSchema):
     page = fields.Int(missing=1)
     query = fields.Str(missing=None, validate=validate.Length(min=2))
+    sort = fields.Str(
+        missing=None,
+        validate=validate.OneOf(
+            SONG_SORT_FIELDS + [f"-{field}" for field in SONG_SORT_FIELDS]
+        ),
+    )
     limit = fields.Int(
         missing=app.config.get("SONGS_PER_PAGE", 50),
         validate=lambda a: 0 < a <= app.config.get("SONGS_PER_PAGE", 50),
@@ -0,0 +1,106 @@
+from pathlib import Path
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+
+from pony.orm import count
+from pony.orm import db_session
+from pony.orm import select
+
+from radio import app
+from radio import redis_client
+from radio.database import Song
+
+# Redis hash holding the library totals
+STATS_KEY = "library:stats"
+STATS_FIELDS = ("songs", "plays", "size")
+
+
+class LibraryStats(NamedTuple):
+    songs: int
+    plays: int
+    size: int
+
+
+def update_stats(songs: int = 0, plays: int = 0, size: Optional[int] = 0) -> None:
+    """
+    Adjusts the stored totals. Updates are best effort, and a change of unknown
+    size drops the totals so they are recounted on their next read.
+
+    :param songs: change in the number of songs
+    :param plays: change in the total playcount
+    :param size: change in the size of the library, in bytes (None if unknown)
+    """
+    try:
+        if size is None:
+            redis_client.delete(STATS_KEY)
+            return
+        pipe = redis_client.pipeline()
+        for field, value in zip(STATS_FIELDS, (songs, plays, size)):
+            if value:
+                pipe.hincrby(STATS_KEY, field, value)
+        pipe.execute()
+    except Exception:
+        app.logger.warning("Could not update library stats", exc_info=True)
+
+
+def songs_added(sizes: List[Optional[int]]) -> None:
+    size = None if None in sizes else sum(sizes)
+    update_stats(songs=len(sizes), size=size)
+
+
+def song_added(size: Optional[int]) -> None:
+    songs_added([size])
+
+
+def song_removed(playcount: int, size: Optional[int]) -> None:
+    update_stats(songs=-1, plays=-playcount, size=None if size is None else -size)
+
+
+def song_resized(old_size: Optional[int], new_size: Optional[int]) -> None:
+    if old_size is None or new_size is None:
+        update_stats(size=None)
+    else:
+        update_stats(size=new_size - old_size)
+
+
+def song_played() -> None:
+    update_stats(plays=1)
+
+
+@db_session
+def count_stats(path: Path) -> LibraryStats:
+    """
+    Counts the library totals from scratch
+    """
+    return LibraryStats(
+        songs=count(s for s in Song),
+        plays=select(s.playcount for s in Song).sum(),
+        size=sum(f.stat().st_size for f in path.glob("*.ogg")),
+    )
+
+
+def get_library_stats(path: Path = app.config["PATH_MUSIC"]) -> LibraryStats:
+    """
+    Returns the library totals, recounting them only if they are not stored yet
+
+    :param path: music directory
+    :return: number of songs, total playcount and size of the library in bytes
+    """
+    try:
+        stored = redis_client.hmget(STATS_KEY, STATS_FIELDS)
+    except Exception:
+        app.logger.warning("Could not read library stats", exc_info=True)
+        return count_stats(path)
+    if all(value is not None for value in stored):
+        return LibraryStats(*(int(value) for value in stored))
+    stats = count_stats(path)
+    try:
+        pipe = redis_client.pipeline()
+        pipe.hset(STATS_KEY, mapping=stats._asdict())
+        # recount daily, in case an update was lost
+        pipe.expire(STATS_KEY, app.config.get("LIBRARY_STATS_TTL", 86400))
+        pipe.execute()
+    except Exception:
+        app.logger.warning("Could not store library stats", exc_info=True)
+    return stats
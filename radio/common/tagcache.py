@@ -0,0 +1,99 @@
+import json
+from pathlib import Path
+from typing import Any
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+
+from radio import app
+from radio import redis_client
+
+# cached tags of a file, keyed by its path
+CACHE_KEY = "metadata:{}"
+# Redis hash counting cache lookups and misses, hits are the difference
+COUNTERS_KEY = "metadata:cache:stats"
+# tags that are cached, the path is added back on read
+CACHED_FIELDS = ("title", "artist", "length")
+
+
+def file_stamp(path: Path) -> Optional[Tuple[int, int]]:
+    """
+    :return: size and mtime (in ns) of a file, which change whenever it is rewritten
+    """
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def count_miss() -> None:
+    """
+    Counts a miss for a file whose tags could not be cached
+    """
+    try:
+        redis_client.hincrby(COUNTERS_KEY, "misses", 1)
+    except Exception:
+        pass
+
+
+def get_cached_metadata(path: Path) -> Optional[Dict[str, Any]]:
+    """
+    Returns a file's cached tags, if the file is unchanged since they were read.
+    The lookup is counted in the same round trip, the miss once the tags are
+    cached (see `cache_metadata`).
+
+    :param path: music file
+    :return: tags as returned by `get_metadata`, or None if not cached
+    """
+    stamp = file_stamp(path)
+    if not stamp:
+        return None
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.get(CACHE_KEY.format(path.resolve()))
+        pipe.hincrby(COUNTERS_KEY, "lookups", 1)
+        cached, _ = pipe.execute()
+    except Exception:
+        app.logger.warning("Could not read metadata cache", exc_info=True)
+        return None
+    entry = json.loads(cached) if cached else None
+    if not entry or (entry["size"], entry["mtime"]) != stamp:
+        return None
+    return {"path": path, **{field: entry[field] for field in CACHED_FIELDS}}
+
+
+def cache_metadata(path: Path, meta: Dict[str, Any]) -> None:
+    """
+    Caches a file's tags after a miss, tied to its current size and mtime
+
+    :param path: music file
+    :param meta: tags returned by `get_metadata`
+    """
+    stamp = file_stamp(path)
+    if not stamp:
+        count_miss()
+        return
+    entry = {"size": stamp[0], "mtime": stamp[1]}
+    entry.update((field, meta[field]) for field in CACHED_FIELDS)
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.set(
+            CACHE_KEY.format(path.resolve()),
+            json.dumps(entry),
+            ex=app.config.get("METADATA_CACHE_TTL", 604800),
+        )
+        pipe.hincrby(COUNTERS_KEY, "misses", 1)
+        pipe.execute()
+    except Exception:
+        app.logger.warning("Could not store metadata cache", exc_info=True)
+
+
+def get_cache_counters() -> Dict[str, int]:
+    """
+    :return: number of cache hits and misses so far
+    """
+    stored = redis_client.hmget(COUNTERS_KEY, "lookups", "misses")
+    lookups, misses = (int(value or 0) for value in stored)
+    # misses of files that vanished before their lookup are counted too
+    return {"hits": max(lookups - misses, 0), "misses": misses}
@@ -0,0 +1,412 @@
+import hashlib
+import os
+import select
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterable
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Set
+from uuid import UUID
+
+from radio import app
+from radio.common.schemas import Track
+
+
+class Rendition(NamedTuple):
+    """An encoding of the stream, served on its own Icecast mount"""
+
+    name: str
+    codec: str
+    mount: str
+    bitrate: Optional[int] = None
+
+    @property
+    def is_mp3(self) -> bool:
+        return self.codec == "mp3"
+
+    @property
+    def passthrough(self) -> bool:
+        """
+        :returns: True if the stored Ogg Vorbis file is sent as is
+        """
+        return self.codec == "vorbis"
+
+    def encoder_args(self) -> List[str]:
+        """
+        :returns: ffmpeg output arguments used to produce this rendition
+        """
+        if self.codec == "mp3":
+            return ["-c:a", "libmp3lame", "-b:a", f"{self.bitrate}k", "-f", "mp3"]
+        if self.codec == "opus":
+            return ["-c:a", "libopus", "-b:a", f"{self.bitrate}k", "-f", "ogg"]
+        return ["-c:a", "copy", "-f", "ogg"]
+
+
+def get_renditions(config: dict) -> List[Rendition]:
+    """
+    Gets every rendition that should be streamed.
+    The stored Ogg Vorbis file is always streamed, MP3 if transcoding is enabled,
+    followed by any extra renditions from `ICECAST_EXTRA_RENDITIONS`.
+
+    :param config: app config
+    :return: list of renditions to stream
+    """
+    mount = config["ICECAST_MOUNT"]
+    renditions = [Rendition("OGG", "vorbis", f"{mount}.ogg")]
+    if config["ICECAST_TRANSCODE"]:
+        renditions.append(
+            Rendition("MP3", "mp3", f"{mount}.mp3", config["TRANSCODE_BITRATE"])
+        )
+    for extra in config.get("ICECAST_EXTRA_RENDITIONS", []):
+        codec, bitrate = extra["codec"], extra["bitrate"]
+        ext = "mp3" if codec == "mp3" else "opus"
+        name = f"{codec.upper()}-{bitrate}"
+        renditions.append(Rendition(name, codec, f"{mount}-{bitrate}.{ext}", bitrate))
+    return renditions
+
+
+def trim_args(track: Optional[Track]) -> List[str]:
+    """
+    :returns: ffmpeg input options skipping the track's leading and trailing silence
+    """
+    args = []
+    if track and track.start > 0:
+        args += ["-ss", f"{track.start:.3f}"]
+    if track and track.end and track.end < track.length:
+        args += ["-to", f"{track.end:.3f}"]
+    return args
+
+
+def gain_args(track: Optional[Track]) -> List[str]:
+    """
+    :returns: ffmpeg output options applying the track's stored loudness gain
+    """
+    if track and track.gain:
+        return ["-af", f"volume={track.gain:.2f}dB"]
+    return []
+
+
+def transcode_command(
+    config: dict,
+    rendition: Rendition,
+    src: str = "-",
+    dst: str = "-",
+    track: Optional[Track] = None,
+) -> List[str]:
+    """
+    Builds the ffmpeg command used to transcode a song to the given rendition
+
+    :param config: app config
+    :param rendition: rendition to transcode to
+    :param src: input file (stdin by default)
+    :param dst: output file (stdout by default)
+    :param track: track being transcoded, to apply its stored levelling
+    :return: ffmpeg command line
+    """
+    # stream copies are trimmed, but cannot be filtered
+    levelling = [] if rendition.passthrough else gain_args(track)
+    return [
+        str(config["PATH_FFMPEG_BINARY"]),
+        *trim_args(track),
+        "-i",
+        src,
+        "-vn",
+        *levelling,
+        *rendition.encoder_args(),
+        dst,
+    ]
+
+
+class TranscodeCache:
+    """
+    Size-bounded, LRU-evicted on-disk cache of transcoded MP3 renditions.
+    Files are shared between processes, so recency is tracked with mtimes.
+
+    :param path: directory to store cached renditions in
+    :param max_size: maximum total size of the cache, in bytes
+    :param rendition: MP3 rendition to cache
+    :param workers: number of background transcodes to run at once
+    """
+
+    def __init__(
+        self, path: Path, max_size: int, rendition: Rendition, workers: int = 2
+    ):
+        self.path = path
+        self.max_size = max_size
+        self.rendition = rendition
+        self.workers = workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pending: Set[UUID] = set()
+        self._lock = threading.Lock()
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, config: dict) -> Optional["TranscodeCache"]:
+        """
+        :returns: the configured cache, or None if caching is disabled
+        """
+        if not config["ICECAST_TRANSCODE"]:
+            return None
+        if not config.get("TRANSCODE_CACHE_ENABLED", False):
+            return None
+        mount = config["ICECAST_MOUNT"]
+        return cls(
+            path=Path(config["PATH_TRANSCODE_CACHE"]),
+            max_size=config.get("TRANSCODE_CACHE_SIZE", 2 * 1024 ** 3),
+            rendition=Rendition(
+                "MP3", "mp3", f"{mount}.mp3", config["TRANSCODE_BITRATE"]
+            ),
+            workers=config.get("TRANSCODE_CACHE_WORKERS", 2),
+        )
+
+    def key(self, track: Track) -> Path:
+        """
+        :returns: path of the cached rendition for the given track
+        """
+        name = f"{track.id}-{self.rendition.bitrate}k"
+        # levelling is baked into the rendition, so re-analysed or
+        # re-configured tracks get a new entry instead of the stale one
+        levelling = [*trim_args(track), *gain_args(track)]
+        if levelling:
+            digest = hashlib.sha1(" ".join(levelling).encode()).hexdigest()
+            name += f"-{digest[:12]}"
+        return self.path / f"{name}.mp3"
+
+    def get(self, track: Track) -> Optional[Path]:
+        """
+        Looks up a cached rendition, marking it as recently used
+
+        :param track: track to look up
+        :return: path to the cached rendition, or None on a miss
+        """
+        cached = self.key(track)
+        try:
+            os.utime(cached)
+        except FileNotFoundError:
+            return None
+        return cached
+
+    def fill(self, track: Track) -> Optional[Path]:
+        """
+        Transcodes the given track into the cache, if not already cached.
+        Output is written to a temporary file and renamed into place,
+        so readers never see a partial rendition.
+
+        :param track: track to transcode
+        :return: path to the cached rendition, or None if transcoding failed
+        """
+        cached = self.get(track)
+        if cached:
+            return cached
+        cached = self.key(track)
+        tmp = cached.with_name(f".{cached.name}.{os.getpid()}.tmp")
+        retcode = subprocess.call(
+            transcode_command(
+                app.config, self.rendition, str(track.path), str(tmp), track
+            ),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        if retcode != 0:
+            app.logger.warning(f"Could not cache transcode of {track.path}")
+            tmp.unlink(missing_ok=True)
+            return None
+        tmp.replace(cached)
+        self.evict()
+        return cached
+
+    def evict(self) -> None:
+        """
+        Removes the least recently used renditions until the cache fits its size limit
+        """
+        entries = []
+        for file in self.path.glob("*.mp3"):
+            try:
+                stat = file.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, file))
+        total = sum(size for _, size, _ in entries)
+        for _, size, file in sorted(entries):
+            if total <= self.max_size:
+                break
+            file.unlink(missing_ok=True)
+            total -= size
+
+    def prefetch(self, tracks: Iterable[Track]) -> None:
+        """
+        Fills the cache with the given tracks in the background
+
+        :param tracks: tracks that will be played soon
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        for track in tracks:
+            with self._lock:
+                if track.id in self._pending or self.key(track).exists():
+                    continue
+                self._pending.add(track.id)
+            self._executor.submit(self._fill_pending, track)
+
+    def _fill_pending(self, track: Track) -> None:
+        try:
+            self.fill(track)
+        finally:
+            with self._lock:
+                self._pending.discard(track.id)
+
+
+class PersistentTranscoder:
+    """
+    A single long-lived ffmpeg encoder for a mount, fed decoded audio track after track.
+    Each track only starts a lightweight decoder writing raw PCM into the encoder,
+    so the output is gapless and the encoder is never restarted or re-primed.
+
+    :param config: app config
+    :param rendition: rendition to encode
+    """
+
+    SAMPLE_FORMAT = ["-f", "s16le", "-ar", "44100", "-ac", "2"]
+
+    def __init__(self, config: dict, rendition: Rendition):
+        self.config = config
+        self.rendition = rendition
+        self.encoder: Optional[subprocess.Popen] = None
+        self.decoder: Optional[subprocess.Popen] = None
+        # the track being fed, and the thread copying it into the encoder
+        self.current: Optional[TranscoderFeed] = None
+        self.pumping: Optional[threading.Thread] = None
+
+    def ensure_running(self) -> None:
+        """
+        Starts the encoder, or restarts it if it has exited
+        """
+        if self.encoder and self.encoder.poll() is None:
+            return
+        # unbuffered, so select() on the output sees everything there is to read
+        self.encoder = subprocess.Popen(
+            [
+                str(self.config["PATH_FFMPEG_BINARY"]),
+                *self.SAMPLE_FORMAT,
+                "-i",
+                "-",
+                *self.rendition.encoder_args(),
+                "-",
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            bufsize=0,
+        )
+
+    def feed(self, track: Track) -> "TranscoderFeed":
+        """
+        Starts decoding the given track into the encoder.
+        The previous track stops being fed first, so no audio from it follows.
+
+        :param track: track to decode
+        :return: readable encoder output for the track
+        """
+        self.stop_feed()
+        if self.pumping:
+            self.drain(self.pumping)
+        self.ensure_running()
+        self.decoder = subprocess.Popen(
+            [
+                str(self.config["PATH_FFMPEG_BINARY"]),
+                *trim_args(track),
+                "-i",
+                str(track.path),
+                "-vn",
+                *gain_args(track),
+                *self.SAMPLE_FORMAT,
+                "-",
+            ],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        feed = TranscoderFeed(self)
+        self.current = feed
+        self.pumping = threading.Thread(
+            target=self.pump, args=(self.decoder, feed), daemon=True
+        )
+        self.pumping.start()
+        return feed
+
+    def pump(self, decoder: subprocess.Popen, feed: "TranscoderFeed") -> None:
+        """
+        Copies decoded audio into the encoder until the decoder finishes or is stopped
+        """
+        buffer = bytearray(64 * 1024)
+        view = memoryview(buffer)
+        encoder = self.encoder
+        try:
+            while not feed.stopped.is_set():
+                size = decoder.stdout.readinto(buffer)
+                if not size or feed.stopped.is_set():
+                    break
+                # the encoder's input is unbuffered, so writes may be partial
+                written = 0
+                while written < size:
+                    written += encoder.stdin.write(view[written:size])
+        except (BrokenPipeError, ValueError):
+            app.logger.warning("Persistent transcoder exited, it will be restarted")
+        finally:
+            decoder.stdout.close()
+            decoder.wait()
+            feed.done.set()
+
+    def drain(self, pumping: threading.Thread) -> None:
+        """
+        Discards encoder output until the given pump has exited.
+        A stopped pump may still be blocked writing into a full encoder.
+        """
+        while pumping.is_alive():
+            output = self.encoder.stdout if self.encoder else None
+            if output and select.select([output], [], [], 0.05)[0]:
+                if not output.read(64 * 1024):
+                    output = None
+            pumping.join(0 if output else 0.05)
+
+    def stop_feed(self) -> None:
+        """
+        Stops feeding the current track (e.g. when it is skipped)
+        """
+        if self.current:
+            self.current.stopped.set()
+        if self.decoder and self.decoder.poll() is None:
+            self.decoder.terminate()
+
+
+class TranscoderFeed:
+    """
+    Encoder output for a single track fed into a `PersistentTranscoder`.
+    Reading ends once the track has been fully fed and the encoder has nothing
+    more to give; anything it is still holding opens the next track.
+    """
+
+    def __init__(self, transcoder: PersistentTranscoder):
+        self.transcoder = transcoder
+        # set once nothing more of the track will be fed
+        self.done = threading.Event()
+        # set when the track is skipped, the pump stops writing as soon as it sees it
+        self.stopped = threading.Event()
+
+    def readinto(self, buffer: bytearray) -> int:
+        output = self.transcoder.encoder.stdout
+        while True:
+            timeout = 0.05 if self.done.is_set() else 0.5
+            ready, _, _ = select.select([output], [], [], timeout)
+            if ready:
+                return output.readinto(buffer)
+            if self.done.is_set():
+                return 0
+
+    def close(self) -> None:
+        self.transcoder.stop_feed()
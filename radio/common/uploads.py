@@ -0,0 +1,227 @@
+import hashlib
+import time
+import uuid
+from pathlib import Path
+from typing import IO
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+
+import filetype
+
+from radio import app
+from radio import redis_client
+from radio.common.utils import get_nonexistant_path
+
+SESSION_KEY = "upload:session:{}"
+# bytes filetype needs to recognise a file
+SNIFF_SIZE = 262
+COPY_SIZE = 256 * 1024
+# seconds a chunk may take to arrive before another request may write instead
+LOCK_TIMEOUT = 300
+
+# hashers of the sessions this process has received chunks for, with the offset
+# each has hashed up to, so chunks are hashed as they arrive instead of
+# re-reading the file once it is complete
+hashers: Dict[str, Tuple[int, "hashlib._Hash"]] = {}
+
+
+class UploadError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class UploadSession:
+    """
+    A resumable upload, written to PATH_ENCODE one chunk at a time.
+    Its state is kept in Redis, so chunks may be sent to any API worker.
+
+    :param session_id: ID of the session
+    :param fields: the session's stored state
+    """
+
+    def __init__(self, session_id: str, fields: Dict[str, str]):
+        self.id = session_id
+        self.filename = fields["filename"]
+        self.size = int(fields["size"])
+        self.offset = int(fields["offset"])
+        self.path = Path(fields["path"])
+        self.priority = int(fields["priority"])
+        self.source_hash: Optional[str] = None
+
+    @property
+    def key(self) -> str:
+        return SESSION_KEY.format(self.id)
+
+    @property
+    def complete(self) -> bool:
+        return self.offset >= self.size
+
+    @classmethod
+    def create(cls, filename: str, size: int, priority: int) -> "UploadSession":
+        """
+        Starts a new upload
+
+        :param filename: (secure) name of the file being uploaded
+        :param size: size of the whole file, in bytes
+        :param priority: priority of the encode job once the upload is complete
+        """
+        limit = app.config.get("FILE_SIZE_LIMIT")
+        if size <= 0:
+            raise UploadError(400, "File is empty")
+        if limit and size > limit:
+            raise UploadError(413, f"File is larger than the limit of {limit} bytes")
+        session_id = uuid.uuid4().hex
+        fields = {
+            "filename": filename,
+            "size": size,
+            "offset": 0,
+            "path": str(Path(app.config["PATH_ENCODE"], f"{session_id}.part")),
+            "priority": priority,
+            "created": time.time(),
+        }
+        pipe = redis_client.pipeline()
+        pipe.hset(SESSION_KEY.format(session_id), mapping=fields)
+        pipe.expire(SESSION_KEY.format(session_id), cls.ttl())
+        pipe.execute()
+        Path(fields["path"]).touch()
+        return cls(session_id, {k: str(v) for k, v in fields.items()})
+
+    @classmethod
+    def get(cls, session_id: str) -> Optional["UploadSession"]:
+        fields = redis_client.hgetall(SESSION_KEY.format(session_id))
+        if not fields:
+            return None
+        return cls(session_id, {k.decode(): v.decode() for k, v in fields.items()})
+
+    @staticmethod
+    def ttl() -> int:
+        return app.config.get("UPLOAD_SESSION_TTL", 86400)
+
+    def hasher(self) -> "hashlib._Hash":
+        """
+        Returns the hasher of the bytes received so far.
+        If chunks went to another process since this one last saw the session,
+        the file is read back once.
+        """
+        offset, hasher = hashers.get(self.id, (None, None))
+        if hasher is None or offset != self.offset:
+            hasher = hashlib.sha256()
+            with open(self.path, "rb") as f:
+                remaining = self.offset
+                while remaining > 0:
+                    block = f.read(min(COPY_SIZE, remaining))
+                    if not block:
+                        break
+                    hasher.update(block)
+                    remaining -= len(block)
+            hashers[self.id] = (self.offset, hasher)
+        return hasher
+
+    def write(self, offset: int, stream: IO[bytes]) -> Optional[Path]:
+        """
+        Appends a chunk to the upload, hashing it as it is written
+
+        :param offset: position of the chunk in the file, must match the bytes received
+        :param stream: the chunk's data
+        :return: path of the uploaded file once it is complete, see `finish`
+        """
+        # only one request may write to the session at a time
+        lock = f"{self.key}:lock"
+        if not redis_client.set(lock, offset, nx=True, ex=LOCK_TIMEOUT):
+            raise UploadError(409, "Another chunk is being written")
+        try:
+            # another request may have written to (or finished) the session
+            fields = redis_client.hgetall(self.key)
+            if not fields:
+                raise UploadError(404, "Upload session does not exist")
+            self.offset = int(fields[b"offset"])
+            if offset != self.offset:
+                raise UploadError(409, f"Expected a chunk at offset {self.offset}")
+            self.append(stream)
+            if self.complete:
+                return self.finish()
+        except UploadError as e:
+            if e.status == 400:
+                self.discard()
+            raise
+        finally:
+            redis_client.delete(lock)
+        return None
+
+    def append(self, stream: IO[bytes]) -> None:
+        hasher = self.hasher()
+        try:
+            with open(self.path, "r+b") as f:
+                # drop anything left over from an interrupted chunk
+                f.seek(self.offset)
+                f.truncate()
+                while True:
+                    block = stream.read(COPY_SIZE)
+                    if not block:
+                        break
+                    if self.offset + len(block) > self.size:
+                        raise UploadError(413, "Upload is larger than its stated size")
+                    if self.offset < SNIFF_SIZE:
+                        self.sniff(f, block)
+                    f.write(block)
+                    hasher.update(block)
+                    self.offset += len(block)
+                    hashers[self.id] = (self.offset, hasher)
+        except Exception:
+            # the hasher no longer matches the file, it is rebuilt next time
+            hashers.pop(self.id, None)
+            raise
+        finally:
+            # a partially received chunk is kept, the client resumes after it
+            pipe = redis_client.pipeline()
+            pipe.hset(self.key, "offset", self.offset)
+            pipe.expire(self.key, self.ttl())
+            pipe.execute()
+
+    def sniff(self, f: IO[bytes], block: bytes) -> None:
+        """
+        Checks the file is audio as soon as enough of it has arrived
+        """
+        f.flush()
+        head = self.path.read_bytes()[: self.offset] + block
+        if len(head) < SNIFF_SIZE and self.offset + len(block) < self.size:
+            return
+        kind = filetype.guess(head[:SNIFF_SIZE])
+        if not kind or kind.mime.split("/")[0] != "audio":
+            raise UploadError(400, "File is not audio")
+
+    def finish(self) -> Path:
+        """
+        Moves the complete upload to its final name, ready to be encoded.
+        Its hash is kept in `source_hash`.
+
+        :return: path of the uploaded file
+        """
+        self.source_hash = self.hasher().hexdigest()
+        path = get_nonexistant_path(Path(app.config["PATH_ENCODE"], self.filename))
+        self.path.rename(path)
+        redis_client.delete(self.key)
+        hashers.pop(self.id, None)
+        return path
+
+    def discard(self) -> None:
+        self.path.unlink(missing_ok=True)
+        redis_client.delete(self.key)
+        hashers.pop(self.id, None)
+
+
+def remove_expired_uploads() -> int:
+    """
+    Removes the partial files of upload sessions that have expired
+
+    :return: number of files removed
+    """
+    removed = 0
+    for path in Path(app.config["PATH_ENCODE"]).glob("*.part"):
+        if not redis_client.exists(SESSION_KEY.format(path.stem)):
+            path.unlink(missing_ok=True)
+            removed += 1
+    return removed
@@ -1,43 +1,60 @@
+import concurrent.futures
+import hashlib
+import json
 import math
+import os
+import re
 import subprocess
-import urllib.request
 from datetime import datetime
 from enum import Enum
-from functools import lru_cache
 from functools import partial
 from pathlib import Path
-from random import choices
 from typing import Any
 from typing import Dict
+from typing import Iterator
 from typing import List
 from typing import NamedTuple
 from typing import Optional
+from typing import Set
+from typing import Tuple
 from typing import Union
-from urllib.error import URLError
 from uuid import UUID
 
 import arrow
 import marshmallow
 import mutagen
-import xmltodict
 from flask import Response
 from flask import jsonify
 from marshmallow import ValidationError
+from pony.orm import IntegrityError
+from pony.orm import TransactionIntegrityError
 from pony.orm import commit
 from pony.orm import count
 from pony.orm import db_session
 from pony.orm import max
+from pony.orm import rollback
 from pony.orm import select
-from pony.orm import sum as db_sum
+from pony.orm import sum
 from webargs import flaskparser
 from werkzeug.exceptions import HTTPException
 from werkzeug.http import HTTP_STATUS_CODES
 from werkzeug.utils import secure_filename
 
 from radio import app
+from radio.common.queue import QueueEntry
+from radio.common.queue import song_queue
+from radio.common.sampling import SongIndex
 from radio.common.schemas import RequestStatus
 from radio.common.schemas import SongData
-from radio.database import Queue
+from radio.common.schemas import Track
+from radio.common.stats import song_added
+from radio.common.stats import song_played
+from radio.common.stats import song_removed
+from radio.common.stats import song_resized
+from radio.common.stats import songs_added
+from radio.common.tagcache import cache_metadata
+from radio.common.tagcache import count_miss
+from radio.common.tagcache import get_cached_metadata
 from radio.database import Song
 
 register_blueprint_prefixed = partial(
@@ -81,19 +98,6 @@ def make_api_response(
     return response
 
 
-@lru_cache(maxsize=32)
-def get_folder_size(path: Path = Path()) -> int:
-    """
-    Calculate the total size of all files in the given path.
-    This is cached for performance concerns.
-    Only counts files with an extension.
-
-    :param path: path of folder to get size of
-    :return: the total size of all files in the given path
-    """
-    return sum(file.stat().st_size for file in path.rglob("*.*"))
-
-
 def allowed_file_extension(filename: Path) -> bool:
     """
     Check if the given filename is an allowed extension for upload
@@ -109,12 +113,15 @@ class EncodeError(Exception):
     pass
 
 
-def encode_file(input_filename: Path, remove_original: bool = False) -> Path:
+def encode_file(
+    input_filename: Path, remove_original: bool = False, threads: Optional[int] = None
+) -> Path:
     """
     Encodes a given file and moves it to the correct output directory
 
     :param Path input_filename: path of file to encode
     :param bool remove_original: remove original file after encoding
+    :param threads: number of threads ffmpeg may use, or None to let it decide
     :return: Full path to encoded file
     """
     output_path = get_nonexistant_path(
@@ -135,6 +142,7 @@ def encode_file(input_filename: Path, remove_original: bool = False) -> Path:
             "-q:a",
             str(app.config["SONG_QUALITY_LVL"]),
             "-vn",
+            *(["-threads", str(threads)] if threads else []),
             str(output_path),
         ]
     )
@@ -145,6 +153,249 @@ def encode_file(input_filename: Path, remove_original: bool = False) -> Path:
     return output_path
 
 
+def file_hash(filename: Path) -> str:
+    """
+    :param Path filename: file to hash
+    :return: SHA-256 of the file's contents, as hex
+    """
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(partial(f.read, 1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def audio_hash(filename: Path) -> Optional[str]:
+    """
+    Hashes a music file's decoded audio, so copies with different tags
+    (or containers) still match
+
+    :param Path filename: file to hash
+    :return: SHA-256 of the decoded audio, or None if it could not be decoded
+    """
+    try:
+        result = subprocess.run(
+            [
+                str(app.config["PATH_FFMPEG_BINARY"]),
+                "-v",
+                "error",
+                "-i",
+                str(filename),
+                "-map",
+                "0:a",
+                "-f",
+                "hash",
+                "-hash",
+                "sha256",
+                "-",
+            ],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+    except (OSError, subprocess.SubprocessError):
+        app.logger.exception(f"Could not hash audio of {filename}")
+        return None
+    match = re.match(rb"SHA256=([0-9a-f]{64})", result.stdout)
+    if result.returncode != 0 or not match:
+        return None
+    return match.group(1).decode()
+
+
+def hash_song(
+    filename: Path, source_hash: Optional[str] = None, audio: bool = True
+) -> Dict[str, str]:
+    """
+    Computes the hashes duplicates are detected with.
+    The audio hash needs a full decode, so is only computed if DEDUPE_AUDIO_HASH is set.
+
+    :param Path filename: file to hash
+    :param source_hash: hash of the file, if already computed while receiving it
+    :param audio: whether to compute the audio hash, uploads leave it to the encoder
+    :return: dict of Song hash attributes
+    """
+    hashes = {"source_hash": source_hash or file_hash(filename)}
+    if audio and app.config.get("DEDUPE_AUDIO_HASH", False):
+        decoded = audio_hash(filename)
+        if decoded:
+            hashes["audio_hash"] = decoded
+    return hashes
+
+
+@db_session
+def find_duplicate(hashes: Dict[str, str]) -> Optional[Song]:
+    """
+    :param hashes: hashes returned by `hash_song`
+    :return: the song with the same file or audio, if any
+    """
+    for attr, value in hashes.items():
+        song = Song.select(**{attr: value}).first()
+        if song:
+            return song
+    return None
+
+
+class Loudness(NamedTuple):
+    loudness: float
+    true_peak: float
+    start_offset: float
+    end_offset: float
+
+
+def analyse_loudness(filename: Path, length: float) -> Optional[Loudness]:
+    """
+    Measures the EBU R128 integrated loudness and true peak of a music file,
+    along with where the audio starts and ends once silence is trimmed.
+
+    :param Path filename: file to analyse
+    :param length: length of the file, in seconds
+    :return: loudness details, or None if the file could not be analysed
+    """
+    try:
+        result = subprocess.run(
+            [
+                str(app.config["PATH_FFMPEG_BINARY"]),
+                "-nostats",
+                "-i",
+                str(filename),
+                "-vn",
+                "-af",
+                "silencedetect=noise=-60dB:d=0.5,loudnorm=print_format=json",
+                "-f",
+                "null",
+                "-",
+            ],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+    except (OSError, subprocess.SubprocessError):
+        app.logger.exception(f"Could not analyse loudness of {filename}")
+        return None
+    output = result.stderr.decode(errors="replace")
+    stats = re.search(r"\{[^{}]*\"input_i\"[^{}]*\}", output)
+    if result.returncode != 0 or not stats:
+        app.logger.warning(f"Could not analyse loudness of {filename}")
+        return None
+    stats = json.loads(stats.group(0))
+    try:
+        loudness, true_peak = float(stats["input_i"]), float(stats["input_tp"])
+    except ValueError:
+        # digital silence reports -inf
+        return None
+    start_offset, end_offset = 0.0, length
+    starts = [float(x) for x in re.findall(r"silence_start: (-?[\d.]+)", output)]
+    ends = [float(x) for x in re.findall(r"silence_end: ([\d.]+)", output)]
+    if starts and starts[0] <= 0 and ends:
+        start_offset = ends[0]
+    # silence running to the end of the file has no silence_end
+    if starts and len(starts) > len(ends) and starts[-1] > start_offset:
+        end_offset = starts[-1]
+    return Loudness(loudness, true_peak, start_offset, end_offset)
+
+
+def loudness_gain(loudness: Optional[float], true_peak: Optional[float]) -> float:
+    """
+    Calculates the gain needed to bring a song to `LOUDNESS_TARGET`,
+    without pushing its true peak above -1 dBTP.
+
+    :param loudness: integrated loudness of the song, in LUFS
+    :param true_peak: true peak of the song, in dBTP
+    :return: gain to apply, in dB
+    """
+    if loudness is None or not app.config.get("LOUDNESS_NORMALISE", False):
+        return 0.0
+    gain = app.config.get("LOUDNESS_TARGET", -16.0) - loudness
+    if true_peak is not None:
+        gain = min(gain, -1.0 - true_peak)
+    return round(gain, 2)
+
+
+def write_replaygain_tags(filename: Path, loudness: Loudness) -> None:
+    """
+    Stores ReplayGain tags in a music file, so players can level songs
+    that are streamed without being re-encoded.
+
+    :param Path filename: file to tag
+    :param loudness: measured loudness of the file
+    """
+    try:
+        metadata = mutagen.File(filename, easy=True)
+        # ReplayGain 2.0 uses a -18 LUFS reference
+        metadata["replaygain_track_gain"] = f"{-18.0 - loudness.loudness:.2f} dB"
+        metadata["replaygain_track_peak"] = f"{10 ** (loudness.true_peak / 20):.6f}"
+        metadata.save()
+    except Exception:
+        app.logger.exception(f"Could not write ReplayGain tags to {filename}")
+
+
+# weighted sampling index, kept in step with the Songs table as it changes
+song_index = SongIndex()
+
+
+@db_session
+def library_fingerprint() -> Tuple[int, Optional[datetime], int]:
+    """
+    Cheap summary of the Songs table, used to notice changes made by other processes
+
+    :return: number of songs, when the newest was added and their total playcount
+    """
+    songs, newest, plays = select(
+        (count(s), max(s.added), sum(s.playcount)) for s in Song
+    ).first()
+    return songs, newest, plays or 0
+
+
+def update_fingerprint(
+    songs: int = 0, plays: int = 0, added: Optional[datetime] = None
+) -> None:
+    """
+    Applies a change made by this process to the index's fingerprint,
+    so the index is not rebuilt for changes it already has
+    """
+    if song_index.fingerprint is None:
+        return
+    total_songs, newest, total_plays = song_index.fingerprint
+    if added and (newest is None or added > newest):
+        newest = added
+    song_index.fingerprint = (total_songs + songs, newest, total_plays + plays)
+
+
+@db_session
+def get_song_index() -> SongIndex:
+    """
+    Returns the sampling index, rebuilding it if the library changed elsewhere
+
+    :return: up to date sampling index
+    """
+    fingerprint = library_fingerprint()
+    if song_index.fingerprint != fingerprint:
+        app.logger.debug("Rebuilding song sampling index")
+        song_index.build(select((s.id, s.playcount) for s in Song)[:], fingerprint)
+    return song_index
+
+
+def index_song_added(song: Song) -> None:
+    """
+    Adds a newly inserted song to the sampling index, without a rebuild
+    """
+    song_index.add(song.id, song.playcount)
+    update_fingerprint(songs=1, plays=song.playcount, added=song.added)
+
+
+def index_song_removed(song_id: UUID) -> None:
+    """
+    Removes a deleted song from the sampling index.
+    If it was the newest song the fingerprint no longer matches, and the index is
+    rebuilt on its next use.
+    """
+    if song_id not in song_index:
+        return
+    plays = song_index.playcount(song_id)
+    song_index.remove(song_id)
+    update_fingerprint(songs=-1, plays=-plays)
+
+
 @db_session
 def sample_songs_weighted(num: int = 6) -> List[Song]:
     """
@@ -154,14 +405,12 @@ def sample_songs_weighted(num: int = 6) -> List[Song]:
     :param int num: number of songs to sample
     :return: list of songs sampled from Songs table, weighted by playcount
     """
-    songs = Song.select()[:]
-    if len(songs) < num:
-        return songs
-    weights = []
-    max_plays = max(s.playcount for s in Song) + 1
-    for song in songs:
-        weights.append(abs(max_plays - song.playcount))
-    return choices(songs, weights=weights, k=num)
+    index = get_song_index()
+    if len(index) < num:
+        return Song.select()[:]
+    song_ids = index.sample(num)
+    songs = {s.id: s for s in Song.select(lambda s: s.id in song_ids)}
+    return [songs[song_id] for song_id in song_ids]
 
 
 def get_metadata(filename: Path) -> Optional[Dict[str, Any]]:
@@ -171,6 +420,11 @@ def get_metadata(filename: Path) -> Optional[Dict[str, Any]]:
     :param Path filename: file to read tags from
     :return: dict containing music file tags
     """
+    use_cache = app.config.get("METADATA_CACHE", True)
+    if use_cache:
+        cached = get_cached_metadata(filename)
+        if cached:
+            return cached
     try:
         metadata = mutagen.File(filename, easy=True)
     except:
@@ -178,17 +432,22 @@ def get_metadata(filename: Path) -> Optional[Dict[str, Any]]:
         metadata = None
     # remove files missing metadata
     if not metadata or "title" not in metadata or "artist" not in metadata:
+        if use_cache:
+            count_miss()
         app.logger.warning(f"Removing {filename} due to missing metadata")
         filename.unlink(missing_ok=True)
         return None
     title = metadata["title"][0]
     artist = metadata["artist"][0]
-    return {
+    meta = {
         "title": title,
         "artist": artist,
         "path": filename,
         "length": metadata.info.length,
     }
+    if use_cache:
+        cache_metadata(filename, meta)
+    return meta
 
 
 @db_session
@@ -206,29 +465,102 @@ def get_song_or_abort(song_id: Optional[UUID]) -> Song:
     return song
 
 
+def get_audio_info(filename: Path) -> Dict[str, Any]:
+    """
+    Returns details of a music file's encoding, and its size and mtime.
+    Details that cannot be read are left out.
+
+    :param Path filename: file to read
+    :return: dict of Song attributes describing the file
+    """
+    info: Dict[str, Any] = {}
+    try:
+        stat = filename.stat()
+        info.update(size=stat.st_size, mtime=stat.st_mtime)
+        stream = mutagen.File(filename).info
+    except Exception:
+        app.logger.warning(f"Could not read audio details of {filename}")
+        return info
+    for attr in ("bitrate", "sample_rate", "channels"):
+        value = getattr(stream, attr, None)
+        if value:
+            info[attr] = int(value)
+    return info
+
+
+def read_song(filepath: Path) -> Optional[Dict[str, Any]]:
+    """
+    Reads everything stored about a music file: its tags, loudness and hashes.
+    Does not touch the database, so it can run in a worker process.
+
+    :param Path filepath: music file to read
+    :return: dict containing music file tags and loudness, or None if invalid
+    """
+    meta = get_metadata(filepath)
+    if meta:
+        # measured once here, so levelling costs nothing per play
+        meta["loudness"] = analyse_loudness(filepath, meta["length"])
+        meta["hashes"] = hash_song(filepath)
+    return meta
+
+
+def add_song(meta: Dict[str, Any]) -> Song:
+    """
+    Creates a song from its file's metadata, without committing it
+
+    :param meta: metadata returned by `get_metadata` or `read_song`
+    :return: the new song
+    """
+    song = Song(
+        filename=meta["path"].name,
+        artist=meta["artist"],
+        title=meta["title"],
+        length=int(meta["length"]),
+        **meta.get("hashes", {}),
+    )
+    loudness = meta.get("loudness")
+    if loudness:
+        song.set(**loudness._asdict())
+        write_replaygain_tags(meta["path"], loudness)
+    # read last, as writing tags changes the file's size
+    song.set(**get_audio_info(meta["path"]))
+    return song
+
+
 @db_session
-def insert_song(filepath: Path) -> Optional[Song]:
+def insert_song(
+    filepath: Path, hashes: Optional[Dict[str, str]] = None
+) -> Optional[Song]:
     """
     Adds a song to the database
 
     :param Path filepath: music file to add
+    :param hashes: hashes of the file the song was encoded from, see `hash_song`
     """
     app.logger.info(f"Inserting song: {filepath}")
     meta = get_metadata(filepath)
     if meta:
         # check dupe
         song = Song.get(artist=meta["artist"], title=meta["title"])
+        if song and song.filename == filepath.name:
+            # already added, e.g. by the library watcher while an upload was encoded
+            return song
         if song:
             app.logger.warning(f"{filepath} is a dupe, removing...")
             filepath.unlink(missing_ok=True)
         else:
-            song = Song(
-                filename=filepath.name,
-                artist=meta["artist"],
-                title=meta["title"],
-                length=int(meta["length"]),
-            )
-            commit()
+            meta["loudness"] = analyse_loudness(filepath, meta["length"])
+            meta["hashes"] = hashes or hash_song(filepath)
+            song = add_song(meta)
+            try:
+                commit()
+            except (IntegrityError, TransactionIntegrityError):
+                # another process added the file while it was being analysed
+                rollback()
+                app.logger.info(f"{filepath} was added concurrently")
+                return Song.get(filename=filepath.name)
+            index_song_added(song)
+            song_added(song.size)
         return song
     else:
         app.logger.warning(f"{filepath} has no metadata, removing...")
@@ -236,6 +568,63 @@ def insert_song(filepath: Path) -> Optional[Song]:
     return None
 
 
+def update_song(song: Song, meta: Dict[str, Any]) -> None:
+    """
+    Updates a song from its (replaced) file's metadata, without committing it.
+    Hashes are only filled in if the song has none yet.
+
+    :param song: song to update
+    :param meta: metadata returned by `read_song`
+    """
+    old_size = song.size
+    song.set(artist=meta["artist"], title=meta["title"], length=int(meta["length"]))
+    # rescans only see the encoded file, so hashes of the original upload are kept
+    hashes = meta.get("hashes", {})
+    missing = {attr: value for attr, value in hashes.items() if not getattr(song, attr)}
+    song.set(**missing)
+    loudness = meta.get("loudness")
+    if loudness:
+        song.set(**loudness._asdict())
+        write_replaygain_tags(meta["path"], loudness)
+    song.set(**get_audio_info(meta["path"]))
+    song_resized(old_size, song.size)
+
+
+@db_session
+def insert_songs(
+    songs: List[Dict[str, Any]], known: Optional[Set[Tuple[str, str]]] = None
+) -> List[Song]:
+    """
+    Adds songs that have already been read to the database, in a single transaction.
+    Duplicates (by artist and title) are removed from disk instead.
+
+    :param songs: metadata returned by `read_song`
+    :param known: (artist, title) of every song in the database, updated in place
+    :return: songs that were added
+    """
+    if known is None:
+        known = set(select((s.artist, s.title) for s in Song)[:])
+    filenames = [meta["path"].name for meta in songs]
+    # files that are already a song's own must never be removed as dupes
+    existing = set(select(s.filename for s in Song if s.filename in filenames))
+    added = []
+    for meta in songs:
+        if meta["path"].name in existing:
+            continue
+        key = (meta["artist"], meta["title"])
+        if key in known:
+            app.logger.warning(f"{meta['path']} is a dupe, removing...")
+            meta["path"].unlink(missing_ok=True)
+            continue
+        known.add(key)
+        added.append(add_song(meta))
+    commit()
+    for song in added:
+        index_song_added(song)
+    songs_added([song.size for song in added])
+    return added
+
+
 @db_session
 def insert_queue(songs: List[Song]) -> None:
     """
@@ -243,9 +632,7 @@ def insert_queue(songs: List[Song]) -> None:
 
     :param songs: list of songs to add
     """
-    for song in songs:
-        Queue(song=song)
-    commit()
+    song_queue.add(song.id for song in songs)
 
 
 @db_session
@@ -253,10 +640,8 @@ def generate_queue() -> None:
     """
     Fills the queue with songs, using the weighted sample method
     """
-    queue = Queue.select()[:]
-    if queue:
-        randoms = db_sum(not entry.requested for entry in queue)
-        reqs = len(queue) - randoms
+    randoms, reqs = song_queue.counts()
+    if randoms or reqs:
         threshold = math.ceil((10 - min(reqs, 10)) / 2)
         to_add = abs(threshold - randoms)
         if randoms >= threshold:
@@ -267,52 +652,250 @@ def generate_queue() -> None:
 
 
 @db_session
-def reload_songs(path=app.config["PATH_MUSIC"]) -> None:
+def remove_songs(filenames: List[str]) -> None:
+    """
+    Removes the songs with the given filenames from the database and the queue
+
+    :param filenames: filenames of the songs to remove
+    """
+    for song in Song.select(lambda s: s.filename in filenames):
+        song_removed(song.playcount, song.size)
+        index_song_removed(song.id)
+        song_queue.remove_song(song.id)
+        song.delete()
+    commit()
+
+
+# records the size and mtime of every file seen by the last library scan
+MANIFEST_NAME = ".manifest.json"
+
+
+class ScanReport(NamedTuple):
+    added: int
+    updated: int
+    removed: int
+    failed: int
+
+
+def stat_files(path: Path) -> Dict[str, Tuple[int, float]]:
+    """
+    :return: size and mtime of each music file in `path`, by filename
+    """
+    with os.scandir(path) as entries:
+        files = [e for e in entries if e.name.endswith(".ogg") and e.is_file()]
+        return {f.name: (f.stat().st_size, f.stat().st_mtime) for f in files}
+
+
+def load_manifest(path: Path) -> Dict[str, Tuple[int, float]]:
+    try:
+        manifest = json.loads((path / MANIFEST_NAME).read_text())
+    except (OSError, ValueError):
+        return {}
+    return {filename: tuple(stat) for filename, stat in manifest.items()}
+
+
+def save_manifest(path: Path, manifest: Dict[str, Tuple[int, float]]) -> None:
+    tmp = path / f"{MANIFEST_NAME}.tmp"
+    try:
+        tmp.write_text(json.dumps(manifest))
+        tmp.replace(path / MANIFEST_NAME)
+    except OSError:
+        app.logger.exception(f"Could not save library manifest to {path}")
+
+
+def read_songs(paths: List[Path], workers: int) -> Iterator[Optional[Dict[str, Any]]]:
+    """
+    Reads the given music files, in a pool of processes if `workers` > 1
+
+    :return: results of `read_song`, in the order of `paths`
+    """
+    if workers <= 1 or len(paths) <= 1:
+        yield from map(read_song, paths)
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(read_song, paths, chunksize=8)
+
+
+@db_session
+def reload_songs(
+    path: Path = app.config["PATH_MUSIC"],
+    workers: Optional[int] = None,
+    batch_size: int = 500,
+) -> ScanReport:
     """
     Keeps music directory and database in sync.
-    This is done by removing songs that exist in the database, but not on the filesystem.
-    Also adds any songs found in the filesystem that are not present in the database.
-    """
-    songs_filesystem = [f.name for f in path.glob("*.ogg")]
-    # insert all files if no songs in database
-    if count(s for s in Song) <= 0:
-        for filename in songs_filesystem:
-            insert_song(path / filename)
-    # generate queue if it is empty
-    if count(s for s in Queue) <= 0:
+    Songs that exist in the database but not on the filesystem are removed,
+    and files that are new (or changed since the last scan) are read and added.
+
+    Only files whose size or mtime differ from the manifest of the last scan are read,
+    tags are read in a pool of processes and songs are written in batches.
+
+    :param path: music directory to scan
+    :param workers: number of processes reading tags, defaults to the CPU count
+    :param batch_size: number of songs written per transaction
+    :return: number of songs added, updated, removed and that failed to be read
+    """
+    workers = workers or os.cpu_count() or 1
+    files = stat_files(path)
+    manifest = load_manifest(path)
+    songs_db = set(select(song.filename for song in Song)[:])
+
+    songs_to_add = files.keys() - songs_db
+    songs_to_remove = songs_db - files.keys()
+    # songs already known whose file was replaced since the last scan
+    songs_to_update = {
+        filename
+        for filename in files.keys() & songs_db
+        if filename in manifest and manifest[filename] != files[filename]
+    }
+    app.logger.info(
+        f"Scanning {path}: {len(songs_to_add)} new, {len(songs_to_update)} changed, "
+        f"{len(songs_to_remove)} removed"
+    )
+
+    removed = list(songs_to_remove)
+    for i in range(0, len(removed), batch_size):
+        remove_songs(removed[i : i + batch_size])
+
+    to_read = sorted(songs_to_add | songs_to_update)
+    known = set(select((s.artist, s.title) for s in Song)[:])
+    batch: List[Dict[str, Any]] = []
+    added = updated = failed = 0
+    results = read_songs([path / filename for filename in to_read], workers)
+    for done, meta in enumerate(results, 1):
+        if not meta:
+            failed += 1
+        elif meta["path"].name in songs_to_update:
+            update_song(Song.get(filename=meta["path"].name), meta)
+            updated += 1
+        else:
+            batch.append(meta)
+        if done % batch_size == 0 or done == len(to_read):
+            added += len(insert_songs(batch, known))
+            batch = []
+            app.logger.info(f"Scanned {done}/{len(to_read)} files")
+
+    # tags may have been written while reading, so stat again
+    save_manifest(path, stat_files(path))
+    if not len(song_queue):
         generate_queue()
+    return ScanReport(added, updated, len(songs_to_remove), failed)
 
-    songs_db = select(song.filename for song in Song)[:]
 
-    songs_to_add = [song for song in songs_filesystem if song not in songs_db]
-    songs_to_remove = [song for song in songs_db if song not in songs_filesystem]
+def make_track(song: Song, queue_id: Optional[int] = None) -> Track:
+    """
+    Builds the track handed to stream workers for the given song
 
-    for song in songs_to_remove:
-        Song.get(filename=song).delete()
+    :param song: song to build track for
+    :param queue_id: ID of the queue entry the song was taken from
+    :return: track for the given song
+    """
+    # silence is only trimmed when levelling, so unlevelled streams play files as is
+    trim = app.config.get("LOUDNESS_NORMALISE", False)
+    return Track(
+        id=song.id,
+        path=Path(app.config["PATH_MUSIC"], song.filename),
+        artist=song.artist,
+        title=song.title,
+        length=song.length,
+        queue_id=queue_id,
+        gain=loudness_gain(song.loudness, song.true_peak),
+        start=(song.start_offset or 0.0) if trim else 0.0,
+        end=song.end_offset if trim else None,
+    )
 
-    app.logger.info(f"Adding songs: {songs_to_add}")
-    app.logger.info(f"Removing songs: {songs_to_remove}")
 
-    for filename in songs_to_add:
-        insert_song(Path(app.config["PATH_MUSIC"], filename))
+@db_session
+def peek_track() -> Optional[Track]:
+    """
+    Gets the track at the front of the queue, without marking it as played
+
+    :return: track to play next
+    """
+    generate_queue()
+    queue_entry = song_queue.first()
+    while queue_entry:
+        song = Song.get(id=queue_entry.song_id)
+        if song:
+            return make_track(song, queue_id=queue_entry.id)
+        # the song was deleted while it was queued
+        song_queue.remove(queue_entry.id)
+        queue_entry = song_queue.first()
+    return None
 
 
 @db_session
+def play_track(track: Track) -> bool:
+    """
+    Marks a track returned by `peek_track` as played, removing it from the queue
+
+    :param track: track to mark as played
+    :return: False if the track's queue entry no longer exists
+    """
+    if not song_queue.remove(track.queue_id):
+        return False
+    song = Song.get(id=track.id)
+    if not song:
+        return True
+    song.playcount += 1
+    song.lastplayed = datetime.utcnow()
+    song_index.increment(song.id)
+    update_fingerprint(plays=1)
+    song_played()
+    return True
+
+
+@db_session
+def next_track() -> Optional[Track]:
+    """
+    Gets the track to play next from the queue, marking it as played
+
+    :return: track to play
+    """
+    track = peek_track()
+    if track:
+        play_track(track)
+    return track
+
+
 def next_song() -> Optional[Path]:
     """
     Gets the song to play next from the queue
 
     :return: path to song
     """
-    generate_queue()
-    queue_entry = Queue.select().sort_by(Queue.id).first()
-    if not queue_entry:
-        return None
-    song = Song[queue_entry.song.id]
-    song.playcount += 1
-    song.lastplayed = datetime.utcnow()
-    queue_entry.delete()
-    return Path(app.config["PATH_MUSIC"], song.filename)
+    track = next_track()
+    return track.path if track else None
+
+
+@db_session
+def queued_songs(entries: List[QueueEntry]) -> List[Tuple[QueueEntry, Song]]:
+    """
+    Loads the songs of the given queue entries in a single query.
+    Entries whose song no longer exists are left out.
+
+    :param entries: queue entries, as returned by the queue backend
+    :return: (entry, song) pairs, in the order of `entries`
+    """
+    song_ids = [entry.song_id for entry in entries]
+    songs = {s.id: s for s in Song.select(lambda s: s.id in song_ids)}
+    return [
+        (entry, songs[entry.song_id]) for entry in entries if entry.song_id in songs
+    ]
+
+
+@db_session
+def upcoming_tracks(num: int = 3) -> List[Track]:
+    """
+    Gets the tracks at the front of the queue, without modifying it
+
+    :param num: number of tracks to return
+    :return: list of upcoming tracks, in play order
+    """
+    return [
+        make_track(song, queue_id=entry.id)
+        for entry, song in queued_songs(song_queue.entries(num))
+    ]
 
 
 class QueueType(Enum):
@@ -331,6 +914,17 @@ class QueueStatus(NamedTuple):
     time: Optional[datetime]
 
 
+def entry_status(queue_entry: Optional[QueueEntry]) -> QueueStatus:
+    """
+    :param queue_entry: first queue entry of a song, if it is queued
+    :return: queue details for the song
+    """
+    if queue_entry:
+        req_type = QueueType.USER if queue_entry.requested else QueueType.NORMAL
+        return QueueStatus(queued=True, type=req_type, time=queue_entry.added)
+    return QueueStatus(queued=False, type=QueueType.NONE, time=None)
+
+
 @db_session
 def queue_status(song: Song) -> QueueStatus:
     """
@@ -339,11 +933,7 @@ def queue_status(song: Song) -> QueueStatus:
     :param song: song to get status of
     :return: queue details for given song
     """
-    song_queue = Queue.select(lambda s: s.song.id == song.id).sort_by(Queue.id).first()
-    if song_queue:
-        req_type = QueueType.USER if song_queue.requested else QueueType.NORMAL
-        return QueueStatus(queued=True, type=req_type, time=song_queue.added)
-    return QueueStatus(queued=False, type=QueueType.NONE, time=None)
+    return entry_status(song_queue.find(song.id))
 
 
 def humanize_lastplayed(seconds: Union[arrow.arrow.Arrow, int]) -> str:
@@ -369,9 +959,30 @@ def request_status(song: Union[Song, SongData]) -> RequestStatus:
     :param song: song to get status of
     :return: requestable status for given song
     """
-    status = queue_status(song)
+    return request_statuses([song])[0]
+
+
+@db_session
+def request_statuses(songs: List[Union[Song, SongData]]) -> List[RequestStatus]:
+    """
+    Gets the requestable status of several songs, looking up the queue only once
+
+    :param songs: songs to get status of
+    :return: requestable status of each song, in the same order
+    """
+    queued = song_queue.find_many(song.id for song in songs)
+    queue_length = len(song_queue)
+    return [
+        make_request_status(song, entry_status(queued.get(song.id)), queue_length)
+        for song in songs
+    ]
+
+
+def make_request_status(
+    song: Union[Song, SongData], status: QueueStatus, queue_length: int
+) -> RequestStatus:
     info = RequestStatus(requestable=not status.queued)
-    if count(x for x in Queue) >= 10:
+    if queue_length >= 10:
         info.reason = "Queue is full. Please wait until there are less than 10 entries"
         info.requestable = False
     elif status.queued:
@@ -399,51 +1010,6 @@ def when_requestable(lastplayed: int, length: int) -> arrow.arrow.Arrow:
     return arrow.get(lastplayed + (60 * 30) + length)
 
 
-def parse_status(url: str) -> dict:
-    """
-    Function to parse the XML returned from a mountpoint.
-    Input must be a bytestring as to avoid UnicodeDecodeError from stopping
-    Parsing. The only meaningful result is "Current Listeners".
-
-    Logic behind returning an explicit "Online" key is readability
-    """
-    result = {"Online": False, "Current Song": ""}  # Assume False by default
-    try:
-        xml = urllib.request.urlopen(url).read()
-    except URLError:
-        return result
-    try:
-        # CDATA required
-        xml_dict = xmltodict.parse(xml, xml_attribs=False, cdata_separator="\n")
-        try:
-            xml_dict = (
-                xml_dict.get("playlist", {}).get("trackList", {}).get("track", None)
-            )
-        except AttributeError:
-            # No mountpoint it seems, just ditch an empty result
-            return result
-        else:
-            if xml_dict is None:
-                # We got none returned from the get anyway
-                return result
-        annotations = xml_dict.get("annotation", False)
-        if not annotations:
-            # edge case for having nothing...
-            return result
-        annotations = annotations.split("\n")
-        for annotation in annotations:
-            tmp = annotation.split(":", 1)
-            if len(tmp) > 1:
-                result[tmp[0]] = tmp[1].strip()
-        result["Online"] = True
-        result["Current Song"] = xml_dict.get("title", "") or ""
-    except:
-        # fallback for any unexpected errors
-        result["Online"] = False
-        result["Current Song"] = ""
-    return result
-
-
 def filter_default_webargs(args: marshmallow.Schema, **kwargs: any) -> dict:
     """
     Returns a dict containing only arguments that have non-default values set
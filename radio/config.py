@@ -0,0 +1,181 @@
+class Config:
+    """ Server configuration """
+
+    # Print/display debug info while running
+    DEBUG = False
+    PROPAGATE_EXCEPTIONS = False
+
+    # Protocol to prefer for URLs (http/s)
+    PREFERRED_URL_SCHEME = "http"
+    # Prefix to use for API URLs
+    SERVER_API_PREFIX = "/api/v1"
+    # Replace with a long, random string
+    SECRET_KEY = "secret-key-goes-here"
+    # Replace with a long, random string
+    JWT_SECRET_KEY = "secret-key-goes-here"
+
+    # Desired vorbis quality level for encoding uploaded files
+    SONG_QUALITY_LVL = 8
+    # Desired bitrate to use for streaming (transcoding)
+    TRANSCODE_BITRATE = 192
+    # Level transcoded streams to a common loudness, using analysis done on upload
+    # (untranscoded Ogg streams carry ReplayGain tags instead)
+    LOUDNESS_NORMALISE = False
+    # Target integrated loudness, in LUFS
+    LOUDNESS_TARGET = -16
+
+    # Paths (prefer full paths, relative cannot be guaranteed)
+    # Path to store all songs at
+    PATH_MUSIC = "/full/path/to/radio/music/"
+    # Path to store temporary files for encoding
+    PATH_ENCODE = "/full/path/to/radio/encode/"
+    # Path to an ffmpeg binary to use for encoding (this MUST exist)
+    PATH_FFMPEG_BINARY = "/usr/local/bin/ffmpeg"
+    # Allowed music upload extensions
+    ALLOWED_EXTENSIONS = ["mp3", "ogg", "flac", "wav", "m4a"]
+
+    # Database configuration for PonyORM (postgres preferred)
+    DB_BINDING = "postgres"
+    DB_HOST = "127.0.0.1"
+    DB_USER = "sgfc"
+    DB_PASSWORD = ""
+    DB_DATABASE = "radio"
+
+    # Icecast server configuration
+    # Icecast auth
+    ICECAST_HOST = "127.0.0.1"
+    ICECAST_PORT = 8067
+    ICECAST_USER = "source"
+    ICECAST_PASSWORD = "source-password-goes-here"
+    # Icecast metadata
+    ICECAST_LOCATION = "Country"
+    ICECAST_CONTACT = "contact.email@example.com"
+    ICECAST_MOUNT = "/radio"
+    ICECAST_NAME = "Radio Stream Title"
+    ICECAST_DESCRIPTION = "A short description about your stream"
+    ICECAST_GENRE = "Genre of the music being streamed"
+    ICECAST_URL = "http://url-to-use-for-icecast-links.org"
+    # Transcode stream to MP3 for browser compatibility
+    ICECAST_TRANSCODE = False
+    # Extra renditions to stream, each on its own mount (e.g. /radio-128.mp3)
+    # codec is one of "mp3" or "opus", bitrate is in kbps
+    ICECAST_EXTRA_RENDITIONS = []
+    # Decode each song once and share the output between all mounts
+    STREAM_FANOUT = False
+    # Size of the shared buffer between the decoder and each mount, in bytes
+    STREAM_RING_SIZE = 1048576
+    # Keep one ffmpeg encoder running per transcoded mount, fed song after song
+    # Gives gapless output; not used together with STREAM_FANOUT
+    STREAM_PERSISTENT_TRANSCODER = False
+    # Seconds of audio sent to Icecast per chunk (larger chunks use less CPU)
+    STREAM_CHUNK_SECONDS = 0.5
+    # Elect a single scheduler with a Redis lease, so several stream nodes can run
+    # Nodes that are not leading play the tracks scheduled by the leader
+    STREAM_LEADER_ELECTION = False
+    # Lifetime of the scheduler lease, in seconds (failover takes at most this long)
+    STREAM_LEADER_TTL = 10
+    # Names of the renditions this node streams (e.g. ["OGG", "MP3"]), None for all
+    STREAM_NODE_RENDITIONS = None
+    # Cache MP3 transcodes on disk instead of re-transcoding every play
+    TRANSCODE_CACHE_ENABLED = False
+    # Path to store cached transcodes at
+    PATH_TRANSCODE_CACHE = "/full/path/to/radio/cache/"
+    # Largest allowed size of the transcode cache, in bytes
+    TRANSCODE_CACHE_SIZE = 2147483648
+    # Number of transcodes to run in the background at once
+    TRANSCODE_CACHE_WORKERS = 2
+    # Number of upcoming queue entries to transcode ahead of time
+    TRANSCODE_CACHE_PREFETCH = 3
+    # Keep one source connection open across tracks (no reconnect between songs)
+    ICECAST_PERSISTENT_CONNECTION = True
+    # Initial and maximum delay (in seconds) between reconnect attempts
+    ICECAST_RECONNECT_DELAY = 1
+    ICECAST_RECONNECT_MAX_DELAY = 60
+    # Listener counts and mount health are sampled from Icecast's status-json.xsl
+    # every ICECAST_STATUS_INTERVAL seconds by the stream, and cached for the API
+    ICECAST_STATUS_INTERVAL = 10
+    ICECAST_STATUS_TIMEOUT = 5
+    ICECAST_STATUS_TTL = 60
+    # Seconds a music file must stop changing before the watcher adds it
+    # The watcher (`python -m radio.watcher`) requires `pip install watchdog`
+    WATCHER_DEBOUNCE = 2
+
+    # Redis configuration
+    # Used to enable song skipping, among other things
+    REDIS_URL = "redis://redis:6379/0"
+    # Where the play queue is stored, one of "database" or "redis"
+    # Switch with `python -m tools.migrate_queue <from> <to>` to keep queued songs
+    QUEUE_BACKEND = "database"
+    # Library totals (songs, plays, size) are kept up to date in Redis,
+    # and recounted from scratch after this many seconds
+    LIBRARY_STATS_TTL = 86400
+    # Now playing push (/np/events): seconds a connection is kept before the client
+    # is asked to reconnect, seconds between keepalives, and reconnect delay in ms
+    NP_EVENTS_MAX_AGE = 600
+    NP_EVENTS_KEEPALIVE = 15
+    NP_EVENTS_RETRY = 5000
+    # Also detect duplicates by their decoded audio (catches retagged copies),
+    # at the cost of decoding every upload before it is encoded
+    DEDUPE_AUDIO_HASH = False
+    # Cache tags read from music files in Redis, keyed by path, size and mtime
+    METADATA_CACHE = True
+    METADATA_CACHE_TTL = 604800
+    # Uploads are encoded by the encoder service (`python -m radio.encoder`)
+    # Number of encodes each encoder process runs at once
+    UPLOAD_WORKERS = 2
+    # Most encodes running at once across every encoder process
+    UPLOAD_CONCURRENCY = 2
+    # Threads each ffmpeg encode may use (None lets ffmpeg decide)
+    UPLOAD_THREADS = 1
+    # Seconds after which an encode's slot is considered abandoned
+    UPLOAD_ENCODE_TIMEOUT = 3600
+    # Seconds a finished upload job's status is kept for
+    UPLOAD_JOB_TTL = 86400
+    # Seconds an unfinished chunked upload is kept after its last chunk
+    UPLOAD_SESSION_TTL = 86400
+
+    # OpenID auth configuration
+    # Allows use of OpenID login (as well as traditional)
+    AUTH_OPENID_ENABLED = True
+    AUTH_CLIENT_ID = "client-id"
+    AUTH_CLIENT_SECRET = "client-secret"
+    AUTH_SERVER_METADATA_URL = "https://example.com/.well-known/openid-configuration"
+
+    # General app configuration
+    # Largest allowed size for music uploads, in bytes (if PUBLIC_UPLOADS is True)
+    FILE_SIZE_LIMIT = 524288000
+    # Allow anyone to upload (only logged-in admins otherwise)
+    PUBLIC_UPLOADS = False
+    # Displays a download button next to songs in the song listing
+    PUBLIC_DOWNLOADS = False
+    # Title of the site to show in headings and the browser title
+    TITLE = "SGFC Radio"
+    # Number of songs to return per page
+    SONGS_PER_PAGE = 25
+
+    # CSS options for website
+    # These must be for Bootstrap 4
+    DEFAULT_CSS = "Pulse"
+    CSS = {
+        "Cerulean": "https://bootswatch.com/4/cerulean/bootstrap.min.css",
+        "Cosmo": "https://bootswatch.com/4/cosmo/bootstrap.min.css",
+        "Cyborg": "https://bootswatch.com/4/cyborg/bootstrap.min.css",
+        "Darkly": "https://bootswatch.com/4/darkly/bootstrap.min.css",
+        "Flatly": "https://bootswatch.com/4/flatly/bootstrap.min.css",
+        "Journal": "https://bootswatch.com/4/journal/bootstrap.min.css",
+        "Litera": "https://bootswatch.com/4/litera/bootstrap.min.css",
+        "Lumen": "https://bootswatch.com/4/lumen/bootstrap.min.css",
+        "Lux": "https://bootswatch.com/4/lux/bootstrap.min.css",
+        "Materia": "https://bootswatch.com/4/materia/bootstrap.min.css",
+        "Minty": "https://bootswatch.com/4/minty/bootstrap.min.css",
+        "Pulse": "https://bootswatch.com/4/pulse/bootstrap.min.css",
+        "Sandstone": "https://bootswatch.com/4/sandstone/bootstrap.min.css",
+        "Simplex": "https://bootswatch.com/4/simplex/bootstrap.min.css",
+        "Sketchy": "https://bootswatch.com/4/sketchy/bootstrap.min.css",
+        "Slate": "https://bootswatch.com/4/slate/bootstrap.min.css",
+        "Solar": "https://bootswatch.com/4/solar/bootstrap.min.css",
+        "Spacelab": "https://bootswatch.com/4/spacelab/bootstrap.min.css",
+        "Superhero": "https://bootswatch.com/4/superhero/bootstrap.min.css",
+        "United": "https://bootswatch.com/4/united/bootstrap.min.css",
+        "Yeti": "https://bootswatch.com/4/yeti/bootstrap.min.css",
+    }
@@ -18,6 +18,11 @@ class Config:
     SONG_QUALITY_LVL = 8
     # Desired bitrate to use for streaming (transcoding)
     TRANSCODE_BITRATE = 192
+    # Level transcoded streams to a common loudness, using analysis done on upload
+    # (untranscoded Ogg streams carry ReplayGain tags instead)
+    LOUDNESS_NORMALISE = False
+    # Target integrated loudness, in LUFS
+    LOUDNESS_TARGET = -16
 
     # Paths (prefer full paths, relative cannot be guaranteed)
     # Path to store all songs at
@@ -52,10 +57,88 @@ class Config:
     ICECAST_URL = "http://url-to-use-for-icecast-links.org"
     # Transcode stream to MP3 for browser compatibility
     ICECAST_TRANSCODE = False
+    # Extra renditions to stream, each on its own mount (e.g. /radio-128.mp3)
+    # codec is one of "mp3" or "opus", bitrate is in kbps
+    ICECAST_EXTRA_RENDITIONS = []
+    # Decode each song once and share the output between all mounts
+    STREAM_FANOUT = False
+    # Size of the shared buffer between the decoder and each mount, in bytes
+    STREAM_RING_SIZE = 1048576
+    # Keep one ffmpeg encoder running per transcoded mount, fed song after song
+    # Gives gapless output; not used together with STREAM_FANOUT
+    STREAM_PERSISTENT_TRANSCODER = False
+    # Seconds of audio sent to Icecast per chunk (larger chunks use less CPU)
+    STREAM_CHUNK_SECONDS = 0.5
+    # Elect a single scheduler with a Redis lease, so several stream nodes can run
+    # Nodes that are not leading play the tracks scheduled by the leader
+    # Each mount is only streamed to by the node holding its lease, the others stand by
+    STREAM_LEADER_ELECTION = False
+    # Lifetime of the scheduler lease, in seconds (failover takes at most this long)
+    STREAM_LEADER_TTL = 10
+    # Names of the renditions this node streams (e.g. ["OGG", "MP3"]), None for all
+    STREAM_NODE_RENDITIONS = None
+    # Name of this node in the stream metrics, None for the hostname
+    STREAM_NODE_NAME = None
+    # Cache MP3 transcodes on disk instead of re-transcoding every play
+    TRANSCODE_CACHE_ENABLED = False
+    # Path to store cached transcodes at
+    PATH_TRANSCODE_CACHE = "/app/paths/cache/"
+    # Largest allowed size of the transcode cache, in bytes
+    TRANSCODE_CACHE_SIZE = 2147483648
+    # Number of transcodes to run in the background at once
+    TRANSCODE_CACHE_WORKERS = 2
+    # Number of upcoming queue entries to transcode ahead of time
+    TRANSCODE_CACHE_PREFETCH = 3
+    # Keep one source connection open across tracks (no reconnect between songs)
+    ICECAST_PERSISTENT_CONNECTION = False
+    # Reconnect before sending if the connection sat idle this long, in seconds
+    # (keep it below Icecast's source-timeout, which drops idle sources)
+    ICECAST_IDLE_TIMEOUT = 4
+    # Initial and maximum delay (in seconds) between reconnect attempts
+    ICECAST_RECONNECT_DELAY = 1
+    ICECAST_RECONNECT_MAX_DELAY = 60
+    # Listener counts and mount health are sampled from Icecast's status-json.xsl
+    # every ICECAST_STATUS_INTERVAL seconds by the stream, and cached for the API
+    ICECAST_STATUS_INTERVAL = 10
+    ICECAST_STATUS_TIMEOUT = 5
+    ICECAST_STATUS_TTL = 60
+    # Seconds a music file must stop changing before the watcher adds it
+    # The watcher (`python -m radio.watcher`) requires `pip install watchdog`
+    WATCHER_DEBOUNCE = 2
 
     # Redis configuration
     # Used to enable song skipping, among other things
     REDIS_URL = "redis://redis:6379/0"
+    # Where the play queue is stored, one of "database" or "redis"
+    # Switch with `python -m tools.migrate_queue <from> <to>` to keep queued songs
+    QUEUE_BACKEND = "database"
+    # Library totals (songs, plays, size) are kept up to date in Redis,
+    # and recounted from scratch after this many seconds
+    LIBRARY_STATS_TTL = 86400
+    # Now playing push (/np/events): seconds a connection is kept before the client
+    # is asked to reconnect, seconds between keepalives, and reconnect delay in ms
+    NP_EVENTS_MAX_AGE = 600
+    NP_EVENTS_KEEPALIVE = 15
+    NP_EVENTS_RETRY = 5000
+    # Also detect duplicates by their decoded audio (catches retagged copies),
+    # at the cost of decoding every upload before it is encoded
+    DEDUPE_AUDIO_HASH = False
+    # Cache tags read from music files in Redis, keyed by path, size and mtime
+    METADATA_CACHE = True
+    METADATA_CACHE_TTL = 604800
+    # Uploads are encoded by the encoder service (`python -m radio.encoder`)
+    # Number of encodes each encoder process runs at once
+    UPLOAD_WORKERS = 2
+    # Most encodes running at once across every encoder process
+    UPLOAD_CONCURRENCY = 2
+    # Threads each ffmpeg encode may use (None lets ffmpeg decide)
+    UPLOAD_THREADS = 1
+    # Seconds after which an encode's slot is considered abandoned
+    UPLOAD_ENCODE_TIMEOUT = 3600
+    # Seconds a finished upload job's status is kept for
+    UPLOAD_JOB_TTL = 86400
+    # Seconds an unfinished chunked upload is kept after its last chunk
+    UPLOAD_SESSION_TTL = 86400
 
     # OpenID auth configuration
     # Allows use of OpenID login (as well as traditional)
@@ -0,0 +1,16 @@
+import flask_restful as rest
+from flask import Blueprint
+from flask import Response
+
+from radio.common.metrics import render_metrics
+
+blueprint = Blueprint("metrics", __name__)
+api = rest.Api(blueprint)
+
+
+@api.resource("/metrics")
+class MetricsController(rest.Resource):
+    def get(self) -> Response:
+        return Response(
+            render_metrics(), mimetype="text/plain; version=0.0.4; charset=utf-8"
+        )
@@ -1,9 +1,10 @@
-import concurrent.futures
 import dataclasses
 import os
+import time
 from datetime import timedelta
 from functools import partial
 from pathlib import Path
+from typing import Any
 from typing import Dict
 from typing import Optional
 from urllib.parse import quote
@@ -34,38 +35,66 @@ from werkzeug.utils import secure_filename
 
 from radio import app
 from radio import redis_client
+from radio.common.jobs import PRIORITY_HIGH
+from radio.common.jobs import PRIORITY_NORMAL
+from radio.common.jobs import JobStatus
+from radio.common.jobs import create_job
+from radio.common.jobs import get_job
+from radio.common.jobs import queue_position
+from radio.common.nowplaying import refresh_now_playing
 from radio.common.pagination import Pagination
+from radio.common.queue import song_queue
 from radio.common.schemas import FavouriteSchema
+from radio.common.schemas import RequestStatus
 from radio.common.schemas import SongBasicSchema
 from radio.common.schemas import SongData
 from radio.common.schemas import SongMeta
 from radio.common.schemas import SongQuerySchema
 from radio.common.schemas import TokenSchema
+from radio.common.stats import song_removed
+from radio.common.stats import song_resized
+from radio.common.uploads import UploadError
+from radio.common.uploads import UploadSession
 from radio.common.users import admin_required
 from radio.common.users import user_is_admin
-from radio.common.utils import EncodeError
 from radio.common.utils import allowed_file_extension
-from radio.common.utils import encode_file
 from radio.common.utils import filter_default_webargs
+from radio.common.utils import find_duplicate
+from radio.common.utils import get_audio_info
 from radio.common.utils import get_metadata
 from radio.common.utils import get_song_or_abort
-from radio.common.utils import insert_song
+from radio.common.utils import hash_song
+from radio.common.utils import index_song_removed
 from radio.common.utils import make_api_response
 from radio.common.utils import parser
 from radio.common.utils import request_status
-from radio.database import Queue
+from radio.common.utils import request_statuses
 from radio.database import Song
 from radio.database import User
 
 blueprint = Blueprint("songs", __name__)
 api = rest.Api(blueprint)
 
+# Song fields that are only used internally and not exposed by the API
+SONG_PRIVATE_FIELDS = [
+    "filename",
+    "loudness",
+    "true_peak",
+    "start_offset",
+    "end_offset",
+    "mtime",
+    "source_hash",
+    "audio_hash",
+]
+
 
 # TODO: break this file up
 
 
 @db_session
-def query_songs(query: Optional[str], user: Optional[User] = None) -> Query:
+def query_songs(
+    query: Optional[str], user: Optional[User] = None, sort: Optional[str] = None
+) -> Query:
     songs: Query
     src = user.favourites if user else Song
     if query:
@@ -75,23 +104,27 @@ def query_songs(query: Optional[str], user: Optional[User] = None) -> Query:
         )
     else:
         songs = src.select()
+    if sort:
+        attr = getattr(Song, sort.lstrip("-"))
+        songs = songs.sort_by(desc(attr) if sort.startswith("-") else attr)
     # sort by date uploaded if not a favourite
-    if not user:
+    elif not user:
         songs = songs.sort_by(desc(Song.added))
     return songs
 
 
-def get_song_detailed(song: Song) -> SongData:
+def get_song_detailed(song: Song, status: Optional[RequestStatus] = None) -> SongData:
     """
-    Gets file size and request status for the given song
+    Gets file details and request status for the given song
 
     :param song: Song to get details for
+    :param status: request status of the song, if already looked up
     :return: SongData
     """
     original_song = song
-    song = SongData(**song.to_dict(exclude="filename", with_lazy=True))
-    song.size = Path(app.config["PATH_MUSIC"], original_song.filename).stat().st_size
-    song.meta = SongMeta(**dataclasses.asdict(request_status(song)))
+    song = SongData(**song.to_dict(exclude=SONG_PRIVATE_FIELDS, with_lazy=True))
+    song.size = song.size or 0
+    song.meta = SongMeta(**dataclasses.asdict(status or request_status(song)))
     if current_user:
         song.meta.favourited = original_song in current_user.favourites
     return song
@@ -104,15 +137,22 @@ def get_songs_response(
     query: Optional[str],
     limit: int,
     favourites: Optional[User] = None,
+    sort: Optional[str] = None,
 ) -> Response:
-    results = query_songs(query, favourites)
+    results = query_songs(query, favourites, sort)
     pagination = Pagination(page=page, per_page=limit, total_count=results.count())
     # report error if page does not exist
     if page <= 0 or page > pagination.pages:
         return make_api_response(404, "Page does not exist")
-    processed_songs = list(map(get_song_detailed, results.page(page, limit)))
+    songs = results.page(page, limit)[:]
+    # one queue lookup for the whole page
+    processed_songs = list(map(get_song_detailed, songs, request_statuses(songs)))
     args = partial(
-        filter_default_webargs, args=SongQuerySchema(), query=query, limit=limit
+        filter_default_webargs,
+        args=SongQuerySchema(),
+        query=query,
+        limit=limit,
+        sort=sort,
     )
     return make_api_response(
         200,
@@ -138,7 +178,9 @@ class SongsController(rest.Resource):
     @jwt_optional
     def get(self) -> Response:
         args = parser.parse(SongQuerySchema(), request)
-        return get_songs_response(self, args["page"], args["query"], args["limit"])
+        return get_songs_response(
+            self, args["page"], args["query"], args["limit"], sort=args["sort"]
+        )
 
 
 @api.resource("/request")
@@ -157,7 +199,8 @@ class RequestController(rest.Resource):
         song = Song[args.get("id")]
         status = request_status(song)
         if status.requestable:
-            Queue(song=song, requested=True)
+            song_queue.add([song.id], requested=True)
+            refresh_now_playing()
             return make_api_response(
                 200,
                 f'Requested "{song.title}" successfully',
@@ -212,11 +255,13 @@ class SongController(rest.Resource):
         song.set(**values)
         commit()
         # update file metadata as well
-        metadata = mutagen.File(
-            Path(app.config["PATH_MUSIC"], song.filename), easy=True
-        )
+        filepath = Path(app.config["PATH_MUSIC"], song.filename)
+        metadata = mutagen.File(filepath, easy=True)
         metadata.update(values)
         metadata.save()
+        old_size = song.size
+        song.set(**get_audio_info(filepath))
+        song_resized(old_size, song.size)
         return make_api_response(
             200,
             "Successfully updated song metadata",
@@ -228,9 +273,15 @@ class SongController(rest.Resource):
     def delete(self, args: Dict[str, UUID], **kwargs) -> Response:
         song = get_song_or_abort(args["id"])
         filepath = os.path.join(app.config["PATH_MUSIC"], song.filename)
+        song_removed(song.playcount, song.size)
         if os.path.isfile(filepath):
             os.remove(filepath)
+        index_song_removed(song.id)
+        song_queue.remove_song(song.id)
         song.delete()
+        # the snapshot is rebuilt from the database, so it must see the deletion
+        commit()
+        refresh_now_playing()
         app.logger.info(f'Deleted song "{song.filename}"')
         return make_api_response(200, f'Successfully deleted song "{song.filename}"')
 
@@ -278,13 +329,59 @@ class DownloadController(rest.Resource):
         )
 
 
+def can_upload() -> bool:
+    return app.config["PUBLIC_UPLOADS"] or user_is_admin()
+
+
+def queue_upload(filepath: Path, filename: str, hashes: Dict[str, str]) -> Response:
+    """
+    Queues a received upload to be encoded, unless it is missing metadata or
+    already in the library
+
+    :param filepath: uploaded file, in PATH_ENCODE
+    :param filename: name of the file as uploaded
+    :param hashes: hashes of the uploaded file, see `hash_song`.
+        The audio hash is left to the encoder, as it needs a full decode.
+    """
+    meta = get_metadata(filepath)
+    if not meta:
+        filepath.unlink(missing_ok=True)
+        return make_api_response(400, "File missing metadata")
+
+    # reject duplicates before spending an encode on them
+    duplicate = find_duplicate(hashes)
+    if duplicate:
+        filepath.unlink(missing_ok=True)
+        return make_api_response(
+            400,
+            f'"{duplicate.title}" by {duplicate.artist} already exists',
+            content={"id": duplicate.id},
+        )
+
+    # encoding happens in the encoder service, see radio.encoder
+    priority = PRIORITY_HIGH if user_is_admin() else PRIORITY_NORMAL
+    job_id = create_job(
+        filepath,
+        filename,
+        hashes,
+        priority,
+        artist=meta["artist"],
+        title=meta["title"],
+    )
+    app.logger.info(f'File "{filename}" queued for encoding as job {job_id}')
+    return make_api_response(
+        202,
+        f'File "{filename}" uploaded and queued for encoding',
+        content={"job": job_id, "_links": job_links(job_id)},
+    )
+
+
 @api.resource("/upload")
 class UploadController(rest.Resource):
     @jwt_optional
     def post(self) -> Response:
-        if not app.config["PUBLIC_UPLOADS"]:
-            if not user_is_admin():
-                return make_api_response(403, "Uploading is not enabled")
+        if not can_upload():
+            return make_api_response(403, "Uploading is not enabled")
 
         if "song" not in request.files:
             app.logger.warning("No file part")
@@ -308,41 +405,126 @@ class UploadController(rest.Resource):
                 filepath.unlink(missing_ok=True)
                 return make_api_response(400, "File is not audio")
 
-            meta = get_metadata(filepath)
-            if not meta:
-                filepath.unlink(missing_ok=True)
-                return make_api_response(400, "File missing metadata")
-
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                try:
-                    future = executor.submit(
-                        encode_file, filepath, remove_original=True
-                    )
-                    final_path = future.result()
-                    song = insert_song(final_path)
-                    if song:
-                        app.logger.info(f'File "{filename}" uploaded')
-                        return make_api_response(
-                            200, f'File "{filename}" uploaded', content={"id": song.id}
-                        )
-                except EncodeError:
-                    # delete the original
-                    app.logger.exception(f"Encode error for {filepath}")
-                    filepath.unlink(missing_ok=True)
-                    return make_api_response(400, "File could not be encoded")
+            return queue_upload(filepath, filename, hash_song(filepath, audio=False))
         return make_api_response(400, "File could not be processed")
 
 
+def job_links(job_id: str) -> dict:
+    return {"_self": api.url_for(UploadJobController, job_id=job_id, _external=True)}
+
+
+@api.resource("/upload/<string:job_id>")
+class UploadJobController(rest.Resource):
+    def get(self, job_id: str) -> Response:
+        job = get_job(job_id)
+        if not job:
+            return make_api_response(404, "Upload job does not exist")
+        content = {
+            "_links": job_links(job_id),
+            "job": job_id,
+            "status": job["status"],
+            "filename": job["filename"],
+            "artist": job.get("artist"),
+            "title": job.get("title"),
+            "message": job.get("message"),
+            "id": job.get("song"),
+        }
+        if job["status"] == JobStatus.QUEUED:
+            content["position"] = queue_position(job_id)
+        return make_api_response(200, content=content)
+
+
+def session_content(session: UploadSession) -> dict:
+    return {
+        "_links": {
+            "_self": api.url_for(
+                UploadSessionController, session_id=session.id, _external=True
+            )
+        },
+        "session": session.id,
+        "filename": session.filename,
+        "size": session.size,
+        "offset": session.offset,
+    }
+
+
+@api.resource("/upload/chunked")
+class UploadSessionsController(rest.Resource):
+    @jwt_optional
+    @parser.use_args(
+        {
+            "filename": fields.Str(required=True),
+            "size": fields.Int(required=True, validate=validate.Range(min=1)),
+        },
+        locations=("json",),
+    )
+    def post(self, args: Dict[str, Any]) -> Response:
+        """
+        Starts a resumable upload, whose chunks are then sent to the returned session
+        """
+        if not can_upload():
+            return make_api_response(403, "Uploading is not enabled")
+        if not allowed_file_extension(Path(args["filename"])):
+            return make_api_response(400, "File could not be processed")
+        filename = secure_filename(args["filename"])
+        if not filename:
+            return make_api_response(400, "Filename not valid")
+        priority = PRIORITY_HIGH if user_is_admin() else PRIORITY_NORMAL
+        try:
+            session = UploadSession.create(filename, args["size"], priority)
+        except UploadError as e:
+            return make_api_response(e.status, e.message)
+        return make_api_response(201, content=session_content(session))
+
+
+@api.resource("/upload/chunked/<string:session_id>")
+class UploadSessionController(rest.Resource):
+    def get(self, session_id: str) -> Response:
+        """
+        Returns the number of bytes received, so an interrupted upload can resume
+        """
+        session = UploadSession.get(session_id)
+        if not session:
+            return make_api_response(404, "Upload session does not exist")
+        return make_api_response(200, content=session_content(session))
+
+    @jwt_optional
+    def patch(self, session_id: str) -> Response:
+        """
+        Appends the request body to the upload, starting at the `Upload-Offset` header.
+        The upload is queued for encoding once its last chunk is received.
+        """
+        if not can_upload():
+            return make_api_response(403, "Uploading is not enabled")
+        session = UploadSession.get(session_id)
+        if not session:
+            return make_api_response(404, "Upload session does not exist")
+        try:
+            offset = int(request.headers["Upload-Offset"])
+        except (KeyError, ValueError):
+            return make_api_response(400, "Missing or invalid `Upload-Offset` header")
+        try:
+            filepath = session.write(offset, request.stream)
+        except UploadError as e:
+            return make_api_response(e.status, e.message)
+        if not filepath:
+            return make_api_response(200, content=session_content(session))
+        hashes = hash_song(filepath, session.source_hash, audio=False)
+        return queue_upload(filepath, session.filename, hashes)
+
+
 @api.resource("/favourites")
 class FavouriteController(rest.Resource):
     @jwt_optional
     @parser.use_kwargs(FavouriteSchema())
-    def get(self, page: int, query: str, limit: int, user: Optional[str]) -> Response:
+    def get(
+        self, page: int, query: str, limit: int, sort: Optional[str], user: Optional[str]
+    ) -> Response:
         if user:
             user = User.get(username=user)
         elif current_user:
             user = current_user
-        return get_songs_response(self, page, query, limit, user)
+        return get_songs_response(self, page, query, limit, user, sort)
 
     @jwt_required
     @parser.use_args(SongBasicSchema())
@@ -369,5 +551,6 @@ class FavouriteController(rest.Resource):
 class SkipController(rest.Resource):
     @admin_required
     def post(self) -> Response:
-        redis_client.publish("skip", "True")
+        # publish the request time, so workers can measure skip latency
+        redis_client.publish("skip", str(time.time()))
         return make_api_response(200, "Successfully skipped current playing song")
@@ -0,0 +1,134 @@
+import logging
+import threading
+import time
+from pathlib import Path
+
+from radio import app
+from radio.common.jobs import JobStatus
+from radio.common.jobs import acquire_slot
+from radio.common.jobs import get_job
+from radio.common.jobs import next_job
+from radio.common.jobs import release_slot
+from radio.common.jobs import requeue_expired
+from radio.common.jobs import requeue_job
+from radio.common.jobs import update_job
+from radio.common.uploads import remove_expired_uploads
+from radio.common.utils import EncodeError
+from radio.common.utils import encode_file
+from radio.common.utils import find_duplicate
+from radio.common.utils import hash_song
+from radio.common.utils import insert_song
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s:%(process)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger("encoder")
+
+
+def process_job(job_id: str) -> None:
+    """
+    Encodes an uploaded file and adds it to the library
+    """
+    job = get_job(job_id)
+    if not job:
+        logger.warning(f"Job {job_id} no longer exists")
+        return
+    filepath = Path(job["path"])
+    update_job(job_id, JobStatus.ENCODING, started=time.time())
+    logger.info(f"Encoding {filepath} (job {job_id})")
+    try:
+        hashes = job["hashes"]
+        if app.config.get("DEDUPE_AUDIO_HASH", False) and "audio_hash" not in hashes:
+            # decoding the whole file is too slow to do while handling the upload
+            hashes = hash_song(filepath, hashes["source_hash"])
+            duplicate = find_duplicate(hashes)
+            if duplicate:
+                filepath.unlink(missing_ok=True)
+                message = f'"{duplicate.title}" by {duplicate.artist} already exists'
+                update_job(
+                    job_id, JobStatus.FAILED, message=message, song=str(duplicate.id)
+                )
+                return
+        final_path = encode_file(
+            filepath, remove_original=True, threads=app.config.get("UPLOAD_THREADS")
+        )
+        song = insert_song(final_path, hashes)
+    except EncodeError:
+        logger.exception(f"Encode error for {filepath}")
+        filepath.unlink(missing_ok=True)
+        update_job(job_id, JobStatus.FAILED, message="File could not be encoded")
+        return
+    except Exception:
+        logger.exception(f"Job {job_id} failed")
+        filepath.unlink(missing_ok=True)
+        update_job(job_id, JobStatus.FAILED, message="File could not be processed")
+        return
+    if not song:
+        update_job(job_id, JobStatus.FAILED, message="File missing metadata")
+        return
+    if song.filename != final_path.name:
+        message = f'"{song.title}" by {song.artist} already exists'
+        update_job(job_id, JobStatus.FAILED, message=message, song=str(song.id))
+        return
+    update_job(job_id, JobStatus.DONE, song=str(song.id), finished=time.time())
+    logger.info(f'File "{job["filename"]}" uploaded')
+
+
+def work(limit: int, lease: float) -> None:
+    """
+    Takes jobs from the queue and processes them, one at a time
+    """
+    while True:
+        try:
+            job_id = next_job()
+            if not job_id:
+                # pick up the jobs of encoders that died mid-job
+                requeue_expired(lease)
+                continue
+            if not acquire_slot(job_id, limit, lease):
+                # every slot is taken by other processes, let someone else try
+                requeue_job(job_id)
+                time.sleep(1)
+                continue
+            try:
+                process_job(job_id)
+            finally:
+                release_slot(job_id)
+        except Exception:
+            logger.exception("Encoder worker failed, retrying...")
+            time.sleep(1)
+
+
+def clean_uploads(interval: float) -> None:
+    """
+    Periodically removes the partial files of abandoned chunked uploads
+    """
+    while True:
+        try:
+            removed = remove_expired_uploads()
+            if removed:
+                logger.info(f"Removed {removed} expired partial uploads")
+        except Exception:
+            logger.exception("Failed to remove expired uploads")
+        time.sleep(interval)
+
+
+def run():
+    workers = app.config.get("UPLOAD_WORKERS", 2)
+    limit = app.config.get("UPLOAD_CONCURRENCY", workers)
+    lease = app.config.get("UPLOAD_ENCODE_TIMEOUT", 3600)
+    logger.info(f"Starting {workers} encoder workers (at most {limit} at once)")
+    threads = [
+        threading.Thread(target=work, args=(limit, lease), daemon=True)
+        for _ in range(workers)
+    ]
+    threading.Thread(target=clean_uploads, args=(3600,), daemon=True).start()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+if __name__ == "__main__":
+    run()
@@ -8,6 +8,7 @@ from pony.orm import Optional
 from pony.orm import PrimaryKey
 from pony.orm import Required
 from pony.orm import Set
+from pony.orm import db_session
 from pony.orm import set_sql_debug
 
 from radio import app
@@ -31,6 +32,21 @@ def define_entities(db):
         lastplayed: datetime = Optional(datetime)
         playcount: int = Required(int, default=0, unsigned=True)
         added: datetime = Required(datetime, default=datetime.utcnow)
+        # EBU R128 integrated loudness (LUFS) and true peak (dBTP)
+        loudness: float = Optional(float)
+        true_peak: float = Optional(float)
+        # audible section of the song, in seconds (excludes leading/trailing silence)
+        start_offset: float = Optional(float)
+        end_offset: float = Optional(float)
+        # file details, captured at ingest so listings never touch the filesystem
+        size: int = Optional(int, size=64)
+        bitrate: int = Optional(int, unsigned=True)
+        sample_rate: int = Optional(int, unsigned=True)
+        channels: int = Optional(int, unsigned=True)
+        mtime: float = Optional(float)
+        # SHA-256 of the file the song was added from, and of its decoded audio
+        source_hash: str = Optional(str, 64, index=True)
+        audio_hash: str = Optional(str, 64, index=True)
         favored_by = Set(User)
         queue = Set("Queue", hidden=True, cascade_delete=True)
 
@@ -41,10 +57,42 @@ def define_entities(db):
         added: datetime = Required(datetime, default=datetime.utcnow)
 
 
+def add_missing_columns(db: Database) -> None:
+    """
+    Adds columns for attributes introduced after a table was created.
+    Pony only creates missing tables, so existing databases need new
+    (optional) attributes added by hand, before their indexes are created.
+    """
+    provider = db.provider
+    with db_session:
+        connection = db.get_connection()
+        for entity in db.entities.values():
+            if entity._root_ is not entity:
+                continue
+            if not provider.table_exists(connection, entity._table_):
+                continue
+            table = provider.quote_name(entity._table_)
+            cursor = db.execute(f"SELECT * FROM {table} WHERE 1 = 0")
+            existing = {column[0].lower() for column in cursor.description}
+            for attr in entity._attrs_:
+                if attr.is_collection:
+                    continue
+                for column, converter in zip(attr.columns, attr.converters):
+                    if column.lower() in existing:
+                        continue
+                    column_type = converter.get_sql_type()
+                    db.execute(
+                        f"ALTER TABLE {table} "
+                        f"ADD COLUMN {provider.quote_name(column)} {column_type}"
+                    )
+
+
 def define_db(*args, **kwargs):
     set_sql_debug(app.debug, True)
     db = Database()
     db.bind(*args, **kwargs)
     define_entities(db)
-    db.generate_mapping(create_tables=True)
+    db.generate_mapping(check_tables=False)
+    add_missing_columns(db)
+    db.create_tables()
     return db
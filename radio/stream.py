@@ -1,22 +1,50 @@
-import base64
+import ctypes
 import logging
+import mmap
 import multiprocessing
+import os
 import queue
+import signal
 import subprocess
+import sys
+import threading
 import time
-import urllib.parse
-import urllib.request
-import urllib.response
-from http.client import responses
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import IO
+from typing import Generator
+from typing import List
+from typing import Optional
+from typing import Tuple
+from uuid import UUID
 
 import shouty
 
 from radio import app
 from radio import redis_client
-from radio.common.utils import get_metadata
-from radio.common.utils import next_song
+from radio.common.fanout import FanOut
+from radio.common.icecast import MetadataUpdater
+from radio.common.icecast import StatusSampler
+from radio.common.leader import LeaderLease
+from radio.common.leader import TrackFollower
+from radio.common.leader import publish_track
+from radio.common.metrics import StreamMetrics
+from radio.common.nowplaying import publish_listeners
+from radio.common.nowplaying import refresh_now_playing
+from radio.common.nowplaying import set_now_playing
+from radio.common.ringbuffer import RingBuffer
+from radio.common.schemas import Track
+from radio.common.transcode import PersistentTranscoder
+from radio.common.transcode import Rendition
+from radio.common.transcode import TranscodeCache
+from radio.common.transcode import get_renditions
+from radio.common.transcode import transcode_command
+from radio.common.transcode import trim_args
+from radio.common.utils import next_track
+from radio.common.utils import peek_track
+from radio.common.utils import play_track
+from radio.common.utils import upcoming_tracks
 
 logging.basicConfig(
     level=logging.NOTSET,
@@ -25,17 +53,17 @@ logging.basicConfig(
 logger = logging.getLogger("stream")
 
 
-def get_shout_params(config: dict, mp3: bool) -> dict:
+def get_shout_params(config: dict, rendition: Rendition) -> dict:
     audio_info = {"channels": "2"}
-    if mp3:
-        audio_info["bitrate"] = f"{config['TRANSCODE_BITRATE'] * 1000}"
+    if rendition.bitrate:
+        audio_info["bitrate"] = f"{rendition.bitrate * 1000}"
     return {
         "host": config["ICECAST_HOST"],
         "port": config["ICECAST_PORT"],
         "user": config["ICECAST_USER"],
         "password": config["ICECAST_PASSWORD"],
-        "format": shouty.Format.MP3 if mp3 else shouty.Format.OGG,
-        "mount": config["ICECAST_MOUNT"] + (".mp3" if mp3 else ".ogg"),
+        "format": shouty.Format.MP3 if rendition.is_mp3 else shouty.Format.OGG,
+        "mount": rendition.mount,
         "audio_info": audio_info,
         "name": config["ICECAST_NAME"],
         "description": config["ICECAST_DESCRIPTION"],
@@ -49,96 +77,297 @@ class Worker(multiprocessing.Process):
         self, group=None, target=None, name=None, args=(), kwargs=None, *, daemon=None
     ):
         super().__init__(group=group, target=target, name=name, daemon=daemon)
-        self.is_mp3 = args[1]
+        self.args = args
         self.config = args[0]
-        self.params = get_shout_params(self.config, self.is_mp3)
-        self.format = "MP3" if self.is_mp3 else "OGG"
-        self.queue = multiprocessing.JoinableQueue()
-        self.pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
-        self.pubsub.subscribe("skip")
-
-    def set_metadata(self, song_path: Path):
-        meta = get_metadata(song_path)
-        if meta:
-            data = urllib.parse.quote_plus(f"{meta['artist']} - {meta['title']}")
-            request = urllib.request.Request(
-                "http://{}:{}/admin/metadata?mount={}&mode=updinfo&song={}".format(
-                    self.params["host"], self.params["port"], self.params["mount"], data
-                )
-            )
-            base64string = base64.b64encode(
-                bytes(f"{self.params['user']}:{self.params['password']}", "ascii")
-            )
-            request.add_header(
-                "Authorization", "Basic %s" % base64string.decode("utf-8")
-            )
-            with urllib.request.urlopen(request) as resp:
-                code = resp.getcode()
-                logger.debug(f"Set metadata [{code} {responses[code]}]")
+        self.rendition: Rendition = args[1]
+        # ring buffer fed by the shared fan-out stage, if enabled
+        self.ring: Optional[RingBuffer] = args[2] if len(args) > 2 else None
+        self.is_mp3 = self.rendition.is_mp3
+        self.params = get_shout_params(self.config, self.rendition)
+        self.format = self.rendition.name
+        self.queue = multiprocessing.Queue()
+        # set once the worker is done with the last track it was given
+        self.done = multiprocessing.Event()
+        self.done.set()
+        # set once the worker starts streaming the last track it was given
+        self.streamed = multiprocessing.Event()
+        # lease on the mount when leader election is enabled, held in the worker
+        # process so only one node is connected to the mount at a time
+        self.mount_lease: Optional[LeaderLease] = None
+        cache = TranscodeCache.from_config(self.config)
+        self.cache = cache if cache and cache.rendition == self.rendition else None
+        # set by the skip listener thread, checked by the send loop
+        self.skipping = threading.Event()
+        self.source: Optional[IO] = None
+        self.ffmpeg: Optional[subprocess.Popen] = None
+        # transcoder pre-started for the next track: (song id, source, ffmpeg)
+        self.preroll_queue = multiprocessing.Queue()
+        self.prerolled: Optional[Tuple[UUID, IO, subprocess.Popen]] = None
+        # long-lived encoder fed track after track, started in the worker process
+        self.transcoder: Optional[PersistentTranscoder] = None
+        self.preroll_lock = threading.Lock()
+        self.metrics = StreamMetrics(self.format, self.config.get("STREAM_NODE_NAME"))
+        self.metadata = MetadataUpdater(self.params)
+        # whether shouty accepts memoryviews, falls back to copying if not
+        self.send_buffers = True
+        # time the last byte of the previous track was sent
+        self.last_sent: Optional[float] = None
+        # time the pending skip was requested
+        self.skip_requested: Optional[float] = None
 
-    def put_queue(self, song_path: Path):
-        self.queue.put(song_path)
+    def set_metadata(self, track: Track):
+        self.metadata.update(track.artist, track.title)
+
+    def put_queue(self, track: Track):
+        self.done.clear()
+        self.streamed.clear()
+        self.queue.put(track)
 
     def join_queue(self):
-        self.queue.join()
-
-    def should_skip(self):
-        message = self.pubsub.get_message()
-        if message:
-            # parse skip message to see if we should skip or not
-            # "False" == do not skip, anything else will skip.
-            should_skip = message.get("data", "False").decode()
-            if should_skip == "True":
-                logger.debug(f"{self.format}: Redis message: <{message!r}>...")
-                return True
+        """
+        Waits for the worker to finish the last track it was given.
+        Returns early if the worker process died, so one dead worker never
+        stalls the others.
+        """
+        while not self.done.wait(1.0):
+            if not self.is_alive():
+                logger.error(f"{self.format}: Worker died with code {self.exitcode}")
+                return
+
+    def listen_skip(self):
+        """
+        Listens for skip messages on a dedicated connection, flagging the current
+        track to be skipped so the send loop never has to poll Redis itself.
+        """
+        while True:
+            try:
+                pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe("skip")
+                for message in pubsub.listen():
+                    # "False" == do not skip, anything else will skip.
+                    data = message.get("data", b"False").decode()
+                    if data == "False":
+                        self.skipping.clear()
+                        continue
+                    logger.debug(f"{self.format}: Redis message: <{message!r}>...")
+                    # skips are published with the time they were requested
+                    try:
+                        self.skip_requested = float(data)
+                    except ValueError:
+                        self.skip_requested = time.time()
+                    self.skipping.set()
+                    self.interrupt()
+            except Exception:
+                logger.exception(f"{self.format}: Skip listener failed, retrying...")
+                time.sleep(1)
+
+    def interrupt(self):
+        """
+        Wakes the send loop if it is blocked waiting on its source
+        """
+        if self.ring and self.source is self.ring:
+            self.ring.close()
+        if self.transcoder:
+            self.transcoder.stop_feed()
+        ffmpeg = self.ffmpeg
+        if ffmpeg:
+            ffmpeg.terminate()
+
+    def should_skip(self) -> bool:
+        if self.skipping.is_set():
+            self.skipping.clear()
+            self.metrics.inc("skips_total")
+            if self.skip_requested:
+                latency = max(time.time() - self.skip_requested, 0)
+                self.metrics.observe("skip_latency_seconds", latency)
+            return True
         return False
 
-    def stream(self, connection, song_path: Path):
-        logger.info(f'{self.format}: Streaming "{song_path}"...')
+    def preroll(self, track: Track):
+        self.preroll_queue.put(track)
+
+    def listen_preroll(self):
+        """
+        Pre-starts the transcoder for each track the scheduler says is up next
+        """
+        while True:
+            track = self.preroll_queue.get()
+            if self.ring or self.transcoder:
+                continue
+            if self.rendition.passthrough and not trim_args(track):
+                continue
+            if self.cache and self.cache.get(track):
+                continue
+            src, ffmpeg = self.start_transcoder(track)
+            with self.preroll_lock:
+                stale, self.prerolled = self.prerolled, (track.id, src, ffmpeg)
+            if stale:
+                self.discard_preroll(stale)
+            logger.debug(f"{self.format}: Pre-rolled ffmpeg for next track.")
+
+    @staticmethod
+    def discard_preroll(prerolled: Tuple[UUID, IO, subprocess.Popen]):
+        _, src, ffmpeg = prerolled
+        src.close()
+        ffmpeg.terminate()
+
+    def start_transcoder(self, track: Track) -> Tuple[IO, subprocess.Popen]:
+        with track.path.open("rb") as song:
+            ffmpeg = subprocess.Popen(
+                transcode_command(self.config, self.rendition, track=track),
+                stdin=song,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+            )
+        logger.debug(f"{self.format}: Started ffmpeg.")
+        return ffmpeg.stdout, ffmpeg
+
+    def open_source(self, track: Track) -> Tuple[IO, Optional[subprocess.Popen]]:
+        """
+        Opens the byte source to stream for the given track.
+        Fan-out workers read the shared decoder's output, and workers with a
+        persistent transcoder feed it the track. Stored files are sent as is,
+        unless they are trimmed like the transcoded renditions. Otherwise
+        transcoding workers prefer a pre-rolled ffmpeg, then a cached transcode,
+        falling back to starting a live ffmpeg.
+
+        :return: readable source, and the ffmpeg process feeding it (if any)
+        """
+        if self.ring:
+            return self.ring, None
+        if self.rendition.passthrough and not trim_args(track):
+            return track.path.open("rb"), None
+        if self.transcoder:
+            return self.transcoder.feed(track), None
+        with self.preroll_lock:
+            prerolled, self.prerolled = self.prerolled, None
+        if prerolled and prerolled[0] == track.id:
+            logger.debug(f"{self.format}: Using pre-rolled ffmpeg.")
+            return prerolled[1], prerolled[2]
+        if prerolled:
+            self.discard_preroll(prerolled)
+        if self.cache:
+            cached = self.cache.get(track)
+            if cached:
+                logger.debug(f"{self.format}: Transcode cache hit.")
+                return cached.open("rb"), None
+            logger.debug(f"{self.format}: Transcode cache miss.")
+        return self.start_transcoder(track)
+
+    def chunk_size(self, track: Track) -> int:
+        """
+        Sizes chunks to cover `STREAM_CHUNK_SECONDS` of audio at the track's bitrate,
+        so fewer, larger sends are made per song.
+        """
+        if self.rendition.bitrate:
+            bytes_per_second = self.rendition.bitrate * 125
+        else:
+            try:
+                bytes_per_second = track.path.stat().st_size / max(track.length, 1)
+            except OSError:
+                bytes_per_second = 0
+        size = int(bytes_per_second * self.config.get("STREAM_CHUNK_SECONDS", 0.5))
+        return min(max(size, 4096), 64 * 1024)
+
+    def chunks(self, track: Track, src: IO) -> Generator[memoryview, None, None]:
+        """
+        Yields the chunks to send for a track, without allocating per chunk.
+        Stored Ogg files are memory mapped and split on Ogg page boundaries,
+        everything else is read into a single reused buffer.
+        Each chunk is only valid until the next one is requested.
+        """
+        chunk_size = self.chunk_size(track)
+        if self.rendition.passthrough and not self.ring:
+            try:
+                mapped = mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):
+                mapped = None
+            if mapped:
+                view = memoryview(mapped)
+                try:
+                    pos = 0
+                    while pos < len(mapped):
+                        end = mapped.find(b"OggS", pos + chunk_size)
+                        if end == -1:
+                            end = len(mapped)
+                        chunk = view[pos:end]
+                        try:
+                            yield chunk
+                        finally:
+                            chunk.release()
+                        pos = end
+                finally:
+                    view.release()
+                    mapped.close()
+                return
+        buffer = bytearray(chunk_size)
+        view = memoryview(buffer)
+        while True:
+            size = src.readinto(buffer)
+            if not size:
+                return
+            chunk = view[:size]
+            try:
+                yield chunk
+            finally:
+                chunk.release()
+
+    def send(self, connection, chunk: memoryview):
+        """
+        Sends a chunk without copying it, if shouty accepts buffers
+        """
+        if self.send_buffers:
+            try:
+                connection.send(chunk)
+                return
+            except (TypeError, ctypes.ArgumentError):
+                logger.debug(f"{self.format}: Buffers not supported, copying chunks")
+                self.send_buffers = False
+        connection.send(chunk.tobytes())
+
+    def stream(self, connection, track: Track):
+        logger.info(f'{self.format}: Streaming "{track.path}"...')
         start_time = time.time()
         if self.is_mp3:
             # set title for mp3 streams
             # ogg is automatically set from file by icecast
-            self.set_metadata(song_path)
-        with song_path.open("rb") as song:
-            ffmpeg = None
-            src: IO = song
-            if self.is_mp3:
-                ffmpeg = subprocess.Popen(
-                    [
-                        self.config["PATH_FFMPEG_BINARY"],
-                        "-i",
-                        "-",
-                        "-f",
-                        "mp3",
-                        "-ab",
-                        f'{self.config["TRANSCODE_BITRATE"]}k',
-                        "-",
-                    ],
-                    stdin=song,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.DEVNULL,
-                )
-                logger.debug(f"{self.format}: Started ffmpeg.")
-                src = ffmpeg.stdout
-            chunk_size = 4096
-            sent_bytes = 0
-            if src:
-                while True:
-                    # check if we need to skip
-                    if self.should_skip():
-                        break
-                    chunk = src.read(chunk_size)
-                    if not chunk:
-                        logger.debug(f"{self.format}: Buffer is empty, breaking...")
-                        break
-                    connection.send(chunk)
-                    connection.sync()
-                    sent_bytes += len(chunk)
-                src.close()
-            if ffmpeg:
-                ffmpeg.terminate()
-                logger.debug(f"{self.format}: Stopped ffmpeg.")
+            self.set_metadata(track)
+        src, ffmpeg = self.open_source(track)
+        self.source, self.ffmpeg = src, ffmpeg
+        sent_bytes = 0
+        metrics = self.metrics
+        opened = time.perf_counter()
+        if src:
+            chunks = self.chunks(track, src)
+            for chunk in chunks:
+                # check if we need to skip
+                if self.should_skip():
+                    break
+                before_send = time.perf_counter()
+                if not sent_bytes:
+                    if ffmpeg:
+                        metrics.observe("ffmpeg_startup_seconds", before_send - opened)
+                    if self.last_sent:
+                        gap = before_send - self.last_sent
+                        metrics.observe("track_gap_seconds", gap)
+                self.send(connection, chunk)
+                before_sync = time.perf_counter()
+                connection.sync()
+                after_sync = time.perf_counter()
+                metrics.observe("send_seconds", before_sync - before_send)
+                metrics.observe("sync_seconds", after_sync - before_sync)
+                metrics.sent(len(chunk))
+                sent_bytes += len(chunk)
+            else:
+                logger.debug(f"{self.format}: Buffer is empty, breaking...")
+            chunks.close()
+            src.close()
+        self.last_sent = time.perf_counter()
+        metrics.inc("tracks_total")
+        self.source, self.ffmpeg = None, None
+        if ffmpeg:
+            ffmpeg.terminate()
+            logger.debug(f"{self.format}: Stopped ffmpeg.")
         finish_time = time.time()
         kbps = int(sent_bytes * 0.008 / (finish_time - start_time))
         duration = int(finish_time - start_time)
@@ -146,36 +375,350 @@ class Worker(multiprocessing.Process):
             f"{self.format}: Sent {sent_bytes} bytes in {duration} seconds ({kbps} kbps)"
         )
 
+    def holds_mount(self) -> bool:
+        return self.mount_lease is None or self.mount_lease.is_leader
+
+    @staticmethod
+    def is_stale(track: Track) -> bool:
+        """
+        :returns: True if the track would already have finished playing
+        """
+        return bool(track.started) and track.started + track.length < time.time()
+
+    def take_track(self) -> Optional[Track]:
+        """
+        Waits for the next queued track. Tracks are marked done and dropped if
+        they are stale, or if another node is streaming to the mount.
+
+        :return: track to stream, or None if there is none
+        """
+        try:
+            track = self.queue.get(block=True, timeout=5.0)
+        except queue.Empty:
+            return None
+        if not self.holds_mount():
+            self.done.set()
+            return None
+        # tracks that finished while we were disconnected are dropped
+        if self.is_stale(track):
+            logger.warning(f'{self.format}: Dropping stale track "{track.path}"')
+            self.done.set()
+            return None
+        return track
+
+    def play(self, connection, track: Track) -> None:
+        """
+        Streams a track over the given connection, then marks it done.
+        If sending fails the track is left pending, to be retried once reconnected.
+        """
+        self.streamed.set()
+        try:
+            self.stream(connection=connection, track=track)
+        except Exception:
+            # a retry opens a new source, stop the one of this attempt
+            if self.ffmpeg:
+                self.ffmpeg.terminate()
+            self.source, self.ffmpeg = None, None
+            raise
+        self.done.set()
+
+    def connection_failed(self, delay: float, track: Track) -> Optional[Track]:
+        """
+        Waits before reconnecting after the source connection failed
+
+        :param delay: time to wait, in seconds
+        :param track: track that was being streamed or connected for
+        :return: the track to retry once reconnected, or None if it was dropped
+        """
+        logger.exception(
+            f"{self.format}: Source connection failed, reconnecting in {delay}s"
+        )
+        self.metrics.inc("reconnects_total")
+        time.sleep(delay)
+        if self.is_stale(track) or not self.holds_mount():
+            logger.warning(f'{self.format}: Dropping track "{track.path}"')
+            # let the scheduler move on
+            self.done.set()
+            return None
+        return track
+
+    def run_persistent(self):
+        """
+        Keeps a single source connection open for as long as the mount is held.
+        Reconnects (with exponential backoff) when the connection fails, and
+        before sending once it sat idle for longer than Icecast waits for a source.
+        """
+        delay = self.config.get("ICECAST_RECONNECT_DELAY", 1)
+        max_delay = self.config.get("ICECAST_RECONNECT_MAX_DELAY", 60)
+        idle_timeout = self.config.get("ICECAST_IDLE_TIMEOUT", 4)
+        backoff = delay
+        track = None
+        while True:
+            # standbys only connect once they hold the mount and get a track
+            track = track or self.take_track()
+            if not track:
+                continue
+            try:
+                with shouty.connect(**self.params) as connection:
+                    logger.info(f"{self.format}: Connected to {self.params['mount']}")
+                    backoff = delay
+                    while track:
+                        self.play(connection, track)
+                        track = None
+                        idle_since = time.monotonic()
+                        while not track and self.holds_mount():
+                            track = self.take_track()
+                        if track and time.monotonic() - idle_since > idle_timeout:
+                            logger.info(f"{self.format}: Connection idle, reconnecting")
+                            break
+                    if not track:
+                        logger.info(f"{self.format}: Lost the mount, disconnecting")
+            except Exception:
+                track = self.connection_failed(backoff, track)
+                backoff = min(backoff * 2, max_delay)
+
+    def run_per_track(self):
+        """
+        Opens a new source connection for each track
+        """
+        track = None
+        while True:
+            track = track or self.take_track()
+            if not track:
+                continue
+            try:
+                with shouty.connect(**self.params) as connection:
+                    self.play(connection, track)
+                track = None
+            except Exception:
+                delay = self.config.get("ICECAST_RECONNECT_DELAY", 1)
+                track = self.connection_failed(delay, track)
+
     def run(self):
+        self.mount_lease = LeaderLease.from_config(
+            self.config, key=f"stream:mount:{self.rendition.mount}"
+        )
+        if self.mount_lease:
+            self.mount_lease.start()
+        threading.Thread(target=self.listen_skip, daemon=True).start()
+        self.metadata.start()
+        self.metrics.start()
+        if (
+            self.config.get("STREAM_PERSISTENT_TRANSCODER", False)
+            and not self.ring
+            and not self.rendition.passthrough
+        ):
+            self.transcoder = PersistentTranscoder(self.config, self.rendition)
+            self.transcoder.ensure_running()
+        threading.Thread(target=self.listen_preroll, daemon=True).start()
+        try:
+            if self.config.get("ICECAST_PERSISTENT_CONNECTION", False):
+                self.run_persistent()
+            else:
+                self.run_per_track()
+        finally:
+            if self.mount_lease:
+                self.mount_lease.release()
+
+
+def revive(workers: List[Worker]) -> None:
+    """
+    Replaces workers whose process died, in place so their owners see the new ones
+    """
+    for i, worker in enumerate(workers):
+        if not worker.is_alive():
+            logger.error(f"{worker.format}: Restarting dead worker")
+            workers[i] = Worker(args=worker.args)
+            workers[i].start()
+
+
+def wait_for_track(track: Track) -> None:
+    """
+    Waits until the given track would have finished playing, or is skipped.
+    Paces a leader that is not streaming to any mount itself, so it schedules
+    tracks as they are played by the nodes that are.
+    """
+    pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe("skip")
+    try:
         while True:
-            with shouty.connect(**self.params) as connection:
-                try:
-                    song_path = self.queue.get(block=True, timeout=5.0)
-                except queue.Empty:
-                    continue
-                self.stream(connection=connection, song_path=song_path)
-                self.queue.task_done()
+            remaining = track.started + track.length - time.time()
+            if remaining <= 0:
+                return
+            message = pubsub.get_message(timeout=min(remaining, 1.0))
+            if message and message["data"] != b"False":
+                logger.info(f'Skipped "{track.path}" on another node')
+                return
+    finally:
+        pubsub.close()
 
 
-def run():
-    workers = [Worker(args=(app.config, False))]
-    if app.config["ICECAST_TRANSCODE"]:
-        workers.append(Worker(args=(app.config, True)))
-    for worker in workers:
-        worker.start()
+def warm_file(path: Path):
+    """
+    Asks the kernel to read the given file into the page cache ahead of time
+    """
+    try:
+        with path.open("rb") as file:
+            os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+    except (OSError, AttributeError):
+        logger.debug(f'Could not warm "{path}"')
+
+
+class Prefetcher:
+    """
+    Resolves the next track while the current one is still playing.
+    The next file is read into the page cache and any transcoders are pre-started,
+    so the transition between tracks is a single hand-off.
+
+    :param workers: workers to pre-roll the next track on
+    :param fanout: shared fan-out stage to pre-roll, if enabled
+    """
+
+    def __init__(self, workers: List[Worker], fanout: Optional[FanOut] = None):
+        self.workers = workers
+        self.fanout = fanout
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.upcoming: Optional[Future] = None
+
+    def prefetch(self):
+        """
+        Starts preparing the next track in the background
+        """
+        self.upcoming = self.executor.submit(self.prepare)
+
+    def prepare(self) -> Optional[Track]:
+        track = peek_track()
+        # peeking tops the queue up, so the snapshot's queue is stale now
+        refresh_now_playing()
+        if track:
+            warm_file(track.path)
+            if self.fanout:
+                self.fanout.prepare(track)
+            for worker in self.workers:
+                worker.preroll(track)
+            logger.info(f'Prepared next file "{track.path}"')
+        return track
+
+    def next(self) -> Optional[Track]:
+        """
+        Gets the track to play now, marking it as played.
+        Uses the prepared track if its queue entry still exists.
+
+        :return: track to play
+        """
+        track = None
+        if self.upcoming:
+            try:
+                track = self.upcoming.result()
+            except Exception:
+                logger.exception("Failed to prepare next track")
+            self.upcoming = None
+        if track and play_track(track):
+            return track
+        return next_track()
+
+
+def schedule(
+    workers: List[Worker],
+    prefetcher: Prefetcher,
+    fanout: Optional[FanOut],
+    cache: Optional[TranscodeCache],
+    lease: Optional[LeaderLease],
+    follower: Optional[TrackFollower],
+):
+    """
+    Hands each track to the workers, and waits for them to finish it.
+    Tracks are picked by this node if it leads, or received from the leader.
+    """
     while True:
-        song = next_song()
-        if song is None:
-            time.sleep(5)
-            logger.warning("No song to play, waiting...")
-            continue
-        logger.info(f'Streaming file "{song}"')
+        revive(workers)
+        # the lease is confirmed before advancing the queue, in case this node
+        # was paused long enough for another to take over
+        leading = lease is None or (lease.is_leader and lease.confirm())
+        if leading:
+            track = prefetcher.next()
+            if track is None:
+                time.sleep(5)
+                logger.warning("No song to play, waiting...")
+                continue
+            track.started = time.time()
+            if lease:
+                track.fence = lease.token
+                publish_track(track)
+        else:
+            track = follower.next()
+            if track is None:
+                continue
+            warm_file(track.path)
+        logger.info(f'Streaming file "{track.path}"')
+        if fanout:
+            fanout.start(track)
         for worker in workers:
-            worker.put_queue(song)
+            worker.put_queue(track)
+        if leading:
+            # workers are idle until now, so the track starts streaming right away
+            set_now_playing(track)
+            prefetcher.prefetch()
+            if cache:
+                cache.prefetch(
+                    upcoming_tracks(app.config.get("TRANSCODE_CACHE_PREFETCH", 3))
+                )
         for worker in workers:
             worker.join_queue()
-        redis_client.publish("skip", "False")
-        logger.info("Reset skip flag.")
+        if leading and not any(worker.streamed.is_set() for worker in workers):
+            # another node holds our mounts, wait for it to play the track
+            wait_for_track(track)
+        if fanout:
+            fanout.stop()
+        if leading:
+            redis_client.publish("skip", "False")
+            logger.info("Reset skip flag.")
+
+
+def run():
+    renditions = get_renditions(app.config)
+    # nodes may serve only some of the mounts
+    served = app.config.get("STREAM_NODE_RENDITIONS")
+    if served:
+        renditions = [rendition for rendition in renditions if rendition.name in served]
+    fanout = None
+    if app.config.get("STREAM_FANOUT", False):
+        ring_size = app.config.get("STREAM_RING_SIZE", 1024 * 1024)
+        outputs = [(rendition, RingBuffer(ring_size)) for rendition in renditions]
+        fanout = FanOut(app.config, outputs)
+        workers = [Worker(args=(app.config, *output)) for output in outputs]
+    else:
+        workers = [Worker(args=(app.config, rendition)) for rendition in renditions]
+    # exit cleanly when stopped so leases are released, workers inherit this
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    for worker in workers:
+        worker.start()
+    cache = TranscodeCache.from_config(app.config)
+    prefetcher = Prefetcher(workers, fanout)
+    lease = LeaderLease.from_config(app.config)
+    follower = None
+    if lease:
+        follower = TrackFollower()
+        lease.start()
+    # listener counts for the API, pushed to clients when they change
+    StatusSampler.from_config(
+        app.config,
+        on_sample=lambda status: publish_listeners(status["listeners"]),
+        active=lambda: lease is None or lease.is_leader,
+    ).start()
+    try:
+        schedule(workers, prefetcher, fanout, cache, lease, follower)
+    finally:
+        # let a standby take over right away instead of waiting for the lease to expire
+        if lease:
+            lease.release()
+        for worker in workers:
+            worker.terminate()
+        if fanout:
+            for worker in workers:
+                worker.join()
+            # shared memory outlives the process unless it is unlinked
+            fanout.close()
 
 
 if __name__ == "__main__":
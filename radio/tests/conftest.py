@@ -1,5 +1,6 @@
 from typing import Callable
 
+import fakeredis
 import pytest
 from _pytest.monkeypatch import MonkeyPatch
 from flask.testing import FlaskClient
@@ -7,6 +8,7 @@ from pony.orm import Database
 from pony.orm import db_session
 
 from radio import app
+from radio import redis_client
 from radio.models import define_db
 
 
@@ -70,3 +72,10 @@ def client() -> FlaskClient:
 
     with app.test_client() as client:
         yield client
+
+
+@pytest.fixture
+def redis(monkeypatch) -> fakeredis.FakeStrictRedis:
+    fake = fakeredis.FakeStrictRedis()
+    monkeypatch.setattr(redis_client, "_redis_client", fake)
+    return fake
@@ -0,0 +1,43 @@
+import io
+import json
+import urllib.request
+from urllib.error import URLError
+
+from radio.common import icecast
+from radio.common.transcode import Rendition
+
+OGG = Rendition("OGG", "ogg", "/radio", None)
+MP3 = Rendition("MP3", "mp3", "/radio.mp3", 192)
+
+
+def test_fetch_status(monkeypatch):
+    monkeypatch.setattr(icecast, "get_renditions", lambda config: [OGG, MP3])
+
+    def status(sources):
+        body = json.dumps({"icestats": {"source": sources}}).encode()
+        return lambda url, timeout: io.BytesIO(body)
+
+    ogg = {"listenurl": "http://icecast:8000/radio", "listeners": 3}
+    mp3 = {"listenurl": "http://icecast:8000/radio.mp3", "listeners": 2}
+    other = {"listenurl": "http://icecast:8000/other", "listeners": 10}
+    monkeypatch.setattr(urllib.request, "urlopen", status([ogg, mp3, other]))
+    result = icecast.fetch_status(timeout=1)
+    assert result["listeners"] == 5
+    assert result["mounts"] == {
+        "/radio": {"online": True, "listeners": 3},
+        "/radio.mp3": {"online": True, "listeners": 2},
+    }
+
+    # a single source is not wrapped in a list
+    monkeypatch.setattr(urllib.request, "urlopen", status(ogg))
+    result = icecast.fetch_status(timeout=1)
+    assert result["listeners"] == 3
+    assert result["mounts"]["/radio.mp3"] == {"online": False, "listeners": 0}
+
+    def error(url, timeout):
+        raise URLError(url)
+
+    monkeypatch.setattr(urllib.request, "urlopen", error)
+    result = icecast.fetch_status(timeout=1)
+    assert result["listeners"] == 0
+    assert not any(mount["online"] for mount in result["mounts"].values())
@@ -0,0 +1,139 @@
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+from radio import encoder
+from radio.common import jobs
+from radio.common.jobs import JobStatus
+from radio.common.utils import EncodeError
+
+
+def make_job(tmp_path: Path, name: str = "song.mp3", **kwargs) -> str:
+    path = tmp_path / name
+    path.touch()
+    return jobs.create_job(path, name, {"source_hash": name}, **kwargs)
+
+
+def test_job_priority(redis, tmp_path):
+    low = make_job(tmp_path, priority=jobs.PRIORITY_LOW)
+    first = make_job(tmp_path)
+    second = make_job(tmp_path)
+    high = make_job(tmp_path, priority=jobs.PRIORITY_HIGH)
+    assert jobs.queue_position(high) == 0
+    assert jobs.queue_position(low) == 3
+    # higher priorities first, then oldest first
+    assert [jobs.next_job(timeout=1) for _ in range(4)] == [high, first, second, low]
+    assert jobs.next_job(timeout=1) is None
+
+
+def test_get_job(redis, tmp_path):
+    job_id = make_job(tmp_path, artist="Artist")
+    job = jobs.get_job(job_id)
+    assert job["status"] == JobStatus.QUEUED
+    assert job["hashes"] == {"source_hash": "song.mp3"}
+    assert job["artist"] == "Artist"
+    assert jobs.get_job("missing") is None
+
+
+def test_acquire_slot(redis, tmp_path):
+    assert jobs.acquire_slot("a", limit=2, lease=60)
+    assert jobs.acquire_slot("b", limit=2, lease=60)
+    assert not jobs.acquire_slot("c", limit=2, lease=60)
+    jobs.requeue_job("c")
+    jobs.release_slot("a")
+    assert jobs.acquire_slot("c", limit=2, lease=60)
+
+
+def test_requeue_job(redis, tmp_path):
+    first = make_job(tmp_path)
+    second = make_job(tmp_path)
+    assert jobs.next_job(timeout=1) == first
+    # taken jobs are running before any slot is acquired
+    assert redis.zscore(jobs.RUNNING_KEY, first) is not None
+    jobs.requeue_job(first)
+    assert redis.zscore(jobs.RUNNING_KEY, first) is None
+    # keeps its place in the queue
+    assert jobs.next_job(timeout=1) == first
+    assert jobs.next_job(timeout=1) == second
+
+
+def test_requeue_expired(redis, tmp_path):
+    job_id = make_job(tmp_path)
+    assert jobs.next_job(timeout=1) == job_id
+    assert jobs.acquire_slot(job_id, limit=1, lease=60)
+    jobs.update_job(job_id, JobStatus.ENCODING)
+    assert jobs.requeue_expired(lease=60) == []
+    # the encoder died, so its slot is never released
+    redis.zadd(jobs.RUNNING_KEY, {job_id: time.time() - 120})
+    assert jobs.requeue_expired(lease=60) == [job_id]
+    assert jobs.get_job(job_id)["status"] == JobStatus.QUEUED
+    assert jobs.next_job(timeout=1) == job_id
+    # the slot is taken again by whoever picked the job up
+    assert not jobs.acquire_slot("other", limit=1, lease=60)
+    jobs.requeue_job("other")
+    jobs.release_slot(job_id)
+    assert jobs.acquire_slot("other", limit=1, lease=60)
+
+
+def test_process_job(redis, tmp_path, monkeypatch):
+    final = tmp_path / "song.ogg"
+    monkeypatch.setattr(encoder, "encode_file", lambda path, **kwargs: final)
+    song = SimpleNamespace(id="id", filename=final.name, artist="A", title="T")
+    inserted = []
+
+    def insert_song(path, hashes):
+        inserted.append((path, hashes))
+        return song
+
+    monkeypatch.setattr(encoder, "insert_song", insert_song)
+    job_id = make_job(tmp_path)
+    encoder.process_job(job_id)
+    job = jobs.get_job(job_id)
+    assert job["status"] == JobStatus.DONE
+    assert job["song"] == "id"
+    assert inserted == [(final, {"source_hash": "song.mp3"})]
+
+    # the song already existed
+    song.filename = "other.ogg"
+    job_id = make_job(tmp_path)
+    encoder.process_job(job_id)
+    job = jobs.get_job(job_id)
+    assert job["status"] == JobStatus.FAILED
+    assert job["message"] == '"T" by A already exists'
+
+    # no metadata
+    monkeypatch.setattr(encoder, "insert_song", lambda path, hashes: None)
+    job_id = make_job(tmp_path)
+    encoder.process_job(job_id)
+    assert jobs.get_job(job_id)["status"] == JobStatus.FAILED
+
+
+def test_process_job_encode_error(redis, tmp_path, monkeypatch):
+    def encode_file(path, **kwargs):
+        raise EncodeError()
+
+    monkeypatch.setattr(encoder, "encode_file", encode_file)
+    job_id = make_job(tmp_path)
+    encoder.process_job(job_id)
+    job = jobs.get_job(job_id)
+    assert job["status"] == JobStatus.FAILED
+    assert job["message"] == "File could not be encoded"
+    assert not (tmp_path / "song.mp3").exists()
+
+
+def test_process_job_audio_duplicate(redis, tmp_path, monkeypatch):
+    monkeypatch.setitem(encoder.app.config, "DEDUPE_AUDIO_HASH", True)
+    hashes = {"source_hash": "song.mp3", "audio_hash": "audio"}
+    monkeypatch.setattr(encoder, "hash_song", lambda path, source_hash: hashes)
+    song = SimpleNamespace(id="id", artist="A", title="T")
+    monkeypatch.setattr(
+        encoder, "find_duplicate", lambda found: song if found == hashes else None
+    )
+    job_id = make_job(tmp_path)
+    encoder.process_job(job_id)
+    job = jobs.get_job(job_id)
+    # found before spending an encode on it
+    assert job["status"] == JobStatus.FAILED
+    assert job["message"] == '"T" by A already exists'
+    assert job["song"] == "id"
+    assert not (tmp_path / "song.mp3").exists()
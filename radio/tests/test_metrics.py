@@ -0,0 +1,25 @@
+from radio.common.metrics import METRICS_KEY
+from radio.common.metrics import StreamMetrics
+from radio.common.metrics import render_metrics
+
+
+def test_metrics_per_node(redis):
+    # two nodes streaming the same rendition
+    for node, size in (("a", 100), ("b", 50)):
+        metrics = StreamMetrics("OGG", node)
+        metrics.sent(size)
+        metrics.flush()
+    rendered = render_metrics()
+    assert 'radio_stream_bytes_sent_total{node="a",worker="OGG"} 100.0' in rendered
+    assert 'radio_stream_bytes_sent_total{node="b",worker="OGG"} 50.0' in rendered
+
+
+def test_metrics_expire(redis):
+    metrics = StreamMetrics("OGG", "a", ttl=30)
+    metrics.inc("tracks_total")
+    metrics.flush()
+    key = METRICS_KEY.format("a", "OGG")
+    assert 0 < redis.ttl(key) <= 30
+    # only what was added since the last flush is sent
+    metrics.flush()
+    assert redis.hget(key, "tracks_total") == b"1"
@@ -0,0 +1,37 @@
+import sqlite3
+
+from pony.orm import Database
+from pony.orm import db_session
+
+from radio.models import add_missing_columns
+from radio.models import define_entities
+
+
+def test_add_missing_columns(tmp_path):
+    path = tmp_path / "old.sqlite"
+    # a Song table from before loudness and file details were stored
+    with sqlite3.connect(path) as connection:
+        connection.execute(
+            "CREATE TABLE Song (id UUID PRIMARY KEY, filename VARCHAR(256) UNIQUE, "
+            "artist TEXT, title TEXT, length INTEGER, lastplayed DATETIME, "
+            "playcount INTEGER DEFAULT 0, added DATETIME)"
+        )
+    db = Database(provider="sqlite", filename=str(path))
+    define_entities(db)
+    db.generate_mapping(check_tables=False)
+    add_missing_columns(db)
+    # indexes of the new columns are created with the missing tables
+    db.create_tables()
+    with sqlite3.connect(path) as connection:
+        columns = {row[1] for row in connection.execute("PRAGMA table_info(Song)")}
+        indexes = {row[1] for row in connection.execute("PRAGMA index_list(Song)")}
+    assert {"loudness", "start_offset", "size", "source_hash"} <= columns
+    assert "idx_song__source_hash" in indexes
+
+    with db_session:
+        song = db.Song(filename="a.ogg", artist="A", title="T", length=1, size=2**40)
+    with db_session:
+        assert db.Song[song.id].size == 2**40
+    # nothing is left to add
+    add_missing_columns(db)
+    db.disconnect()
@@ -0,0 +1,118 @@
+import json
+from datetime import datetime
+from datetime import timedelta
+
+import arrow
+
+from radio import app
+from radio.common import nowplaying
+from radio.common.nowplaying import NowPlayingBroadcaster
+from radio.common.utils import make_track
+from radio.controllers import now_playing
+
+
+def snapshot(**fields) -> dict:
+    end_time = arrow.now().timestamp + 60
+    return {"end_time": end_time, "artist": "A", "title": "T", **fields}
+
+
+def played(db, songs) -> None:
+    # songs[0] was played last, each song right after the next
+    now = datetime.now()
+    for i, song in enumerate(songs):
+        song.lastplayed = now - timedelta(seconds=100 * (i + 1))
+    db.commit()
+
+
+def test_build_now_playing(db, redis, make_test_song, make_db_test_songs):
+    songs = make_db_test_songs(4)
+    played(db, songs)
+    track = make_track(songs[0])
+    track.started = arrow.now().shift(seconds=-10).timestamp
+
+    result = nowplaying.build_now_playing(track)
+    assert result["id"] == str(songs[0].id)
+    assert (result["start_time"], result["end_time"]) == (
+        track.started,
+        track.started + songs[0].length,
+    )
+    # the current song is not listed as played before itself
+    assert [entry["id"] for entry in result["lp"]] == [str(s.id) for s in songs[1:]]
+    assert result["lp"][0]["timestamp"] == track.started
+    assert result["total_songs"] == 4
+
+    # the track does not need to have been marked as played yet
+    song = db.Song(**make_test_song(filename="new.ogg", i=10))
+    db.commit()
+    track = make_track(song)
+    track.started = arrow.now().timestamp
+    result = nowplaying.build_now_playing(track)
+    assert result["id"] == str(track.id)
+    assert len(result["lp"]) == 4
+
+
+def test_build_now_playing_fallback(db, redis, make_db_test_songs):
+    assert nowplaying.build_now_playing()["lp"] == []
+    songs = make_db_test_songs(3)
+    played(db, songs)
+
+    # without a track, the song played last is the current one
+    result = nowplaying.build_now_playing()
+    assert result["id"] == str(songs[0].id)
+    assert result["start_time"] == arrow.get(songs[0].lastplayed).timestamp
+    assert [entry["id"] for entry in result["lp"]] == [str(s.id) for s in songs[1:]]
+
+    # a track that has not started yet is ignored
+    result = nowplaying.build_now_playing(make_track(songs[2]))
+    assert result["id"] == str(songs[0].id)
+
+
+def test_store_now_playing(redis):
+    pubsub = redis.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(nowplaying.UPDATES_CHANNEL)
+
+    def published():
+        # the first call only reads the subscription confirmation
+        for _ in range(2):
+            message = pubsub.get_message(timeout=0.1)
+            if message:
+                return json.loads(message["data"])
+        return None
+
+    first = snapshot()
+    nowplaying.store_now_playing(first)
+    assert json.loads(redis.get(nowplaying.SNAPSHOT_KEY)) == first
+    # the first snapshot is published whole
+    assert published() == first
+
+    nowplaying.store_now_playing(dict(first, title="Other"))
+    # then only the fields that changed
+    assert published() == {"title": "Other"}
+    nowplaying.store_now_playing(dict(first, title="Other"))
+    assert published() is None
+    assert 0 < redis.ttl(nowplaying.SNAPSHOT_KEY) <= 60 + nowplaying.SNAPSHOT_GRACE
+
+
+def test_np_events(monkeypatch):
+    broadcaster = NowPlayingBroadcaster(backlog=2)
+    # updates are broadcast by the test instead of Redis
+    monkeypatch.setattr(broadcaster, "listen", lambda: None)
+    monkeypatch.setattr(now_playing, "broadcaster", broadcaster)
+    monkeypatch.setattr(now_playing, "np", lambda: {"title": "T", "listeners": 1})
+    monkeypatch.setitem(app.config, "NP_EVENTS_KEEPALIVE", 0.01)
+
+    events = now_playing.np_events()
+    assert next(events).startswith("retry: ")
+    assert next(events) == now_playing.event("np", {"title": "T", "listeners": 1})
+    assert next(events) == ": keepalive\n\n"
+
+    broadcaster.broadcast({"listeners": 2})
+    name, data, _ = next(events).split("\n", 2)
+    assert name == "event: update"
+    assert json.loads(data[len("data: ") :])["listeners"] == 2
+
+    # a client that falls behind is dropped, ending its stream
+    for listeners in range(3, 6):
+        broadcaster.broadcast({"listeners": listeners})
+    assert not broadcaster.clients
+    assert len(list(events)) == 2
@@ -0,0 +1,87 @@
+import pytest
+
+from radio.common.queue import DatabaseQueue
+from radio.common.queue import RedisQueue
+
+
+@pytest.fixture(params=["database", "redis"])
+def song_queue(request, db, redis):
+    return DatabaseQueue() if request.param == "database" else RedisQueue()
+
+
+def test_queue_order(song_queue, make_db_test_songs):
+    songs = make_db_test_songs(4)
+    song_queue.add([songs[0].id, songs[1].id])
+    song_queue.add([songs[2].id], requested=True)
+    song_queue.add([songs[3].id])
+
+    entries = song_queue.entries()
+    # played in the order they were queued
+    assert [entry.song_id for entry in entries] == [song.id for song in songs]
+    assert [entry.requested for entry in entries] == [False, False, True, False]
+    assert [entry.song_id for entry in song_queue.entries(2)] == [
+        songs[0].id,
+        songs[1].id,
+    ]
+    assert song_queue.first() == entries[0]
+    assert song_queue.get(entries[2].id) == entries[2]
+    assert song_queue.counts() == (3, 1)
+    assert len(song_queue) == 4
+
+    assert song_queue.remove(entries[0].id)
+    assert not song_queue.remove(entries[0].id)
+    assert song_queue.first() == entries[1]
+
+    song_queue.clear()
+    assert song_queue.entries() == []
+    assert song_queue.first() is None
+
+
+def test_queue_requested(song_queue, make_db_test_songs):
+    songs = make_db_test_songs(2)
+    song_queue.add([songs[0].id])
+    song_queue.add([songs[1].id], requested=True)
+    song_queue.add([songs[1].id])
+    requested = song_queue.find(songs[1].id)
+    # the first entry of a song is found
+    assert requested.requested
+    assert song_queue.counts() == (2, 1)
+    song_queue.remove(requested.id)
+    assert song_queue.counts() == (2, 0)
+    assert not song_queue.find(songs[1].id).requested
+
+
+def test_queue_find_many(song_queue, make_db_test_songs):
+    songs = make_db_test_songs(3)
+    song_queue.add([songs[0].id, songs[1].id])
+    song_queue.add([songs[1].id], requested=True)
+    found = song_queue.find_many(song.id for song in songs)
+    assert set(found) == {songs[0].id, songs[1].id}
+    assert found[songs[1].id] == song_queue.find(songs[1].id)
+    assert not found[songs[1].id].requested
+
+
+def test_queue_remove_song(song_queue, make_db_test_songs):
+    songs = make_db_test_songs(2)
+    song_queue.add([songs[0].id, songs[1].id, songs[0].id])
+    song_queue.add([songs[0].id], requested=True)
+    song_queue.remove_song(songs[0].id)
+    assert [entry.song_id for entry in song_queue.entries()] == [songs[1].id]
+    assert song_queue.find(songs[0].id) is None
+    assert song_queue.counts() == (1, 0)
+
+
+def test_redis_queue_insert(redis, db, make_db_test_songs):
+    songs = make_db_test_songs(2)
+    source = DatabaseQueue()
+    source.add([songs[0].id])
+    source.add([songs[1].id], requested=True)
+    target = RedisQueue()
+    for entry in source.entries():
+        target.insert(entry.id, entry.song_id, entry.requested, entry.added)
+    # IDs, flags and times are kept, to the second
+    for moved, entry in zip(target.entries(), source.entries()):
+        assert moved.id == entry.id
+        assert moved.song_id == entry.song_id
+        assert moved.requested == entry.requested
+        assert abs((moved.added - entry.added).total_seconds()) < 1e-3
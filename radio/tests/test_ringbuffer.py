@@ -0,0 +1,53 @@
+import os
+import threading
+from multiprocessing import shared_memory
+
+import pytest
+
+from radio.common.fanout import FanOut
+from radio.common.ringbuffer import RingBuffer
+
+
+def test_ring_buffer_wraps():
+    ring = RingBuffer(1000)
+    data = os.urandom(10000)
+    received = bytearray()
+
+    def consume():
+        while True:
+            chunk = ring.read(333)
+            if not chunk:
+                break
+            received.extend(chunk)
+
+    consumer = threading.Thread(target=consume)
+    consumer.start()
+    view = memoryview(data)
+    for i in range(0, len(data), 777):
+        assert ring.write(view[i : i + 777])
+    ring.finish()
+    consumer.join()
+    assert bytes(received) == data
+    ring.unlink()
+
+
+def test_ring_buffer_close():
+    ring = RingBuffer(16)
+    assert ring.write(b"0" * 16)
+    ring.close()
+    # writer is not blocked once the reader has gone away
+    assert not ring.write(b"1")
+    ring.reset()
+    assert ring.write(b"2")
+    ring.finish()
+    assert ring.read(16) == b"2"
+    assert ring.read(16) == b""
+    ring.unlink()
+
+
+def test_fanout_close_unlinks_rings():
+    ring = RingBuffer(16)
+    fanout = FanOut({}, [(None, ring)])
+    fanout.close()
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=ring._shm.name)
@@ -0,0 +1,48 @@
+from collections import Counter
+
+from radio.common.sampling import SongIndex
+
+
+def test_song_index_weights():
+    index = SongIndex()
+    index.build([("a", 0), ("b", 3), ("c", 2)])
+    # max plays is 3, so weights are 4, 1 and 2
+    counts = Counter(index.sample(7000))
+    assert set(counts) == {"a", "b", "c"}
+    assert counts["a"] > counts["c"] > counts["b"]
+
+
+def test_song_index_updates():
+    index = SongIndex()
+    index.build([("a", 0)])
+    for song_id in "bcdef":
+        index.add(song_id)
+    assert len(index) == 6
+    index.remove("a")
+    index.remove("c")
+    assert len(index) == 4
+    assert "a" not in index
+    assert set(index.sample(500)) == {"b", "d", "e", "f"}
+    index.increment("b")
+    assert index.max_plays == 1
+    assert index.plays_tree_total() == 1
+    assert index.active_tree_total() == 4
+
+
+def test_song_index_empty():
+    assert SongIndex().sample(5) == []
+
+
+def test_song_index_compacts():
+    index = SongIndex()
+    index.build([(i, i) for i in range(10)])
+    for i in range(5):
+        index.remove(i)
+    # half the slots are empty, one more removal compacts them away
+    assert len(index.ids) == 10
+    index.remove(5)
+    assert index.ids == [6, 7, 8, 9]
+    assert index.playcount(9) == 9
+    assert index.plays_tree_total() == 30
+    assert set(index.sample(500)) == {6, 7, 8, 9}
+
@@ -0,0 +1,76 @@
+import threading
+import time
+import uuid
+
+import pytest
+
+from radio import app
+from radio.common.schemas import Track
+from radio.common.transcode import get_renditions
+
+stream = pytest.importorskip("radio.stream")
+
+
+class Lease:
+    def __init__(self, held: bool):
+        self.is_leader = held
+        self.token = 1
+
+    def confirm(self) -> bool:
+        return self.is_leader
+
+
+class Finished(Exception):
+    pass
+
+
+class Prefetcher:
+    def __init__(self, tracks):
+        self.tracks = tracks
+
+    def next(self):
+        if not self.tracks:
+            raise Finished
+        return self.tracks.pop(0)
+
+    def prefetch(self):
+        pass
+
+
+def test_leader_without_mount_waits_for_track(redis, monkeypatch, tmp_path):
+    worker = stream.Worker(args=(app.config, get_renditions(app.config)[0]))
+    # another node streams to the mount
+    worker.mount_lease = Lease(held=False)
+    monkeypatch.setattr(stream, "revive", lambda workers: None)
+    monkeypatch.setattr(stream, "set_now_playing", lambda track: None)
+    track = Track(uuid.uuid4(), tmp_path / "a.ogg", "Artist", "Title", length=1)
+    # what the worker process would do with the track
+    threading.Thread(target=worker.take_track, daemon=True).start()
+
+    started = time.time()
+    with pytest.raises(Finished):
+        stream.schedule([worker], Prefetcher([track]), None, None, Lease(True), None)
+    assert not worker.streamed.is_set()
+    # the next track is only scheduled once this one would have played
+    assert time.time() - started >= track.length
+
+
+def test_failed_track_is_retried(redis, monkeypatch, tmp_path):
+    worker = stream.Worker(args=(app.config, get_renditions(app.config)[0]))
+    track = Track(uuid.uuid4(), tmp_path / "a.ogg", "Artist", "Title", length=100)
+    track.started = time.time()
+    worker.put_queue(track)
+
+    def disconnected(connection, track):
+        raise OSError("Connection reset")
+
+    monkeypatch.setattr(worker, "stream", disconnected)
+    with pytest.raises(OSError):
+        worker.play(None, track)
+    assert worker.connection_failed(0, track) is track
+    assert not worker.done.is_set()
+
+    # tracks that finished in the meantime are dropped
+    track.started -= track.length
+    assert worker.connection_failed(0, track) is None
+    assert worker.done.is_set()
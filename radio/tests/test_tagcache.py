@@ -0,0 +1,40 @@
+import os
+
+from radio.common import tagcache
+
+
+def test_metadata_cache(redis, make_test_song, make_tmp_file):
+    tmp_file = make_tmp_file("file.ogg")
+    tmp_file.write_bytes(b"tags")
+    meta = make_test_song(path=tmp_file)
+    assert tagcache.get_cached_metadata(tmp_file) is None
+    tagcache.cache_metadata(tmp_file, meta)
+    assert tagcache.get_cached_metadata(tmp_file) == meta
+    assert tagcache.get_cached_metadata(tmp_file) == meta
+    assert tagcache.get_cache_counters() == {"hits": 2, "misses": 1}
+
+    # rewriting the file invalidates its entry
+    tmp_file.write_bytes(b"new tags")
+    assert tagcache.get_cached_metadata(tmp_file) is None
+    tagcache.cache_metadata(tmp_file, meta)
+    assert tagcache.get_cached_metadata(tmp_file) == meta
+    assert tagcache.get_cache_counters() == {"hits": 3, "misses": 2}
+
+    # so does touching it, even if the size is unchanged
+    stat = tmp_file.stat()
+    os.utime(tmp_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    assert tagcache.get_cached_metadata(tmp_file) is None
+    # misses are counted once the tags are read from the file again
+    tagcache.cache_metadata(tmp_file, meta)
+    assert tagcache.get_cache_counters() == {"hits": 3, "misses": 3}
+
+    # missing files are never looked up
+    tmp_file.unlink()
+    assert tagcache.get_cached_metadata(tmp_file) is None
+    assert tagcache.get_cache_counters() == {"hits": 3, "misses": 3}
+
+
+def test_metadata_cache_counters(redis):
+    assert tagcache.get_cache_counters() == {"hits": 0, "misses": 0}
+    tagcache.count_miss()
+    assert tagcache.get_cache_counters() == {"hits": 0, "misses": 1}
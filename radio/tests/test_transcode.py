@@ -0,0 +1,130 @@
+import io
+import os
+import subprocess
+from pathlib import Path
+from types import SimpleNamespace
+from uuid import uuid4
+
+from radio.common.schemas import Track
+from radio.common.transcode import PersistentTranscoder
+from radio.common.transcode import Rendition
+from radio.common.transcode import TranscodeCache
+from radio.common.transcode import TranscoderFeed
+from radio.common.transcode import transcode_command
+
+MP3 = Rendition("MP3", "mp3", "/radio.mp3", 192)
+
+
+def make_track(tmp_path: Path) -> Track:
+    return Track(
+        id=uuid4(), path=tmp_path / "song.ogg", artist="Artist", title="Title", length=1
+    )
+
+
+def test_transcode_command(tmp_path):
+    config = {"PATH_FFMPEG_BINARY": "ffmpeg"}
+    track = make_track(tmp_path)
+    track.length, track.start, track.end, track.gain = 100, 1.5, 95.0, -3.0
+    command = transcode_command(config, MP3, track=track)
+    assert command[:5] == ["ffmpeg", "-ss", "1.500", "-to", "95.000"]
+    assert "volume=-3.00dB" in command
+    # stream copies are trimmed the same, but not filtered
+    ogg = Rendition("OGG", "vorbis", "/radio.ogg")
+    command = transcode_command(config, ogg, track=track)
+    assert command[:5] == ["ffmpeg", "-ss", "1.500", "-to", "95.000"]
+    assert "-af" not in command
+
+
+def test_transcode_cache_fill(tmp_path, monkeypatch):
+    cache = TranscodeCache(tmp_path / "cache", max_size=1024, rendition=MP3)
+    track = make_track(tmp_path)
+    assert cache.get(track) is None
+
+    def ffmpeg_success(args, **kwargs):
+        Path(args[-1]).write_bytes(b"0" * 100)
+        return 0
+
+    monkeypatch.setattr(subprocess, "call", ffmpeg_success)
+    cached = cache.fill(track)
+    assert cached == cache.key(track)
+    assert cache.get(track) == cached
+    # no temporary files are left behind
+    assert list(cache.path.iterdir()) == [cached]
+
+    monkeypatch.setattr(subprocess, "call", lambda args, **kwargs: 1)
+    assert cache.fill(make_track(tmp_path)) is None
+
+
+def test_transcode_cache_evict(tmp_path):
+    cache = TranscodeCache(tmp_path, max_size=250, rendition=MP3)
+    tracks = [make_track(tmp_path) for _ in range(3)]
+    for i, track in enumerate(tracks):
+        cache.key(track).write_bytes(b"0" * 100)
+        os.utime(cache.key(track), (i, i))
+    # using the oldest entry makes it the most recent
+    cache.get(tracks[0])
+    cache.evict()
+    assert cache.get(tracks[0]) is not None
+    assert cache.get(tracks[1]) is None
+    assert cache.get(tracks[2]) is not None
+
+
+def test_transcode_cache_key_levelling(tmp_path):
+    cache = TranscodeCache(tmp_path, max_size=1024, rendition=MP3)
+    track = make_track(tmp_path)
+    plain = cache.key(track)
+    track.gain = -3.0
+    levelled = cache.key(track)
+    assert levelled != plain
+    # re-analysing the song changes its entry again
+    track.start = 0.5
+    assert cache.key(track) not in (plain, levelled)
+
+
+class FakeDecoder:
+    def __init__(self, data: bytes):
+        self.stdout = io.BytesIO(data)
+
+    def wait(self):
+        return 0
+
+
+class PartialWriter:
+    """Accepts at most `limit` bytes per write, like an unbuffered pipe may"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.data = bytearray()
+
+    def write(self, data) -> int:
+        written = bytes(data[: self.limit])
+        self.data += written
+        return len(written)
+
+
+def make_transcoder(writer: PartialWriter) -> PersistentTranscoder:
+    transcoder = PersistentTranscoder({}, MP3)
+    transcoder.encoder = SimpleNamespace(stdin=writer)
+    return transcoder
+
+
+def test_persistent_transcoder_pump():
+    writer = PartialWriter(limit=1000)
+    transcoder = make_transcoder(writer)
+    feed = TranscoderFeed(transcoder)
+    data = os.urandom(200 * 1024)
+    transcoder.pump(FakeDecoder(data), feed)
+    assert bytes(writer.data) == data
+    assert feed.done.is_set()
+
+
+def test_persistent_transcoder_pump_stopped():
+    writer = PartialWriter(limit=1000)
+    transcoder = make_transcoder(writer)
+    feed = TranscoderFeed(transcoder)
+    transcoder.current = feed
+    # a skipped track stops feeding the encoder straight away
+    transcoder.stop_feed()
+    transcoder.pump(FakeDecoder(os.urandom(1024)), feed)
+    assert not writer.data
+    assert feed.done.is_set()
@@ -0,0 +1,107 @@
+import hashlib
+import io
+
+import pytest
+
+from radio import app
+from radio.common import uploads
+from radio.common.jobs import PRIORITY_NORMAL
+from radio.common.uploads import UploadError
+from radio.common.uploads import UploadSession
+
+# recognised as audio/mpeg by filetype
+AUDIO = b"ID3" + bytes(range(256)) * 40
+
+
+@pytest.fixture
+def encode_path(tmp_path, monkeypatch):
+    monkeypatch.setitem(app.config, "PATH_ENCODE", tmp_path)
+    monkeypatch.setitem(app.config, "FILE_SIZE_LIMIT", 1024 * 1024)
+    monkeypatch.setattr(uploads, "hashers", {})
+    return tmp_path
+
+
+def start(size: int = len(AUDIO)) -> UploadSession:
+    return UploadSession.create("song.mp3", size, PRIORITY_NORMAL)
+
+
+def test_upload_in_chunks(redis, encode_path):
+    session = start()
+    assert session.write(0, io.BytesIO(AUDIO[:1000])) is None
+    session = UploadSession.get(session.id)
+    assert session.offset == 1000
+    path = session.write(1000, io.BytesIO(AUDIO[1000:]))
+    assert path == encode_path / "song.mp3"
+    assert path.read_bytes() == AUDIO
+    assert session.source_hash == hashlib.sha256(AUDIO).hexdigest()
+    # the session is gone once finished
+    assert UploadSession.get(session.id) is None
+    assert not list(encode_path.glob("*.part"))
+
+
+def test_upload_wrong_offset(redis, encode_path):
+    session = start()
+    session.write(0, io.BytesIO(AUDIO[:1000]))
+    with pytest.raises(UploadError) as e:
+        session.write(500, io.BytesIO(AUDIO[500:]))
+    assert e.value.status == 409
+    # a session finished by another request cannot be written to
+    session.write(1000, io.BytesIO(AUDIO[1000:]))
+    with pytest.raises(UploadError) as e:
+        session.write(len(AUDIO), io.BytesIO(b""))
+    assert e.value.status == 404
+
+
+def test_upload_locked(redis, encode_path):
+    session = start()
+    redis.set(f"{session.key}:lock", 0)
+    with pytest.raises(UploadError) as e:
+        session.write(0, io.BytesIO(AUDIO))
+    assert e.value.status == 409
+
+
+def test_upload_size_limits(redis, encode_path):
+    with pytest.raises(UploadError) as e:
+        start(size=2 * 1024 * 1024)
+    assert e.value.status == 413
+    with pytest.raises(UploadError) as e:
+        start(size=0)
+    assert e.value.status == 400
+
+    session = start(size=1000)
+    with pytest.raises(UploadError) as e:
+        session.write(0, io.BytesIO(AUDIO))
+    assert e.value.status == 413
+
+
+def test_upload_not_audio(redis, encode_path):
+    session = start()
+    with pytest.raises(UploadError) as e:
+        session.write(0, io.BytesIO(b"x" * 1000))
+    assert e.value.status == 400
+    # the upload is discarded
+    assert UploadSession.get(session.id) is None
+    assert not session.path.exists()
+
+
+def test_upload_hash_across_processes(redis, encode_path):
+    session = start()
+    session.write(0, io.BytesIO(AUDIO[:1000]))
+    stale = uploads.hashers[session.id]
+    # another process receives the next chunk
+    uploads.hashers.clear()
+    UploadSession.get(session.id).write(1000, io.BytesIO(AUDIO[1000:2000]))
+    # and this one the last, with the hasher it kept from the first
+    uploads.hashers[session.id] = stale
+    session = UploadSession.get(session.id)
+    session.write(2000, io.BytesIO(AUDIO[2000:]))
+    assert session.source_hash == hashlib.sha256(AUDIO).hexdigest()
+
+
+def test_remove_expired_uploads(redis, encode_path):
+    session = start()
+    expired = start()
+    redis.delete(expired.key)
+    assert uploads.remove_expired_uploads() == 1
+    assert session.path.exists()
+    assert not expired.path.exists()
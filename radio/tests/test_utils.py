@@ -1,6 +1,6 @@
+import hashlib
 import subprocess
 from pathlib import Path
-from urllib.error import URLError
 from uuid import uuid4
 
 import arrow
@@ -22,14 +22,12 @@ from radio.common import utils
 
 # from radio.common.utils import (
 #     make_api_response,
-#     get_folder_size,
 #     allowed_file_extension,
 #     encode_file,
 #     EncodeError,
 #     get_metadata,
 #     humanize_lastplayed,
 #     when_requestable,
-#     parse_status,
 #     filter_default_webargs,
 #     get_nonexistant_path,
 #     get_self_links,
@@ -66,37 +64,6 @@ def test_make_api_response(client):
         )
 
 
-def test_get_folder_size(tmp_path):
-    def create_files(path, files, size):
-        # create some test files
-        for i in range(files):
-            tmp = path.joinpath(f"testfile-{i}.file")
-            with tmp.open("wb") as f:
-                f.seek(size - 1)
-                f.write(b"0")
-
-    size = 1024 * 1024
-    files = 4
-
-    # no files in directory yet
-    assert utils.get_folder_size(tmp_path) == 0
-    # create some test files
-    create_files(tmp_path, files, size)
-    # test cache is working
-    assert utils.get_folder_size(tmp_path) == 0
-    # clear the LRU cache
-    utils.get_folder_size.cache_clear()
-    assert utils.get_folder_size(tmp_path) == size * files
-
-    # create some test files in subdirectory (tests recursive)
-    sub = tmp_path / "sub"
-    sub.mkdir()
-    create_files(sub, files, size)
-    assert utils.get_folder_size(sub) == size * files
-    utils.get_folder_size.cache_clear()
-    assert utils.get_folder_size(tmp_path) == size * files * 2
-
-
 def test_allowed_file_extension(client):
     with app.app_context():
         app.config["ALLOWED_EXTENSIONS"] = ["mp3", "ogg", "flac", "wav", "m4a"]
@@ -139,6 +106,7 @@ def test_encode_file(tmp_path, monkeypatch):
 
 
 def test_get_metadata(monkeypatch, make_test_song, make_tmp_file):
+    monkeypatch.setitem(app.config, "METADATA_CACHE", False)
     tmp_file = make_tmp_file("file.mp3")
 
     class FDict(dict):
@@ -159,6 +127,19 @@ def test_get_metadata(monkeypatch, make_test_song, make_tmp_file):
     assert not tmp_file.exists()
 
 
+def test_get_metadata_cached(monkeypatch, make_test_song, make_tmp_file):
+    tmp_file = make_tmp_file("file.mp3")
+    cached = make_test_song(path=tmp_file)
+    monkeypatch.setattr(utils, "get_cached_metadata", lambda file: cached)
+
+    def mutagen_metadata(*args, **kwargs):
+        raise AssertionError("file should not be opened")
+
+    monkeypatch.setattr(mutagen, "File", mutagen_metadata)
+    assert utils.get_metadata(tmp_file) == cached
+    assert tmp_file.exists()
+
+
 def test_humanize_lastplayed():
     assert utils.humanize_lastplayed(0) == "Never before"
     past = arrow.now().shift(minutes=-30)
@@ -174,83 +155,6 @@ def test_when_requestable():
     assert utils.when_requestable(now.shift(minutes=-40).timestamp, 100) < now
 
 
-def test_parse_status(monkeypatch):
-    class DummyFile:
-        def __init__(self, body):
-            self.body = body
-
-        def read(self):
-            return self.body
-
-    def error(url):
-        raise URLError(url)
-
-    result_default = {"Online": False, "Current Song": ""}
-    result_success = {
-        "Online": True,
-        "Current Song": "Song Title",
-        "Stream Title": "Radio",
-        "Stream Description": "Description",
-        "Content Type": "audio/mpeg",
-        "Current Listeners": "10",
-        "Peak Listeners": "100",
-        "Stream Genre": "Genre",
-    }
-    url = "http://icecast/endpoint.mp3"
-
-    xml = """<?xml version="1.0" encoding="UTF-8"?>
-<playlist xmlns="http://xspf.org/ns/0/" version="1">
-  {}
-</playlist>
-"""
-
-    response_valid = xml.format(
-        f"""
-<title/>
-<creator/>
-  <trackList>
-    <track>
-      <location>{url}</location>
-      <title>{result_success["Current Song"]}</title>
-      <annotation>Stream Title: {result_success["Stream Title"]}
-Stream Description: {result_success["Stream Description"]}
-Content Type:{result_success["Content Type"]}
-Current Listeners: {result_success["Current Listeners"]}
-Peak Listeners: {result_success["Peak Listeners"]}
-Stream Genre: {result_success["Stream Genre"]}
-Unpaired Example</annotation>
-      <info>{url}</info>
-    </track>
-  </trackList>
-"""
-    )
-
-    monkeypatch.setattr("urllib.request.urlopen", DummyFile)
-    success = utils.parse_status(response_valid)
-    assert success == result_success
-
-    monkeypatch.setattr("urllib.request.urlopen", error)
-    assert utils.parse_status(url) == result_default
-
-    response_missing_tracklist = xml.format("")
-    response_missing_track = xml.format("<trackList/>")
-    response_empty_track = xml.format("<trackList><track/></trackList>")
-    response_missing_annontation = xml.format(
-        f"<trackList><track><title>Song Title</title></track></trackList>"
-    )
-
-    monkeypatch.setattr("urllib.request.urlopen", DummyFile)
-    for resp in [
-        "",  # invalid XML
-        response_missing_tracklist,
-        response_missing_track,
-        response_empty_track,
-        response_missing_annontation,
-    ]:
-        fail = utils.parse_status(resp)
-        assert fail == result_default
-
-
 def test_filter_default_webargs():
     class TestSchema(Schema):
         int = fields.Int(missing=1)
@@ -311,6 +215,19 @@ def test_sample_songs_weighted(make_db_test_songs):
     assert len(utils.sample_songs_weighted(100)) == 10
 
 
+def test_song_index_sees_other_plays(db, make_db_test_songs):
+    songs = make_db_test_songs(3)
+    index = utils.get_song_index()
+    # played by another stream node while this one was not leading
+    songs[0].playcount = 5
+    db.commit()
+    assert utils.get_song_index().playcount(songs[0].id) == 5
+    # plays made here are applied without a rebuild
+    fingerprint = index.fingerprint
+    utils.update_fingerprint(plays=1)
+    assert index.fingerprint == (fingerprint[0], fingerprint[1], 6)
+
+
 def test_insert_song(db, monkeypatch, make_test_song, make_tmp_file):
     tmp_file = make_tmp_file("file.ogg")
 
@@ -322,11 +239,15 @@ def test_insert_song(db, monkeypatch, make_test_song, make_tmp_file):
     inserted_song = utils.insert_song(tmp_file)
     database_song = db.Song.get(filename=tmp_file.name)
     assert inserted_song == database_song
+    # the same file added again (e.g. by the watcher) is kept
+    assert utils.insert_song(tmp_file) == database_song
+    assert tmp_file.exists()
     # duplicate
-    inserted_song = utils.insert_song(tmp_file)
+    dupe_file = make_tmp_file("dupe.ogg")
+    inserted_song = utils.insert_song(dupe_file)
     assert inserted_song == database_song
     # duplicate is removed
-    assert not tmp_file.exists()
+    assert not dupe_file.exists()
 
     # file with no metadata is removed
     tmp_file.touch()
@@ -335,6 +256,21 @@ def test_insert_song(db, monkeypatch, make_test_song, make_tmp_file):
     assert not tmp_file.exists()
 
 
+def test_insert_song_concurrently(db, monkeypatch, make_test_song, make_tmp_file):
+    tmp_file = make_tmp_file("file.ogg")
+    monkeypatch.setattr(
+        utils, "get_metadata", lambda file: make_test_song(path=tmp_file)
+    )
+    # another process commits the file while this one analyses it
+    other = db.Song(**make_test_song(filename=tmp_file.name, i=1))
+    db.commit()
+    # forget it, as only the database of the other process would know about it
+    db.rollback()
+    assert utils.insert_song(tmp_file).id == other.id
+    assert tmp_file.exists()
+    assert db.Song.select().count() == 1
+
+
 def test_insert_queue(db, make_db_test_songs):
     songs = make_db_test_songs(10)
     utils.insert_queue(songs)
@@ -370,22 +306,20 @@ def test_reload_songs(db, tmp_path, monkeypatch, make_test_song):
 
     monkeypatch.setattr(
         utils,
-        "insert_song",
-        lambda filename: mock_insert_song(filename, int(filename.stem[-1])),
+        "read_song",
+        lambda filename: make_test_song(path=filename, i=int(filename.stem[-1])),
     )
 
     files = []
     start = 0
-    # loop is done to hit the following branches on the first run:
-    #   - insert all files if no songs in database
-    #   - generate queue if it is empty
-    # subsequent run makes sure we hit songs_to_add/remove
+    # first run adds every file and generates the queue,
+    # subsequent run makes sure only new files are added
     while start < 10:
         for i in range(start, start + 5):
             file = tmp_path / f"file-{i}.ogg"
             file.touch()
             files.append(file)
-        utils.reload_songs(tmp_path)
+        utils.reload_songs(tmp_path, workers=1)
         songs = select(song.filename for song in db.Song)
         for file in files:
             assert file.name in songs
@@ -394,7 +328,19 @@ def test_reload_songs(db, tmp_path, monkeypatch, make_test_song):
     # test removing songs from database that are not on the file system
     for i in range(start, start + 5):
         mock_insert_song(tmp_path / f"file-{i}.ogg", i)
-    utils.reload_songs(tmp_path)
+    report = utils.reload_songs(tmp_path, workers=1)
+    assert report.removed == 5
+    assert count(db.Song.select()) == 10
+
+    # changed files are read again and updated in place
+    song = db.Song.get(filename="file-0.ogg")
+    (tmp_path / "file-0.ogg").write_bytes(b"changed")
+    monkeypatch.setattr(
+        utils, "read_song", lambda filename: make_test_song(path=filename, i=20)
+    )
+    report = utils.reload_songs(tmp_path, workers=1)
+    assert (report.added, report.updated, report.removed) == (0, 1, 0)
+    assert song.title == "Title-20"
 
 
 def test_next_song(db, make_db_test_songs):
@@ -436,3 +382,141 @@ def test_queue_status(db, make_db_test_songs):
     utils.insert_queue([song])
     status = utils.queue_status(song)
     assert status.type is utils.QueueType.NORMAL
+
+
+def test_upcoming_tracks(db, make_db_test_songs):
+    assert utils.upcoming_tracks() == []
+    make_db_test_songs(10)
+    utils.generate_queue()
+    first = db.Queue.select().sort_by(db.Queue.id).first()
+
+    tracks = utils.upcoming_tracks(3)
+    assert len(tracks) == 3
+    assert tracks[0].id == first.song.id
+    # queue is not modified
+    assert db.Queue.exists(id=first.id)
+    assert utils.next_track().id == tracks[0].id
+
+
+def test_make_track_trim(db, monkeypatch, make_db_test_songs):
+    song = make_db_test_songs(1)[0]
+    song.start_offset, song.end_offset = 1.5, 95.0
+    monkeypatch.setitem(app.config, "LOUDNESS_NORMALISE", False)
+    track = utils.make_track(song)
+    assert (track.start, track.end) == (0.0, None)
+    monkeypatch.setitem(app.config, "LOUDNESS_NORMALISE", True)
+    track = utils.make_track(song)
+    assert (track.start, track.end) == (1.5, 95.0)
+
+
+def test_peek_track(db, make_db_test_songs):
+    assert utils.peek_track() is None
+    make_db_test_songs(10)
+    track = utils.peek_track()
+    entry = db.Queue[track.queue_id]
+    song = entry.song
+    # peeking does not modify the queue
+    assert utils.peek_track() == track
+    assert song.playcount == 0
+
+    assert utils.play_track(track)
+    assert not db.Queue.exists(id=track.queue_id)
+    assert song.playcount == 1
+    assert song.lastplayed is not None
+    # already played
+    assert not utils.play_track(track)
+
+
+def test_analyse_loudness(monkeypatch, make_tmp_file):
+    tmp_file = make_tmp_file("file.ogg")
+    stderr = b"""
+[silencedetect @ 0x0] silence_start: -0.01
+[silencedetect @ 0x0] silence_end: 1.5 | silence_duration: 1.51
+[silencedetect @ 0x0] silence_start: 95.25
+[Parsed_loudnorm_1 @ 0x0]
+{
+    "input_i" : "-9.50",
+    "input_tp" : "-0.20",
+    "input_lra" : "5.30",
+    "input_thresh" : "-19.80"
+}
+"""
+
+    def ffmpeg_run(args, **kwargs):
+        return subprocess.CompletedProcess(args, 0, stderr=stderr)
+
+    monkeypatch.setattr(subprocess, "run", ffmpeg_run)
+    assert utils.analyse_loudness(tmp_file, 100) == (-9.5, -0.2, 1.5, 95.25)
+
+    monkeypatch.setattr(
+        subprocess,
+        "run",
+        lambda args, **kwargs: subprocess.CompletedProcess(args, 1, stderr=b""),
+    )
+    assert utils.analyse_loudness(tmp_file, 100) is None
+
+
+def test_loudness_gain(monkeypatch):
+    with app.app_context():
+        monkeypatch.setitem(app.config, "LOUDNESS_NORMALISE", False)
+        assert utils.loudness_gain(-20.0, -5.0) == 0.0
+        monkeypatch.setitem(app.config, "LOUDNESS_NORMALISE", True)
+        monkeypatch.setitem(app.config, "LOUDNESS_TARGET", -16)
+        assert utils.loudness_gain(None, None) == 0.0
+        assert utils.loudness_gain(-10.0, -3.0) == -6.0
+        # gain is limited by the true peak
+        assert utils.loudness_gain(-20.0, -2.0) == 1.0
+
+
+def test_get_audio_info(monkeypatch, make_tmp_file):
+    tmp_file = make_tmp_file("file.ogg")
+    tmp_file.write_bytes(b"x" * 10)
+
+    class Info:
+        bitrate = 160000
+        sample_rate = 44100
+        channels = 2
+
+    class File:
+        info = Info()
+
+    monkeypatch.setattr(mutagen, "File", lambda *args, **kwargs: File())
+    info = utils.get_audio_info(tmp_file)
+    assert info["size"] == 10
+    assert info["mtime"] == tmp_file.stat().st_mtime
+    assert (info["bitrate"], info["sample_rate"], info["channels"]) == (160000, 44100, 2)
+
+    # unreadable files still report their size
+    monkeypatch.setattr(mutagen, "File", lambda *args, **kwargs: None)
+    assert set(utils.get_audio_info(tmp_file)) == {"size", "mtime"}
+
+
+def test_find_duplicate(db, make_db_test_songs, make_tmp_file):
+    tmp_file = make_tmp_file("file.ogg")
+    tmp_file.write_bytes(b"audio")
+    hashes = utils.hash_song(tmp_file)
+    assert hashes == {"source_hash": hashlib.sha256(b"audio").hexdigest()}
+    assert utils.find_duplicate(hashes) is None
+
+    song = make_db_test_songs(1)[0]
+    song.source_hash = hashes["source_hash"]
+    db.commit()
+    assert utils.find_duplicate(hashes) == song
+    assert utils.find_duplicate({"audio_hash": "0" * 64}) is None
+
+
+def test_update_song_keeps_hashes(db, redis, make_db_test_songs, make_tmp_file):
+    tmp_file = make_tmp_file("test-0.ogg")
+    tmp_file.write_bytes(b"encoded")
+    song = make_db_test_songs(1)[0]
+    song.source_hash = "0" * 64
+    meta = {"path": tmp_file, "artist": "Artist", "title": "Title", "length": 100}
+    meta["hashes"] = utils.hash_song(tmp_file)
+    utils.update_song(song, meta)
+    # the hash of the original upload is not replaced by the encoded file's
+    assert song.source_hash == "0" * 64
+    assert song.artist == "Artist"
+
+    song.source_hash = ""
+    utils.update_song(song, meta)
+    assert song.source_hash == meta["hashes"]["source_hash"]
@@ -0,0 +1,162 @@
+import logging
+import threading
+import time
+from pathlib import Path
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+from pony.orm import commit
+from pony.orm import db_session
+
+from radio import app
+from radio.common.utils import insert_song
+from radio.common.utils import load_manifest
+from radio.common.utils import read_song
+from radio.common.utils import reload_songs
+from radio.common.utils import remove_songs
+from radio.common.utils import save_manifest
+from radio.common.utils import update_song
+from radio.database import Song
+
+try:
+    from watchdog.events import FileSystemEvent
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s:%(process)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger("watcher")
+
+
+class LibraryWatcher(FileSystemEventHandler):
+    """
+    Keeps the Songs table in sync with the music directory as files change.
+    Events are debounced per file, so a file is only read once it has stopped
+    changing (e.g. once an encode or a copy has finished).
+
+    :param path: music directory to watch
+    :param debounce: how long a file must be left alone before it is read, in seconds
+    """
+
+    def __init__(self, path: Path, debounce: float = 2.0):
+        self.path = path.resolve()
+        self.debounce = debounce
+        # filename -> time of its latest event
+        self.pending: Dict[str, float] = {}
+        self.lock = threading.Lock()
+        self.manifest: Dict[str, Tuple[int, float]] = {}
+
+    def touch(self, src_path: str) -> None:
+        path = Path(src_path)
+        if path.parent != self.path or path.suffix != ".ogg":
+            return
+        with self.lock:
+            self.pending[path.name] = time.monotonic()
+
+    def on_created(self, event: "FileSystemEvent") -> None:
+        self.touch(event.src_path)
+
+    def on_modified(self, event: "FileSystemEvent") -> None:
+        self.touch(event.src_path)
+
+    def on_deleted(self, event: "FileSystemEvent") -> None:
+        self.touch(event.src_path)
+
+    def on_moved(self, event: "FileSystemEvent") -> None:
+        self.touch(event.src_path)
+        self.touch(event.dest_path)
+
+    def ready(self) -> List[str]:
+        """
+        :return: files that have not changed for the debounce period
+        """
+        cutoff = time.monotonic() - self.debounce
+        with self.lock:
+            filenames = [name for name, at in self.pending.items() if at <= cutoff]
+            for filename in filenames:
+                del self.pending[filename]
+        return filenames
+
+    def stat(self, filename: str) -> Tuple[int, float]:
+        stat = (self.path / filename).stat()
+        return stat.st_size, stat.st_mtime
+
+    @db_session
+    def sync(self, filename: str) -> None:
+        """
+        Adds a new file, or updates the song of a file that was replaced
+        """
+        song = Song.get(filename=filename)
+        if not song:
+            insert_song(self.path / filename)
+        elif filename in self.manifest:
+            meta = read_song(self.path / filename)
+            if meta:
+                logger.info(f"Updating song: {filename}")
+                update_song(song, meta)
+                commit()
+        # otherwise the song was just added through an upload
+
+    def apply(self, filenames: List[str]) -> None:
+        """
+        Applies the changes to the given files to the database
+        """
+        removed = [name for name in filenames if not (self.path / name).exists()]
+        if removed:
+            logger.info(f"Removing songs: {removed}")
+            remove_songs(removed)
+        for filename in filenames:
+            if filename in removed:
+                self.manifest.pop(filename, None)
+                continue
+            try:
+                # unchanged since we last saw it, e.g. our own ReplayGain tags
+                if self.manifest.get(filename) == self.stat(filename):
+                    continue
+                self.sync(filename)
+                # the file is gone if it was a duplicate or had no tags
+                self.manifest[filename] = self.stat(filename)
+            except FileNotFoundError:
+                self.manifest.pop(filename, None)
+            except Exception:
+                logger.exception(f"Failed to sync {filename}")
+        save_manifest(self.path, self.manifest)
+
+    def run(self) -> None:
+        if Observer is None:
+            raise RuntimeError("The library watcher requires watchdog to be installed")
+        observer = Observer()
+        observer.schedule(self, str(self.path), recursive=False)
+        observer.start()
+        # catch up with changes made while we were not watching,
+        # only files changed since the last scan are read
+        report = reload_songs(self.path)
+        logger.info(f"Initial scan: {report}")
+        self.manifest = load_manifest(self.path)
+        logger.info(f"Watching {self.path} for changes")
+        try:
+            while True:
+                time.sleep(min(self.debounce / 2, 1.0))
+                filenames = self.ready()
+                if filenames:
+                    self.apply(filenames)
+        finally:
+            observer.stop()
+            observer.join()
+
+
+def run():
+    watcher = LibraryWatcher(
+        app.config["PATH_MUSIC"], app.config.get("WATCHER_DEBOUNCE", 2.0)
+    )
+    watcher.run()
+
+
+if __name__ == "__main__":
+    run()
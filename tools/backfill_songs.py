@@ -0,0 +1,60 @@
+import argparse
+import logging
+from pathlib import Path
+
+from pony.orm import commit
+from pony.orm import db_session
+from pony.orm import select
+
+from radio import app
+from radio.common.stats import update_stats
+from radio.common.utils import analyse_loudness
+from radio.common.utils import get_audio_info
+from radio.common.utils import write_replaygain_tags
+from radio.database import Song
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s:%(process)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger("backfill")
+
+parser = argparse.ArgumentParser(
+    description="Fills in file details (and optionally loudness) of existing songs"
+)
+parser.add_argument("--all", action="store_true", help="refresh every song")
+parser.add_argument("--loudness", action="store_true", help="analyse loudness too")
+parser.add_argument("--batch-size", type=int, default=200)
+args = parser.parse_args()
+
+with db_session:
+    if args.all:
+        song_ids = select(s.id for s in Song)[:]
+    elif args.loudness:
+        song_ids = select(
+            s.id for s in Song if s.size is None or s.loudness is None
+        )[:]
+    else:
+        song_ids = select(s.id for s in Song if s.size is None)[:]
+
+logger.info(f"Backfilling {len(song_ids)} songs...")
+for start in range(0, len(song_ids), args.batch_size):
+    batch = song_ids[start : start + args.batch_size]
+    with db_session:
+        for song in Song.select(lambda s: s.id in batch):
+            filepath = Path(app.config["PATH_MUSIC"], song.filename)
+            if not filepath.exists():
+                logger.warning(f"Missing file for {song.filename}, skipping.")
+                continue
+            if args.loudness and (args.all or song.loudness is None):
+                loudness = analyse_loudness(filepath, song.length)
+                if loudness:
+                    song.set(**loudness._asdict())
+                    write_replaygain_tags(filepath, loudness)
+            song.set(**get_audio_info(filepath))
+        commit()
+    logger.info(f"{min(start + args.batch_size, len(song_ids))}/{len(song_ids)} done.")
+
+# sizes changed, so recount the library totals
+update_stats(size=None)
+logger.info("Exiting...")
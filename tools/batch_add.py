@@ -1,33 +1,155 @@
 import argparse
 import concurrent.futures
+import json
+import os
 from pathlib import Path
+from typing import Any
+from typing import Dict
+from typing import Optional
 
-from radio.common.utils import encode_file, next_song, reload_songs, EncodeError
+from radio import app
+from radio.common.utils import encode_file
+from radio.common.utils import find_duplicate
+from radio.common.utils import hash_song
+from radio.common.utils import insert_songs
+from radio.common.utils import next_song
+from radio.common.utils import read_song
+from radio.common.utils import reload_songs
 
 parser = argparse.ArgumentParser()
 parser.add_argument("paths", nargs="*")
-parser.add_argument("--skip", action="store_true")
+parser.add_argument(
+    "--skip", action="store_true", help="rescan the music directory instead"
+)
 parser.add_argument("--remove-original", action="store_true")
 parser.add_argument("--seed", type=int, default=0)
+parser.add_argument("--threads", type=int, default=1, help="threads per ffmpeg")
+parser.add_argument(
+    "--workers", type=int, default=0, help="files encoded at once (default: CPUs)"
+)
+parser.add_argument("--batch-size", type=int, default=50)
+parser.add_argument(
+    "--journal",
+    type=Path,
+    default=Path(app.config["PATH_ENCODE"], ".batch_add.journal"),
+    help="file recording progress, so an interrupted run can be resumed",
+)
 args = parser.parse_args()
 
+# journal states of an input: encoded but not yet in the database, or finished
+ENCODED = "encoded"
+FINISHED = ("added", "duplicate", "failed")
 
-def encode(arg: Path) -> Path:
+
+def load_journal(path: Path) -> Dict[str, Dict[str, Any]]:
+    """
+    :return: latest journal entry of each input
+    """
+    entries = {}
     try:
-        encode_file(arg, remove_original=args.remove_original)
-        print(str(arg) + " completed.")
-    except EncodeError:
-        print(f"Error encoding file {arg}")
-    return arg
+        with open(path) as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the last line is cut short if we were killed mid-write
+                    continue
+                entries[entry["input"]] = entry
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+def record(**entry: Any) -> None:
+    journal.write(json.dumps(entry) + "\n")
+    journal.flush()
+    os.fsync(journal.fileno())
+
+
+def encode(arg: Path, output: Optional[Path]) -> Dict[str, Any]:
+    """
+    Encodes a single input (unless a previous run already did) and reads the result
+    """
+    # skip files that are already in the library before encoding them
+    hashes = hash_song(arg) if arg.exists() else {}
+    duplicate = hashes and find_duplicate(hashes)
+    if duplicate:
+        return dict(status="duplicate", output=duplicate.filename)
+    if not output or not output.exists():
+        output = encode_file(
+            arg, remove_original=args.remove_original, threads=args.threads
+        )
+    meta = read_song(output)
+    if meta and hashes:
+        meta["hashes"] = hashes
+    return dict(status=ENCODED, output=str(output), meta=meta)
+
+
+def insert(batch: Dict[str, Dict[str, Any]]) -> None:
+    """
+    Adds a batch of encoded files to the database, then marks them as finished
+    """
+    added = {song.filename for song in insert_songs(list(batch.values()))}
+    for arg, meta in batch.items():
+        status = "added" if meta["path"].name in added else "duplicate"
+        record(input=arg, status=status, output=str(meta["path"]))
+        print(f"{arg} {status}.")
 
 
-if not args.skip:
-    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
-        futures = {executor.submit(encode, Path(file)): file for file in args.paths}
-        for future in concurrent.futures.as_completed(futures):
-            print(future.result())
+if args.paths and not args.skip:
+    workers = args.workers or max(1, (os.cpu_count() or 1) // max(1, args.threads))
+    args.journal.parent.mkdir(parents=True, exist_ok=True)
+    previous = load_journal(args.journal)
+    inputs = {}
+    for file in args.paths:
+        key = str(Path(file).resolve())
+        entry = previous.get(key, {})
+        if entry.get("status") in FINISHED:
+            print(f"{file} was {entry['status']} by a previous run, skipping.")
+            continue
+        output = entry.get("output")
+        inputs[key] = Path(output) if output else None
 
-reload_songs()
+    print(f"Encoding {len(inputs)} files, {workers} at a time...")
+    with open(args.journal, "a") as journal:
+        batch: Dict[str, Dict[str, Any]] = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(encode, Path(arg), output): arg
+                for arg, output in inputs.items()
+            }
+            for future in concurrent.futures.as_completed(futures):
+                arg = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # one bad file must not stop the rest of the batch
+                    print(f"Error encoding file {arg}: {e!r}")
+                    record(input=arg, status="failed", error=repr(e))
+                    continue
+                meta = result.pop("meta", None)
+                if result["status"] == ENCODED and not meta:
+                    # read_song removes files it cannot read
+                    print(f"{arg} has no metadata, skipping.")
+                    record(input=arg, status="failed")
+                    continue
+                record(input=arg, **result)
+                if meta:
+                    batch[arg] = meta
+                else:
+                    print(f"{arg} is already in the library as {result['output']}.")
+                if len(batch) >= args.batch_size:
+                    insert(batch)
+                    batch = {}
+        if batch:
+            insert(batch)
+else:
+    # nothing to encode, bring the database up to date with the music directory
+    report = reload_songs()
+    print(
+        f"Added {report.added}, updated {report.updated} and removed {report.removed} "
+        f"songs ({report.failed} could not be read)."
+    )
 
 if args.seed and args.seed > 0:
     for _ in range(args.seed):
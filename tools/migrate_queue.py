@@ -0,0 +1,35 @@
+import argparse
+
+from radio import redis_client
+from radio.common.queue import QUEUE_BACKENDS
+from radio.common.queue import RedisQueue
+from radio.common.queue import get_queue_backend
+
+parser = argparse.ArgumentParser()
+parser.add_argument("source", choices=QUEUE_BACKENDS)
+parser.add_argument("target", choices=QUEUE_BACKENDS)
+parser.add_argument("--keep", action="store_true", help="keep the source queue")
+args = parser.parse_args()
+
+if args.source == args.target:
+    parser.error("source and target must differ")
+
+source = get_queue_backend(args.source)
+target = get_queue_backend(args.target)
+entries = source.entries()
+
+target.clear()
+if isinstance(target, RedisQueue):
+    # keep entry IDs and times, new entries are numbered after them
+    for entry in entries:
+        target.insert(entry.id, entry.song_id, entry.requested, entry.added)
+    if entries:
+        redis_client.set(target.counter_key, max(entry.id for entry in entries))
+else:
+    for entry in entries:
+        target.add([entry.song_id], requested=entry.requested)
+if not args.keep:
+    source.clear()
+
+print(f"Moved {len(entries)} queue entries from {args.source} to {args.target}.")
+print(f'Set QUEUE_BACKEND = "{args.target}" in your config and restart.')